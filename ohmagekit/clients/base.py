@@ -1,53 +1,292 @@
-import httplib2, mimetypes, simplejson, urllib, uuid
-from datetime import datetime
+import httplib, socket, time, urllib, urlparse, Queue
 
 # and for multipart stuff
 from poster.encode import multipart_encode
-from poster.streaminghttp import register_openers
-import urllib2
 
-# Register the streaming http handlers with urllib2
-register_openers()
+# the keep-alive connection pool that carries every request
+from transport import ConnectError, shared_pool
+from concurrency import spawn
+from metrics import RequestEvent
+from routing import ServerRouter
             
 class BaseApi(object):
     """
     Consolidates functionality common across all HTTP(S) APIs. 
+    
+    Requests are sent over a keep-alive ConnectionPool. Unless a pool is passed in
+    explicitly, all handles share a single process-wide pool. Calling close() (or
+    using the handle as a context manager) closes the pool's idle connections.
+    
+    Each attempt is made exactly once unless these attributes are set on the handle:
+    
+    retry_policy = A RetryPolicy (see ohmagekit.clients.retry) for failed attempts.
+    circuit_breaker = A CircuitBreaker, usually CircuitBreaker.for_server(self.server).
+    hedge_after = Seconds after which an idempotent request that hasn't been answered
+        is sent a second time; whichever copy is answered first is used.
+        
+    Observers added with add_observer() receive a RequestEvent for every request.
+    
+    'server' may also be a list of replicas of the server, or a ServerRouter (see
+    ohmagekit.clients.routing) for them, in which case each request is routed to one of
+    them: reads to the fastest healthy replica, and writes to the primaries (by default,
+    the first replica). A request that fails moves on to the next candidate, as long as
+    sending it again is safe. 'server' is then the first primary.
     """
     
-    def __init__(self, server, app_prefix):
+    retry_policy = None
+    circuit_breaker = None
+    hedge_after = None
+    observers = ()
+    router = None
+    
+    def __init__(self, server, app_prefix, pool=None):
+        if isinstance(server, (list, tuple)):
+            server = ServerRouter(server)
+        if isinstance(server, ServerRouter):
+            self.router, server = server, server.primaries[0]
+            
         self.server = server
         self.app_prefix = app_prefix
+        self.pool = pool if pool is not None else shared_pool()
+    
+    def close(self):
+        """
+        Closes the idle connections held by this handle's pool. The handle remains
+        usable afterward; new connections are opened as they're needed.
+        """
+        self.pool.close()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def add_observer(self, observer):
+        """
+        Arranges for observer(event) to be called with a RequestEvent (see
+        ohmagekit.clients.metrics) after each request this handle makes. Observers
+        are called on the requesting thread, so they should be quick and must not raise.
+        """
+        self.observers = tuple(self.observers) + (observer,)
+        
+    def remove_observer(self, observer):
+        # compared by equality, since a bound method (e.g. events.append) is a new object each time
+        self.observers = tuple(o for o in self.observers if o != observer)
     
     # utility function to handle the dirty work of making a connection, catching errors, and returning the parsed result
     def _perform_request(self, uri, params, method="GET", request_type="standard"):
-        http = httplib2.Http()
+        resp = self._open_request(uri, params, method, request_type)
+        content = resp.read()
+        
+        started = time.time()
+        try:
+            result = self._handle_response(content, resp.getheader('content-type'), params)
+        except Exception, ex:
+            self._emit_response(resp, parse=time.time() - started, error=ex)
+            if resp.request_compressed and self._refuses_compression(ex):
+                # the server couldn't decode the compressed body, but said so in a way the pool
+                # can't recognize; it didn't act on the request, so send it again uncompressed
+                self.pool.compression_refused(resp)
+                return BaseApi._perform_request(self, uri, params, method, request_type)
+            raise
+        
+        self._emit_response(resp, parse=time.time() - started)
+        return result
+        
+    def _open_request(self, uri, params, method="GET", request_type="standard"):
+        """
+        Sends a request and returns the pooled response once its headers have arrived,
+        leaving the body to be read by the caller. Raises BaseApi.HTTPException (having
+        read the body into it) if the status is anything but 200.
+        """
         url = self.server + self.app_prefix + uri
         
         if request_type == "standard":
-            params = urllib.urlencode(params)
-            # this is where the work happens
-            resp, content = http.request(url, method, params, headers={'Content-type': 'application/x-www-form-urlencoded'})
+            body = urllib.urlencode(params)
+            headers = {'Content-type': 'application/x-www-form-urlencoded'}
         elif request_type == "multipart":
-            try:
-                datagen, headers = multipart_encode(params)
-                request = urllib2.Request(url, datagen, headers)
-                # or, alternatively, here
-                content = urllib2.urlopen(request).read()
-                # we assume it went through if no exception was thrown
-                resp = {'status': '200'}
-            except urllib2.HTTPError, ex:
-                resp = {'status': str(ex.code)}
+            # the body is a generator, which the pool's streaming connections send piecewise
+            body, headers = multipart_encode(params)
         else:
             raise Exception("Unknown request_type %s given to %s._perform_request(), must be 'standard' or 'multipart'" % (request_type, self.__class__.__name__))
         
-        if resp['status'] != '200':
-            raise BaseApi.HTTPException(self.__class__.__name__, resp['status'], body=content)
+        # this is where the work happens; everything but uploads can safely be sent twice
+        resp = self._send(url, method, body, headers, idempotent=(request_type == "standard"), endpoint=uri)
+        
+        if resp.status != 200:
+            ex = BaseApi.HTTPException(self.__class__.__name__, str(resp.status), body=resp.read())
+            self._emit_response(resp, error=ex)
+            raise ex
 
-        return self._handle_response(content)
+        return resp
+                
+    def _send(self, url, method, body, headers, idempotent=True, endpoint=None, sign=None):
+        """
+        Sends a request over the pool, subject to the handle's retry policy, circuit
+        breaker and hedging, and returns the PooledResponse of the final attempt.
+        
+        If given, sign(url, body, headers) returns the url, body and headers to actually
+        send; it's called for each attempt (and each hedged copy) separately, so that
+        signed requests like OAuth's carry a fresh nonce and timestamp every time.
+        
+        If the handle has observers, the response carries a RequestEvent for 'endpoint'
+        (by default, the path of the url), which _emit_response() completes and sends
+        once the response has been consumed.
+        """
+        started = time.time()
+        
+        try:
+            if self.router is not None and url.startswith(self.server):
+                resp, attempts = self._send_routed(url[len(self.server):], method, body, headers, idempotent, sign)
+            else:
+                resp, attempts = self._send_attempts(url, method, body, headers, idempotent, sign)
+        except Exception, ex:
+            if self.observers:
+                self._emit(RequestEvent(service=self.__class__.__name__, endpoint=endpoint or urlparse.urlsplit(url).path,
+                    method=method, error=ex, total=time.time() - started))
+            raise
+            
+        resp.started = started
+        if self.observers:
+            resp.event = RequestEvent(service=self.__class__.__name__, endpoint=endpoint or urlparse.urlsplit(url).path,
+                method=method, attempts=attempts)
+        
+        return resp
+        
+    def _send_routed(self, path, method, body, headers, idempotent, sign=None):
+        # sends the request to the router's candidates in turn (requests that aren't idempotent
+        # being writes), moving on from one that fails if the request can safely be sent again
+        candidates = self.router.candidates(write=not idempotent)
+        
+        for i, server in enumerate(candidates):
+            last = i + 1 == len(candidates)
+            started = time.time()
+            
+            try:
+                resp, attempts = self._send_attempts(server + path, method, body, headers, idempotent, sign)
+            except (socket.error, httplib.HTTPException), ex:
+                self.router.record(server, error=True)
+                if last or not (idempotent or isinstance(ex, ConnectError)):
+                    raise
+                continue
+                
+            if resp.status >= 500:
+                self.router.record(server, error=True)
+                if not last and (idempotent or resp.status == 503):
+                    # finish off the response so that its connection can be reused
+                    resp.read()
+                    continue
+            else:
+                self.router.record(server, latency=time.time() - started)
+                
+            return resp, attempts
+            
+    def _send_attempts(self, url, method, body, headers, idempotent, sign=None):
+        # makes up to retry_policy.max_attempts attempts; returns the final response and the attempt count
+        policy = self.retry_policy
+        attempts = policy.max_attempts if policy is not None else 1
+        
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(policy.delay(attempt - 1))
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_request()
+                
+            try:
+                if self.hedge_after is not None and idempotent:
+                    resp = self._send_hedged(url, method, body, headers, sign)
+                else:
+                    resp = self.pool.request(*_signed(sign, url, method, body, headers), idempotent=idempotent)
+            except (socket.error, httplib.HTTPException), ex:
+                self._record_outcome(False)
+                if attempt + 1 == attempts or not policy.should_retry_error(ex, idempotent):
+                    raise
+                continue
+            except:
+                # anything else (a bad url, or a failure in signing) still ends a trial request,
+                # which would otherwise leave the breaker half-open for good
+                self._record_outcome(False)
+                raise
+                
+            self._record_outcome(resp.status < 500)
+            
+            if attempt + 1 < attempts and policy.should_retry_status(resp.status, idempotent):
+                # finish off the response so that its connection can be reused
+                resp.read()
+                continue
+                
+            return resp, attempt + 1
+            
+    def _send_hedged(self, url, method, body, headers, sign=None):
+        # sends the request, then a second copy if the first hasn't been answered within
+        # hedge_after seconds, and returns whichever response arrives first
+        done = Queue.Queue()
+        first = spawn(self.pool.request, *_signed(sign, url, method, body, headers) + (True,))
+        first.add_done_callback(done.put)
+        
+        try:
+            return done.get(timeout=self.hedge_after).result()
+        except Queue.Empty:
+            pass
+            
+        second = spawn(self.pool.request, *_signed(sign, url, method, body, headers) + (True,))
+        second.add_done_callback(done.put)
+        
+        winner = done.get()
+        if winner.exception() is not None:
+            # the copy that finished first failed, but the other one may still succeed
+            winner = done.get()
+            
+        loser = second if winner is first else first
+        loser.add_done_callback(_discard_response)
+        return winner.result()
+        
+    def _emit_response(self, resp, parse=None, error=None):
+        """
+        Completes the response's RequestEvent with its status, sizes and timings, and
+        sends it to the observers. Does nothing if the event has already been sent, or
+        if the handle has no observers.
+        """
+        event, resp.event = resp.event, None
+        if event is None:
+            return
+        
+        event.status = resp.status
+        event.bytes_sent = resp.bytes_sent
+        event.bytes_received = resp.bytes_received
+        event.connect = resp.connect_time
+        event.first_byte = resp.first_byte_time
+        event.download = resp.download_time
+        event.parse = parse
+        event.error = error
+        event.total = time.time() - resp.started
+        self._emit(event)
+        
+    def _emit(self, event):
+        for observer in self.observers:
+            observer(event)
+            
+    def _record_outcome(self, success):
+        if self.circuit_breaker is not None:
+            if success:
+                self.circuit_breaker.record_success()
+            else:
+                self.circuit_breaker.record_failure()
                 
-    def _handle_response(self, data):
+    def _refuses_compression(self, ex):
+        """
+        Returns whether 'ex', raised by _handle_response() for the answer to a request whose
+        body was compressed, means that the server couldn't decode the body. Servers that
+        can't usually answer 400 or 415, which the pool handles itself; derived classes whose
+        servers answer with an error of their own should override this to recognize it.
+        """
+        return False
+        
+    def _handle_response(self, data, content_type=None, params=None):
         """
         Performs unified handling of the response to trap for error conditions, format according to the API defs, etc.
+        The response's Content-Type and the request's params are given so that the body can be decoded appropriately.
         This base version is a stub that simply returns the data as-is.
         
         Derived API classes should override this method to raise their own exceptions when API-level errors occur
@@ -65,4 +304,15 @@ class BaseApi(object):
             return "%s errored w/HTTP code %s" % (self.service, self.code)
             
         def __unicode__(self):
-            return unicode(self.__str__())
\ No newline at end of file
+            return unicode(self.__str__())
+
+def _signed(sign, url, method, body, headers):
+    # the arguments for pool.request() for one attempt at a request
+    if sign is not None:
+        url, body, headers = sign(url, body, headers)
+    return url, method, body, headers
+
+def _discard_response(future):
+    # closes the response of a hedged request that lost the race, once it arrives
+    if future.exception() is None:
+        future.result().close()
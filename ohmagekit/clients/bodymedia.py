@@ -1,5 +1,6 @@
 from oauth import OAuthApi
-import simplejson, functools
+from ratelimit import merge_ranges, covered
+import collections, formats
 import oauth2 as oauth
 
 # enables debugging output to the console
@@ -11,12 +12,21 @@ class BodyMediaApi(OAuthApi):
     can be made against the server and returns appropriate values for results.
     """
 
-    def __init__(self, server, api_key, api_secret, request_token_url, access_token_url, authenticate_url, app_prefix='/v2/json'):
+    # what fetch_many() polls by default
+    fetch_method = 'step_day'
+
+    # BodyMedia doesn't publish its quotas, which are set per app key; give the handle a
+    # RateLimiter with your key's limits to pace it. likewise, set max_range_days to have
+    # step_day() split longer ranges into several requests if your key is limited to one
+    rate_limits = None
+    max_range_days = None
+
+    def __init__(self, server, api_key, api_secret, request_token_url, access_token_url, authenticate_url, app_prefix='/v2/json', pool=None, rate_limiter=None):
         super(BodyMediaApi, self).__init__(
             server,
             api_key, api_secret,
             request_token_url, access_token_url, authenticate_url,
-            app_prefix)
+            app_prefix, pool, rate_limiter)
 
     # ============================================================================
     # === OVERRIDDEN BASE METHODS
@@ -33,11 +43,43 @@ class BodyMediaApi(OAuthApi):
     # ============================================================================
 
     def step_day(self, token, start='20120101', end='20120502'):
+        """
+        Reads the daily step counts from 'start' through 'end' (dates, or strings in YYYYMMDD
+        form). A range longer than max_range_days is read in several requests, and their
+        'days' and 'totalSteps' are combined.
+        """
+        try:
+            ranges = merge_ranges([(start, end)], self.max_range_days) or [(start, end)]
+        except (AttributeError, ValueError):
+            # anything that isn't a date is passed through as it is, for the server to judge
+            ranges = [(start, end)]
+
+        results = [self._step_day(token, lo, hi) for lo, hi in ranges]
+
+        for result in results[1:]:
+            results[0]['days'].extend(result.get('days', []))
+            results[0]['totalSteps'] = results[0].get('totalSteps', 0) + result.get('totalSteps', 0)
+        return results[0]
+
+    def steps_by_date(self, token, ranges, max_gap_days=7):
+        """
+        Reads the daily step counts for all the given (start, end) date ranges, in as few
+        requests as possible: overlapping ranges, and those less than max_gap_days apart,
+        are read together. Returns an OrderedDict mapping each date in the ranges that
+        BodyMedia has a count for ('YYYY-MM-DD') to its step count.
+        """
+        steps = {}
+        for start, end in merge_ranges(ranges, self.max_range_days, max_gap_days):
+            for day in self._step_day(token, start, end).get('days', []):
+                steps[day['date']] = day['totalSteps']
+
+        dates = ((day.isoformat(), day.strftime('%Y%m%d')) for day in sorted(covered(ranges)))
+        return collections.OrderedDict((day, steps[key]) for day, key in dates if key in steps)
+
+    def _step_day(self, token, start, end):
         # set up for an authed request
         token = oauth.Token(token['oauth_token'], token['oauth_secret'])
-        client = oauth.Client(self.consumer, token)
-        client.set_signature_method(oauth.SignatureMethod_PLAINTEXT())
-        url = self.server + self.app_prefix + '/step/day/%s/%s?api_key=%s' % (start, end, self.api_key)
+        url = self.server + self.app_prefix + '/step/day/%s/%s?api_key=%s' % (_param(start), _param(end), self.api_key)
 
         if debug: print "Accessing URL: %s" % url
 
@@ -45,12 +87,16 @@ class BodyMediaApi(OAuthApi):
         headers = {'Content-Type': 'application/json'}
 
         # and launch the request
-        resp, content = client.request(url, "GET", headers=headers, force_auth_headers=True)
-        if resp['status'] != '200':
-            print content
-            raise Exception("Invalid response from BodyMedia.")
+        status, content = self._perform_oauth_request(url, token, "GET", headers=headers, force_auth_headers=True)
+        if status != 200:
+            if debug: print content
+            raise OAuthApi.OAuthException("Invalid response (%s) from BodyMedia." % status, content)
 
-        if debug: print "Returned (%s): %s" % (resp['status'], content)
+        if debug: print "Returned (%s): %s" % (status, content)
 
         # return the interpreted data
-        return simplejson.loads(content)
\ No newline at end of file
+        return formats.loads(content)
+
+def _param(value):
+    # dates go in the url as YYYYMMDD
+    return value.strftime('%Y%m%d') if hasattr(value, 'strftime') else value
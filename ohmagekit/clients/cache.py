@@ -0,0 +1,156 @@
+"""
+Response caches for read-mostly API endpoints.
+
+A cache maps a key to a value for ttl seconds. Keys are tuples whose first
+element is the endpoint's uri, which lets all the entries for one endpoint be
+invalidated together. Two backends are provided: LRUCache keeps entries in
+memory, evicting the least recently used beyond maxsize, and DiskCache keeps
+them as pickles in a directory, so they survive across processes and runs.
+
+Both count their hits, misses and evictions; see stats().
+"""
+
+import collections, cPickle, hashlib, os, tempfile, threading, time
+
+class _CacheStats(object):
+    def _init_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """
+        Returns a dict with the number of hits, misses, evictions and current entries.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self)}
+
+class LRUCache(_CacheStats):
+    """
+    An in-memory cache of at most maxsize entries, each of which expires ttl seconds
+    after it was stored. Values are returned as-is, so callers shouldn't modify them.
+    """
+
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # maps key to (expires, value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._init_stats()
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or None if it's absent or expired.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.evictions += 1
+                self.misses += 1
+                return None
+
+            # re-inserting moves the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, uri=None):
+        """
+        Drops every entry for the given endpoint uri, or all entries if uri is None.
+        """
+        with self._lock:
+            if uri is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == uri]:
+                    del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskCache(_CacheStats):
+    """
+    A cache that stores each entry as a pickle file in 'directory', which is created
+    if need be. Entries expire ttl seconds after they were stored; expired files are
+    removed when they're next looked up.
+    """
+
+    def __init__(self, directory, ttl=300):
+        self.directory = directory
+        self.ttl = ttl
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._init_stats()
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or None if it's absent or expired.
+        """
+        path = self._path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                expires, value = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        if expires < time.time():
+            self._remove(path)
+            self.evictions += 1
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        # write to a temporary file first so that readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump((time.time() + self.ttl, value), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._path(key))
+        except:
+            # e.g. a value that can't be pickled, or a full disk
+            self._remove(tmp_path)
+            raise
+
+    def invalidate(self, uri=None):
+        """
+        Drops every entry for the given endpoint uri, or all entries if uri is None.
+        """
+        prefix = _digest(uri) + '-' if uri is not None else ''
+
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache') and name.startswith(prefix):
+                self._remove(os.path.join(self.directory, name))
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.cache'))
+
+    def _path(self, key):
+        # the uri gets its own part of the file name so that invalidate() can find its entries
+        return os.path.join(self.directory, "%s-%s.cache" % (_digest(key[0]), _digest(repr(key))))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _digest(value):
+    return hashlib.sha1(value).hexdigest()
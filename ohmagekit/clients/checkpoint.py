@@ -0,0 +1,75 @@
+"""
+A durable record of completed work, so that a long-running job that's interrupted
+can pick up where it left off. Used by bulk uploads and by ohmagekit.export.
+"""
+
+import os, simplejson, tempfile, threading
+
+class Checkpoint(object):
+    """
+    The set of completed job keys (tuples of strings), persisted to an append-only
+    file with one JSON-encoded key per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                complete = 0
+                for line in f:
+                    if not line.endswith('\n'):
+                        # the last line was cut short by an interruption; it's cut off, or the
+                        # next key would be appended to it and neither could be read back
+                        f.truncate(complete)
+                        break
+                    complete += len(line)
+                    try:
+                        self._done.add(tuple(simplejson.loads(line)))
+                    except ValueError:
+                        pass
+
+        self._file = open(path, 'a')
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, key):
+        with self._lock:
+            if key in self._done or self._file.closed:
+                return
+            self._done.add(key)
+            self._file.write(simplejson.dumps(list(key)) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def prune(self, predicate):
+        """
+        Forgets the keys for which predicate(key) is true, rewriting the file without them.
+        """
+        with self._lock:
+            self._done = set(key for key in self._done if not predicate(key))
+
+            self._file.close()
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    for key in sorted(self._done):
+                        f.write(simplejson.dumps(list(key)) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_path, self.path)
+            except:
+                os.remove(tmp_path)
+                raise
+            finally:
+                self._file = open(self.path, 'a')
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,263 @@
+"""
+Minimal futures and a bounded worker pool for running API calls concurrently.
+
+Nearly all of the time spent in an API call is network wait, so plain threads
+are enough to overlap many calls. Exceptions raised by a call are captured in
+its Future and re-raised (with their original traceback) by Future.result().
+"""
+
+import sys, threading, Queue
+
+class Future(object):
+    """
+    The eventual result of a call running on another thread.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Blocks until the call completes and returns its value, or re-raises the
+        exception it produced. Raises Future.Timeout if timeout seconds elapse first.
+        """
+        if not self._done.wait(timeout):
+            raise Future.Timeout()
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Blocks until the call completes and returns the exception it raised, or None.
+        """
+        if not self._done.wait(timeout):
+            raise Future.Timeout()
+
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, fn):
+        """
+        Arranges for fn(future) to be called when the future completes. If it already
+        has, fn is called immediately on the calling thread.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._complete()
+
+    def set_exception(self, exc_info):
+        """
+        Completes the future with an exception, given as a sys.exc_info() tuple.
+        """
+        self._exc_info = exc_info
+        self._complete()
+
+    def _complete(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fn in callbacks:
+            fn(self)
+
+    def _run(self, fn, args, kwargs):
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            self.set_exception(sys.exc_info())
+        else:
+            self.set_result(result)
+
+    class Timeout(Exception):
+        def __str__(self):
+            return "Timed out waiting for a future to complete"
+
+class WorkerPool(object):
+    """
+    Runs submitted calls on at most max_workers threads, queueing the rest.
+
+    Threads are started on demand and exit when the pool is shut down.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedules fn(*args, **kwargs) and returns a Future for its result.
+        """
+        future = Future()
+
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit calls to a WorkerPool that has been shut down")
+
+            self._queue.put((future, fn, args, kwargs))
+
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+        return future
+
+    def map(self, fn, *iterables):
+        """
+        Submits fn once per item (or per tuple of items, given several iterables) and
+        returns the list of futures, in order.
+        """
+        return [self.submit(fn, *args) for args in zip(*iterables)]
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        Stops accepting calls. Calls already queued still run, unless cancel_pending is
+        true, in which case those that haven't started are dropped and their futures raise
+        WorkerPool.Cancelled. If wait is true, blocks until the running calls have finished.
+        """
+        with self._lock:
+            first = not self._shutdown
+            self._shutdown = True
+            threads = list(self._threads)
+
+        if cancel_pending:
+            self._cancel_pending()
+
+        if first:
+            for thread in threads:
+                self._queue.put(None)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def _cancel_pending(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            if item is None:
+                # a worker's signal to exit, from an earlier shutdown(); it still needs it
+                self._queue.put(None)
+                return
+
+            try:
+                raise WorkerPool.Cancelled()
+            except WorkerPool.Cancelled:
+                item[0].set_exception(sys.exc_info())
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, fn, args, kwargs = item
+            future._run(fn, args, kwargs)
+
+    class Cancelled(Exception):
+        def __str__(self):
+            return "The call was cancelled before it started"
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls for the same key into one: while a call for a key is
+    running, other calls for that key wait for it and get its result (or exception)
+    instead of running their own. Calls made after it has finished run anew.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn, *args, **kwargs):
+        """
+        Returns fn(*args, **kwargs), or the result of the call already running for key.
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._flights.get(key)
+            if future is None:
+                future = self._flights[key] = Future()
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            exc_info = sys.exc_info()
+            self._land(key)
+            future.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self._land(key)
+        future.set_result(result)
+        return result
+
+    def _land(self, key):
+        with self._lock:
+            del self._flights[key]
+
+def spawn(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) on a new daemon thread and returns a Future for its result.
+    """
+    future = Future()
+    thread = threading.Thread(target=future._run, args=(fn, args, kwargs))
+    thread.daemon = True
+    thread.start()
+    return future
+
+def wait_all(futures, return_exceptions=False):
+    """
+    Waits for every future and returns their results in order. The first exception
+    encountered is re-raised, unless return_exceptions is true, in which case the
+    exception takes the place of the result.
+    """
+    results = []
+
+    for future in futures:
+        if return_exceptions:
+            exc = future.exception()
+            results.append(exc if exc is not None else future.result())
+        else:
+            results.append(future.result())
+
+    return results
@@ -0,0 +1,93 @@
+"""
+Lazily-fetched, refreshable Ohmage credentials.
+
+A CredentialManager holds a username and password and turns them into the two
+kinds of Ohmage credentials on demand: a hashed password (from user/auth), which
+stays valid indefinitely, and an authentication token (from user/auth_token),
+which expires after a while. Each is only fetched the first time it's needed.
+
+When a token expires, refresh_token() replaces it. However many threads notice
+the expiry at once, only one of them asks the server for a new token; the rest
+wait for it and then use the token it obtained, or get the error it met.
+"""
+
+import sys, threading
+
+class CredentialManager(object):
+    """
+    Fetches and caches the credentials of one user for an OhmageApi handle. use_token
+    and use_hashedpass say which kinds of credentials the handle may ask for.
+    """
+
+    def __init__(self, api, username, password, use_token=True, use_hashedpass=True):
+        self.api = api
+        self.username = username
+        self.use_token = use_token
+        self.use_hashedpass = use_hashedpass
+        self._password = password
+
+        self._token = None
+        self._hashedpass = None
+
+        # every token handed out so far, so that requests carrying an expired one can be recognized
+        self._issued = set()
+
+        # (stale token, sys.exc_info()) of the last refresh that failed
+        self._refresh_failure = None
+
+        # one lock per credential type, held while it's being fetched
+        self._token_lock = threading.Lock()
+        self._hashedpass_lock = threading.Lock()
+
+    def token(self):
+        """
+        Returns the current authentication token, logging in for one if needed.
+        """
+        with self._token_lock:
+            if self._token is None:
+                self._fetch_token()
+            return self._token
+
+    def hashed_password(self):
+        """
+        Returns the hashed password, logging in for it if needed.
+        """
+        with self._hashedpass_lock:
+            if self._hashedpass is None:
+                self._hashedpass = self.api.user_auth(self.username, self._password)['hashed_password']
+                self.api.auth_hashedpass = self._hashedpass
+            return self._hashedpass
+
+    def refresh_token(self, stale_token):
+        """
+        Replaces stale_token, which the server has rejected, with a new one and returns it.
+        If another caller has already replaced it, their new token is returned instead.
+
+        If replacing stale_token fails (e.g. because the password has changed), the error
+        is raised to every caller refreshing it, without asking the server again; resending
+        a bad password may get the account locked. Logging in again starts afresh.
+        """
+        with self._token_lock:
+            failure = self._refresh_failure
+            if failure is not None and failure[0] == stale_token and self._token == stale_token:
+                exc_info = failure[1]
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            if self._token is None or self._token == stale_token:
+                try:
+                    self._fetch_token()
+                except:
+                    self._refresh_failure = (stale_token, sys.exc_info())
+                    raise
+            return self._token
+
+    def issued(self, token):
+        """
+        Returns true if the given token was obtained by this manager.
+        """
+        return token in self._issued
+
+    def _fetch_token(self):
+        self._token = self.api.user_auth_token(self.username, self._password)['token']
+        self._issued.add(self._token)
+        self.api.auth_token = self._token
@@ -1,5 +1,6 @@
 from oauth import OAuthApi
-import simplejson
+from ratelimit import merge_ranges, covered
+import collections, formats
 import oauth2 as oauth
 
 class FitBitApi(OAuthApi):
@@ -8,37 +9,78 @@ class FitBitApi(OAuthApi):
     can be made against the server and returns appropriate values for results.
     """
 
-    def __init__(self, server, api_key, api_secret, request_token_url, access_token_url, authenticate_url, app_prefix='/1'):
-        super(FitBitApi, self).__init__(server, api_key, api_secret, request_token_url, access_token_url, authenticate_url, app_prefix)
+    # what fetch_many() polls by default
+    fetch_method = 'activities_steps'
+
+    # the quota FitBit's API documentation gives: 150 requests an hour per user of each app.
+    # it isn't applied unless the handle is given a RateLimiter, e.g. RateLimiter(**rate_limits)
+    rate_limits = {'user_limit': (150, 3600)}
+
+    # the longest date range FitBit's documentation says an activity time series request serves
+    max_range_days = 1095
+
+    def __init__(self, server, api_key, api_secret, request_token_url, access_token_url, authenticate_url, app_prefix='/1', pool=None, rate_limiter=None):
+        super(FitBitApi, self).__init__(server, api_key, api_secret, request_token_url, access_token_url, authenticate_url, app_prefix, pool, rate_limiter)
         
     def activities_steps(self, token, user='-', start='today', end='30d'):
+        """
+        Reads the daily step counts from 'start' through 'end', which is either a date or
+        a period such as '30d'. A date range longer than FitBit serves at once is read in
+        several requests, and their 'activities-steps' are joined.
+        """
+        try:
+            ranges = merge_ranges([(start, end)], self.max_range_days) or [(start, end)]
+        except (AttributeError, ValueError):
+            # 'today' and periods are passed through as they are
+            ranges = [(start, end)]
+
+        results = [self._activities_steps(token, user, lo, hi) for lo, hi in ranges]
+
+        for result in results[1:]:
+            results[0]['activities-steps'].extend(result['activities-steps'])
+        return results[0]
+
+    def steps_by_date(self, token, ranges, user='-', max_gap_days=30):
+        """
+        Reads the daily step counts for all the given (start, end) date ranges, in as few
+        requests as possible: overlapping ranges, and those less than max_gap_days apart,
+        are read together. Returns an OrderedDict mapping each date in the ranges that
+        FitBit has a count for ('YYYY-MM-DD') to its step count.
+        """
+        steps = {}
+        for start, end in merge_ranges(ranges, self.max_range_days, max_gap_days):
+            for day in self._activities_steps(token, user, start, end)['activities-steps']:
+                steps[day['dateTime']] = int(day['value'])
+
+        dates = (day.isoformat() for day in sorted(covered(ranges)))
+        return collections.OrderedDict((day, steps[day]) for day in dates if day in steps)
+
+    def _activities_steps(self, token, user, start, end):
         # set up for a fitbit authed request
         token = oauth.Token(token['oauth_token'], token['oauth_secret'])
-        client = oauth.Client(self.consumer, token)
-        client.set_signature_method(oauth.SignatureMethod_PLAINTEXT())
-        url = self.server + self.app_prefix + '/user/%s/activities/steps/date/%s/%s.json' % (user, start, end)
+        url = self.server + self.app_prefix + '/user/%s/activities/steps/date/%s/%s.json' % (user, _param(start), _param(end))
         
         # and launch the request
-        resp, content = client.request(url, "GET", force_auth_headers=True)
-        if resp['status'] != '200':
-            print content
-            raise Exception("Invalid response from FitBit.")
+        status, content = self._perform_oauth_request(url, token, "GET", force_auth_headers=True)
+        if status != 200:
+            raise OAuthApi.OAuthException("Invalid response (%s) from FitBit." % status, content)
         
         # return the interpreted data
-        return simplejson.loads(content)
+        return formats.loads(content)
 
     def activities_intraday_steps(self, token, date='today'):
         # set up for a fitbit authed request
         token = oauth.Token(token['oauth_token'], token['oauth_secret'])
-        client = oauth.Client(self.consumer, token)
-        client.set_signature_method(oauth.SignatureMethod_PLAINTEXT())
         url = self.server + self.app_prefix + '/user/-/activities/steps/date/%s/1d.json' % (date)
 
         # and launch the request
-        resp, content = client.request(url, "GET", force_auth_headers=True)
-        if resp['status'] != '200':
-            print content
-            raise Exception("Invalid response from FitBit.")
+        status, content = self._perform_oauth_request(url, token, "GET", force_auth_headers=True)
+        if status != 200:
+            raise OAuthApi.OAuthException("Invalid response (%s) from FitBit." % status, content)
 
         # return the interpreted data
-        return simplejson.loads(content)
\ No newline at end of file
+        return formats.loads(content)
+
+def _param(value):
+    # dates go in the url as YYYY-MM-DD; anything else ('today', '30d') as it is
+    return value.isoformat() if hasattr(value, 'isoformat') else value
@@ -0,0 +1,147 @@
+"""
+Decoding of response bodies by format.
+
+The JSON decoder is the fastest library available at import time: ujson, then
+simplejson if its C speedups are built, then the standard library's json (which
+has its own C scanner), then pure-Python simplejson. use_json_backend() picks a
+different one.
+
+Which decoder applies to a response is decided by response_format(), from the
+response's Content-Type and, failing that, the output_format that was requested,
+rather than by sniffing the body. CSV bodies are read with the csv module, one
+line at a time, so they can be decoded as they stream in.
+"""
+
+import csv, functools, simplejson
+
+def _backends():
+    # (name, loads) for each importable JSON library, fastest first
+    try:
+        import ujson
+        # ujson rounds floats unless asked not to, which would shift coordinates slightly
+        yield 'ujson', functools.partial(ujson.loads, precise_float=True)
+    except ImportError:
+        pass
+
+    if simplejson._import_c_make_encoder() is not None:
+        yield 'simplejson', simplejson.loads
+
+    try:
+        import json
+        yield 'json', json.loads
+    except ImportError:
+        pass
+
+    yield 'simplejson', simplejson.loads
+
+json_backend, _json_loads = next(_backends())
+
+def use_json_backend(name):
+    """
+    Switches JSON decoding to the named library ('ujson', 'simplejson' or 'json').
+    Raises ValueError if it isn't available.
+    """
+    global json_backend, _json_loads
+
+    for backend, loads in _backends():
+        if backend == name:
+            json_backend, _json_loads = backend, loads
+            return
+
+    raise ValueError("JSON backend '%s' is not available" % name)
+
+def loads(data):
+    """
+    Decodes a JSON document with the current backend. Raises ValueError if it's malformed.
+    """
+    return _json_loads(data)
+
+def response_format(content_type, output_format=None):
+    """
+    Returns 'json', 'csv', 'xml' or 'text' for a response with the given Content-Type
+    header, to a request for the given output_format (if any). A specific content type
+    decides; a generic or missing one defers to output_format, and then to 'json'.
+    """
+    mime = (content_type or '').split(';')[0].strip().lower()
+
+    if mime.endswith('json') or mime == 'text/javascript':
+        return 'json'
+    if mime in ('text/csv', 'application/csv', 'text/comma-separated-values'):
+        return 'csv'
+    if mime.endswith('/xml') or mime.endswith('+xml'):
+        return 'xml'
+
+    # an html page is an error from the server or a proxy in front of it, whatever was asked for
+    if mime == 'text/html':
+        return 'text'
+
+    # servers that don't label their output usually send text/plain or octet-stream
+    output_format = (output_format or '').lower()
+    if output_format == 'csv':
+        return 'csv'
+    if output_format == 'xml':
+        return 'xml'
+    return 'json'
+
+def iter_lines(read, chunk_size=64 * 1024):
+    """
+    Generates the lines (with their line endings) of a body read in chunks through
+    read(size).
+    """
+    tail = ''
+
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    if tail:
+        yield tail
+
+class CSVDecoder(object):
+    """
+    Decodes an Ohmage CSV document from an iterable of lines into dicts keyed by the
+    column headers, with the values as unicode strings.
+
+    Lines starting with '#' are not data. Ohmage uses them to carry the response's
+    metadata as JSON (a line such as #{"result":"success",...}); the last such object
+    seen is available as 'metadata' once the rows have been consumed.
+    """
+
+    def __init__(self, lines, encoding='utf-8'):
+        self.metadata = {}
+        self.encoding = encoding
+        self._lines = lines
+
+    def __iter__(self):
+        header = None
+
+        for row in csv.reader(self._data_lines()):
+            if not row:
+                continue
+
+            row = [value.decode(self.encoding) for value in row]
+            if header is None:
+                header = row
+            else:
+                yield dict(zip(header, row))
+
+    def _data_lines(self):
+        for line in self._lines:
+            if line.startswith('#'):
+                self._comment(line)
+            else:
+                yield line
+
+    def _comment(self, line):
+        text = line.lstrip('#').strip()
+        if text.startswith('{'):
+            try:
+                self.metadata = loads(text)
+            except ValueError:
+                pass
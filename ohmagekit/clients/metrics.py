@@ -0,0 +1,117 @@
+"""
+Per-request instrumentation for the API handles.
+
+Every handle derived from BaseApi can have observers, which are callables that
+receive a RequestEvent once each request has completed (see BaseApi.add_observer()).
+An event records what was requested, how much was sent and received, and how long
+each phase took:
+
+connect    = opening a new connection (0 if a pooled one was reused)
+first_byte = from sending the request until the status and headers arrived
+download   = reading the body
+parse      = decoding the body (None where the handle doesn't decode it)
+total      = the whole request, including any retries and the parse
+
+LatencyStats is an observer that aggregates events into per-endpoint latency
+percentiles.
+"""
+
+import collections, math, threading
+
+class RequestEvent(object):
+    """
+    Describes one completed request. 'error' is the exception that ended it, if any,
+    in which case some of the other fields may be None.
+    """
+
+    FIELDS = ('service', 'endpoint', 'method', 'status', 'attempts', 'bytes_sent', 'bytes_received',
+        'connect', 'first_byte', 'download', 'parse', 'total', 'error')
+
+    def __init__(self, **kwargs):
+        for field in RequestEvent.FIELDS:
+            setattr(self, field, kwargs.get(field))
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in RequestEvent.FIELDS)
+
+    def __repr__(self):
+        return "<RequestEvent %s %s %s: %s in %.3fs>" % (self.service, self.method, self.endpoint,
+            self.status if self.error is None else repr(self.error), self.total or 0)
+
+class LatencyStats(object):
+    """
+    An observer that keeps the total latencies of the most recent max_samples requests
+    to each (service, endpoint) and reports their percentiles. Add it to any number of
+    handles with add_observer().
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+
+        self._samples = {}
+        self._counts = collections.defaultdict(int)
+        self._errors = collections.defaultdict(int)
+        self._bytes = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (event.service, event.endpoint)
+
+        with self._lock:
+            if key not in self._samples:
+                self._samples[key] = collections.deque(maxlen=self.max_samples)
+
+            self._counts[key] += 1
+            self._bytes[key] += event.bytes_received or 0
+            if event.error is not None:
+                self._errors[key] += 1
+            if event.total is not None:
+                self._samples[key].append(event.total)
+
+    def summary(self):
+        """
+        Returns a dict mapping each (service, endpoint) to a dict of its request 'count',
+        'errors', 'bytes_received', and the 'p50', 'p95' and 'p99' latencies in seconds.
+        """
+        with self._lock:
+            samples = dict((key, sorted(values)) for key, values in self._samples.items())
+            counts, errors, received = dict(self._counts), dict(self._errors), dict(self._bytes)
+
+        return dict((key, {
+            'count': counts[key],
+            'errors': errors.get(key, 0),
+            'bytes_received': received[key],
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+        }) for key, values in samples.items())
+
+    def report(self):
+        """
+        Returns the summary formatted as a table, slowest endpoints (by p95) first.
+        """
+        lines = ["%-40s %8s %6s %9s %9s %9s" % ('endpoint', 'count', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)')]
+
+        rows = sorted(self.summary().items(), key=lambda item: item[1]['p95'], reverse=True)
+        for (service, endpoint), stats in rows:
+            lines.append("%-40s %8d %6d %9.1f %9.1f %9.1f" % ("%s %s" % (service, endpoint),
+                stats['count'], stats['errors'], stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
+
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+            self._errors.clear()
+            self._bytes.clear()
+
+def percentile(sorted_values, pct):
+    """
+    Returns the pct-th percentile of an already sorted list (nearest-rank), or 0 if it's empty.
+    """
+    if not sorted_values:
+        return 0.0
+
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
@@ -0,0 +1,232 @@
+"""
+Columnar decoding of Ohmage mobility data into NumPy arrays.
+
+mobility/read produces one dict per data point, with the location and sensor
+readings nested inside it. For analysis it's far cheaper to hold the same data
+as one array per field, so decode_columns() fills compact typed buffers straight
+from the points (ideally as they stream off the socket) and wraps them in a
+MobilityColumns instance. Text fields with few distinct values (mode, timezone)
+are stored as small integer codes into a list of categories.
+
+NumPy is an optional dependency; it's only needed when decoding to columns.
+
+This module also provides MobilityDayCache, which stores complete days of
+mobility data on disk so that they never have to be downloaded twice.
+"""
+
+import gzip, hashlib, os, simplejson, tempfile
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the modes the Ohmage mobility classifier produces, in the order of their codes
+MODES = ('still', 'walk', 'run', 'bike', 'drive', 'error')
+
+# the server abbreviates point keys unless asked for long names, so accept either
+_KEYS = {
+    'time': ('t', 'time'),
+    'timezone': ('tz', 'timezone'),
+    'mode': ('m', 'mode'),
+    'location': ('l', 'location'),
+    'latitude': ('la', 'latitude'),
+    'longitude': ('lo', 'longitude'),
+    'accuracy': ('ac', 'accuracy'),
+    'sensor_data': ('sd', 'sensor_data'),
+    'speed': ('sp', 'speed'),
+}
+
+NAN = float('nan')
+
+def _get(d, field, default=None):
+    for key in _KEYS[field]:
+        if key in d:
+            return d[key]
+    return default
+
+class _Categories(object):
+    # assigns consecutive integer codes to the distinct values of a text field
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = dict((v, i) for i, v in enumerate(self.values))
+
+    def code(self, value):
+        if value is None:
+            return -1
+        try:
+            return self.codes[value]
+        except KeyError:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+            return self.codes[value]
+
+class MobilityColumns(object):
+    """
+    Mobility data points held as one NumPy array per field:
+
+    time       int64, milliseconds since the epoch
+    latitude   float64, NaN where the point has no location
+    longitude  float64, NaN where the point has no location
+    accuracy   float64, NaN where the point has no location
+    speed      float64, NaN where the point carries no sensor data
+    mode_codes int8, indexes into modes (-1 if absent)
+    timezone_codes int16, indexes into timezones (-1 if absent)
+    """
+
+    def __init__(self, time, latitude, longitude, accuracy, speed, mode_codes, modes, timezone_codes, timezones):
+        self.time = time
+        self.latitude = latitude
+        self.longitude = longitude
+        self.accuracy = accuracy
+        self.speed = speed
+        self.mode_codes = mode_codes
+        self.modes = list(modes)
+        self.timezone_codes = timezone_codes
+        self.timezones = list(timezones)
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def mode(self):
+        """
+        The mode of each point as an array of strings (None where absent).
+        """
+        return _expand(self.mode_codes, self.modes)
+
+    @property
+    def timezone(self):
+        """
+        The timezone of each point as an array of strings (None where absent).
+        """
+        return _expand(self.timezone_codes, self.timezones)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Joins several MobilityColumns (e.g. one per day) into one. The numeric columns
+        are concatenated directly; codes are remapped onto the union of the categories.
+        """
+        _require_numpy()
+        parts = list(parts)
+
+        modes, timezones = _Categories(MODES), _Categories()
+        mode_codes = [_recode(p.mode_codes, p.modes, modes, numpy.int8) for p in parts]
+        timezone_codes = [_recode(p.timezone_codes, p.timezones, timezones, numpy.int16) for p in parts]
+
+        def join(name, dtype):
+            return numpy.concatenate([getattr(p, name) for p in parts]) if parts else numpy.empty(0, dtype)
+
+        return cls(
+            join('time', numpy.int64),
+            join('latitude', numpy.float64),
+            join('longitude', numpy.float64),
+            join('accuracy', numpy.float64),
+            join('speed', numpy.float64),
+            numpy.concatenate(mode_codes) if parts else numpy.empty(0, numpy.int8), modes.values,
+            numpy.concatenate(timezone_codes) if parts else numpy.empty(0, numpy.int16), timezones.values)
+
+def decode_columns(points):
+    """
+    Decodes an iterable of mobility data points (as returned in the 'data' of
+    mobility_read(), or generated by mobility_read(stream=True)) into MobilityColumns.
+    Points without a timestamp are left out, since there's no int64 value to give them.
+    """
+    _require_numpy()
+
+    # typed buffers hold the values unboxed while we don't yet know how many there are
+    time, latitude, longitude, accuracy, speed = array('d'), array('d'), array('d'), array('d'), array('d')
+    mode_codes, timezone_codes = array('b'), array('h')
+    modes, timezones = _Categories(MODES), _Categories()
+
+    for point in points:
+        timestamp = _get(point, 'time')
+        if timestamp is None:
+            continue
+
+        time.append(timestamp)
+        mode_codes.append(modes.code(_get(point, 'mode')))
+        timezone_codes.append(timezones.code(_get(point, 'timezone')))
+
+        location = _get(point, 'location') or {}
+        latitude.append(_float(_get(location, 'latitude')))
+        longitude.append(_float(_get(location, 'longitude')))
+        accuracy.append(_float(_get(location, 'accuracy')))
+
+        sensor_data = _get(point, 'sensor_data') or {}
+        speed.append(_float(_get(sensor_data, 'speed')))
+
+    return MobilityColumns(
+        numpy.frombuffer(time, numpy.float64).astype(numpy.int64),
+        numpy.frombuffer(latitude, numpy.float64),
+        numpy.frombuffer(longitude, numpy.float64),
+        numpy.frombuffer(accuracy, numpy.float64),
+        numpy.frombuffer(speed, numpy.float64),
+        numpy.frombuffer(mode_codes, numpy.int8), modes.values,
+        numpy.frombuffer(timezone_codes, numpy.int16), timezones.values)
+
+def _float(value):
+    # absent and null readings alike become NaN
+    return NAN if value is None else value
+
+def _expand(codes, categories):
+    # maps codes back to their values, with -1 (absent) mapping to None
+    lookup = numpy.array(list(categories) + [None], dtype=object)
+    return lookup[codes]
+
+def _recode(codes, categories, merged, dtype):
+    # translates codes into the merged categories; the extra last entry maps -1 to itself
+    lookup = numpy.array([merged.code(v) for v in categories] + [-1], dtype=dtype)
+    return lookup[codes]
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("NumPy is required to decode mobility data into columns")
+
+class MobilityDayCache(object):
+    """
+    An on-disk store of whole days of mobility data points, used by
+    OhmageApi.mobility_read_range(). Once a day is over its data doesn't change, so
+    entries never expire. Each day is stored as gzipped JSON in a file named by the
+    SHA-1 of (server, username, date, with_sensor_data), under 'directory'.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, server, username, date, with_sensor_data):
+        """
+        Returns the list of points stored for the given day, or None if there are none.
+        """
+        try:
+            with gzip.open(self._path(server, username, date, with_sensor_data), 'rb') as f:
+                return simplejson.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, server, username, date, with_sensor_data, points):
+        path = self._path(server, username, date, with_sensor_data)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # another thread may have just created it
+                pass
+
+        # write to a temporary file first so that readers never see a partial day
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                    simplejson.dump(points, f)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def _path(self, server, username, date, with_sensor_data):
+        digest = hashlib.sha1(simplejson.dumps([server, username, date, bool(with_sensor_data)])).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.json.gz')
@@ -1,8 +1,9 @@
 import urlparse
 from base import BaseApi
+from concurrency import WorkerPool, wait_all
 
 import oauth2
-import urllib, cgi
+import urllib
 
 class OAuthApi(BaseApi):
     """
@@ -29,10 +30,29 @@ class OAuthApi(BaseApi):
        in step 2. depending on the provider, you either include this data in the
        GET/POST, or in the headers. deriving classes should make this choice
        for you.
+       
+    Requests for many accounts share the handle's connection pool, and
+    fetch_many() polls many accounts at once.
+    
+    Given a rate_limiter (a RateLimiter, per app key and per user token), a handle
+    paces its requests to stay within the provider's quotas; handles that share an
+    app key should share one. Derived classes set rate_limits to the keyword arguments
+    for the quotas the provider publishes, if any, e.g. RateLimiter(**FitBitApi.rate_limits).
+    A request waits up to rate_limit_wait seconds for its turn, and otherwise raises
+    RateLimitException, as does a response saying that a quota has run out for longer,
+    or for the rate_limit_retries-th time in a row.
     """
+    
+    # the method fetch_many() calls by default; set by derived classes
+    fetch_method = None
+    
+    # e.g. {'app_limit': (requests, seconds), 'user_limit': (requests, seconds)}; set by derived classes
+    rate_limits = None
+    rate_limit_wait = 60.0
+    rate_limit_retries = 3
 
-    def __init__(self, server, api_key, api_secret, request_token_url, access_token_url, authenticate_url, app_prefix=''):
-        super(OAuthApi, self).__init__(server, app_prefix)
+    def __init__(self, server, api_key, api_secret, request_token_url, access_token_url, authenticate_url, app_prefix='', pool=None, rate_limiter=None):
+        super(OAuthApi, self).__init__(server, app_prefix, pool)
 
         self.api_key = api_key
         self.api_secret = api_secret
@@ -40,16 +60,17 @@ class OAuthApi(BaseApi):
         # configure the consumer, which basically holds up the credentials for the client to communicate with a service
         self.consumer = oauth2.Consumer(api_key, api_secret)
 
-        # configure the client, which uses the consumer's creds to fire off individual requests
-        self.client = oauth2.Client(self.consumer)
-        # self.client.set_signature_method(oauth2.SignatureMethod_HMAC_SHA1())
-        self.client.set_signature_method(oauth2.SignatureMethod_PLAINTEXT())
+        # the method used to sign each request, which is then sent over the handle's connection pool
+        # self.signature_method = oauth2.SignatureMethod_HMAC_SHA1()
+        self.signature_method = oauth2.SignatureMethod_PLAINTEXT()
 
         # set up paths for asking for various oauth resources
         self.request_token_url = request_token_url # where we ask for our negotiation-phase temp token
         self.authenticate_url = authenticate_url # where the end-user is redirected to ok the process
         self.access_token_url = access_token_url # where we exchange the negotiation-phase token for a permanent one
 
+        self.rate_limiter = rate_limiter
+
     # ========================================================
     # === OAuth Handshake
     # ========================================================
@@ -74,10 +95,10 @@ class OAuthApi(BaseApi):
         extra_params = urllib.urlencode(extra_params_dict) if len(extra_params_dict) > 0 else None
 
         # get temporary token
-        resp, content = self.client.request(self.server + self.request_token_url, "POST", body=extra_params)
-        if resp['status'] != '200':
-            print "*** Error %s: %s" % (resp['status'], content)
-            raise OAuthApi.OAuthException("Received a non-200 response (%s) in get_auth_url()" % (resp['status']), content)
+        status, content = self._perform_oauth_request(self.server + self.request_token_url, method="POST", body=extra_params)
+        if status != 200:
+            print "*** Error %s: %s" % (status, content)
+            raise OAuthApi.OAuthException("Received a non-200 response (%s) in get_auth_url()" % (status), content)
 
         rq_token = dict(urlparse.parse_qsl(content))
 
@@ -96,25 +117,121 @@ class OAuthApi(BaseApi):
         of the callback hit that prompted this method to be called.
         """
 
-        # use the request token in the session to build a new client.
+        # use the request token in the session to sign the exchange.
         token = oauth2.Token(rq_token['oauth_token'], rq_token['oauth_token_secret'])
         token.set_verifier(verifier)
-        client = oauth2.Client(self.consumer, token)
-        client.set_signature_method(oauth2.SignatureMethod_PLAINTEXT())
 
         # add the appendix params if they're present to the list of body arguments
         extra_params = urllib.urlencode(appendix_params) if appendix_params else None
         
         # request the authorized access token
-        resp, content = client.request(self.server + self.access_token_url, "POST", body=extra_params)
-        if resp['status'] != '200':
+        status, content = self._perform_oauth_request(self.server + self.access_token_url, token, method="POST", body=extra_params)
+        if status != 200:
             print content
-            raise OAuthApi.OAuthException("Received a non-200 response (%s) in process_auth_response()" % (resp['status']), content)
+            raise OAuthApi.OAuthException("Received a non-200 response (%s) in process_auth_response()" % (status), content)
 
         access_token = dict(urlparse.parse_qsl(content))
         
         return access_token
 
+    # ========================================================
+    # === Polling Many Accounts
+    # ========================================================
+
+    def fetch_many(self, tokens, method=None, workers=8, return_exceptions=True, **kwargs):
+        """
+        Calls method(token, **kwargs) (by default, the class's fetch_method, e.g. its
+        step count request) for each of the given access tokens, up to 'workers' at once,
+        and returns the results in the same order.
+        
+        If return_exceptions is true, a call that fails contributes its exception to the
+        results instead of aborting the rest. To keep a connection open per worker between
+        calls, give the handle a ConnectionPool with a pool_size of at least 'workers'.
+        """
+        fn = getattr(self, method or self.fetch_method)
+        pool = WorkerPool(workers)
+        
+        try:
+            return wait_all([pool.submit(fn, token, **kwargs) for token in tokens], return_exceptions=return_exceptions)
+        finally:
+            pool.shutdown()
+
+    # ========================================================
+    # === Signed Requests
+    # ========================================================
+
+    def _perform_oauth_request(self, url, token=None, method="GET", body=None, headers=None, force_auth_headers=False):
+        """
+        Signs a request with the consumer's credentials (and the given oauth2.Token, if any)
+        and sends it over the handle's connection pool. Returns a tuple (status, content).
+        
+        With a rate limiter, the request first waits for the app's and the token's quotas
+        to allow it. A response saying a quota has run out is retried (up to rate_limit_retries
+        times) once the quota resets, if that's within rate_limit_wait seconds; otherwise
+        RateLimitException is raised.
+
+        As with oauth2.Client, the oauth parameters are placed in a form-encoded body,
+        in the query string of a GET, or in the Authorization header otherwise. Passing
+        force_auth_headers=True always places them in the header.
+        """
+        headers = dict(headers or {})
+        if method == "POST":
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        # form-encoded bodies are part of the signature base string
+        is_form_encoded = headers.get('Content-Type') == 'application/x-www-form-urlencoded'
+        parameters = dict(urlparse.parse_qsl(body)) if is_form_encoded and body else None
+
+        def sign(url, body, headers):
+            # called for every attempt, retry and hedged copy alike, since the server turns
+            # away a nonce it has already seen
+            req = oauth2.Request.from_consumer_and_token(self.consumer, token=token,
+                http_method=method, http_url=url, parameters=parameters, body=body or '', is_form_encoded=is_form_encoded)
+            req.sign_request(self.signature_method, self.consumer, token)
+
+            headers = dict(headers)
+            if force_auth_headers:
+                headers.update(req.to_header())
+            elif is_form_encoded:
+                body = req.to_postdata()
+            elif method == "GET":
+                url = req.to_url()
+            else:
+                headers.update(req.to_header())
+            return url, body, headers
+
+        if self.rate_limiter is None:
+            return self._send_oauth_request(url, method, body, headers, sign)
+
+        user = token.key if token is not None else None
+
+        for attempt in range(self.rate_limit_retries + 1):
+            wait = self.rate_limiter.acquire(user, self.rate_limit_wait)
+            if wait:
+                raise OAuthApi.RateLimitException("Rate limit reached; the next request is allowed in %.1f seconds" % wait, retry_after=wait)
+
+            status, content, getheader = self._send_oauth_request(url, method, body, headers, sign, with_headers=True)
+
+            limited = self.rate_limiter.observe(user, status, getheader)
+            if limited is None:
+                return status, content
+
+            scope, retry_after = limited
+            if retry_after > self.rate_limit_wait:
+                raise OAuthApi.RateLimitException("The %s's rate limit is exhausted for %.1f seconds" % (scope, retry_after),
+                    content, scope=scope, retry_after=retry_after)
+            if attempt == self.rate_limit_retries:
+                raise OAuthApi.RateLimitException("The %s's rate limit was still exhausted after %d retries" % (scope, attempt),
+                    content, scope=scope, retry_after=retry_after)
+
+    def _send_oauth_request(self, url, method, body, headers, sign, with_headers=False):
+        resp = self._send(url, method, body, headers, idempotent=(method == "GET"), sign=sign)
+        content = resp.read()
+        self._emit_response(resp)
+        if with_headers:
+            return resp.status, content, resp.getheader
+        return resp.status, content
+
     # ========================================================
     # === Exceptions
     # ========================================================
@@ -129,4 +246,16 @@ class OAuthApi(BaseApi):
             return "%s" % (self.message)
             
         def __unicode__(self):
-            return u"%s" % (self.message)
\ No newline at end of file
+            return u"%s" % (self.message)
+
+    class RateLimitException(OAuthException):
+        """
+        Raised when a quota doesn't allow a request. 'scope' is RateLimiter.APP or
+        RateLimiter.USER if the server reported it, and retry_after is the number of
+        seconds until a request should be allowed again.
+        """
+
+        def __init__(self, message, body=None, scope=None, retry_after=None):
+            super(OAuthApi.RateLimitException, self).__init__(message, body)
+            self.scope = scope
+            self.retry_after = retry_after
@@ -10,11 +10,22 @@ supporting classes in this module.
 # you should connect to a server >= this version for best results
 __api_version__ = "2.10"
 
-import simplejson, uuid
-from datetime import datetime
+import collections, hashlib, itertools, mimetypes, os, re, simplejson, sys, tempfile, time
+from uuid import uuid4
+from cStringIO import StringIO
+from simplejson.encoder import encode_basestring_ascii
+from datetime import date as Date, timedelta
 
 # and finally the base API
 from base import BaseApi
+from credentials import CredentialManager
+from streaming import iter_members
+import formats
+from mobility import decode_columns, MobilityDayCache
+from concurrency import Future, SingleFlight, WorkerPool, spawn, wait_all
+from transport import ConnectionPool
+from checkpoint import Checkpoint
+from poster.encode import MultipartParam
 
 class OhmageApi(BaseApi):
     """
@@ -22,9 +33,49 @@ class OhmageApi(BaseApi):
     can be made against the server and returns appropriate values for results.
     """
     
-    def __init__(self, server, app_prefix='/app', client='ohmage-python-api'):
-        super(OhmageApi, self).__init__(server, app_prefix)
+    # the cached endpoints whose results may change after a successful request to each write endpoint
+    cache_invalidations = {
+        '/survey/upload': ('/campaign/read',),
+    }
+    
+    # the series of error codes (06xx, surveys; 08xx, images) with which survey/upload turns down
+    # a batch because of one of the surveys or attachments in it, rather than the request as a
+    # whole (e.g. 0200 for bad credentials, or 07xx for a campaign that's unknown or closed)
+    survey_error_series = (6, 8)
+    
+    # the errors with which Ohmage answers a request whose parameters it couldn't read at all
+    # (0101, a request it couldn't make sense of; 0102, a required parameter that's missing), as
+    # it does a compressed body it can't decode. errors about the credentials or the campaign
+    # show the body was read, so a request turned down with one of them is never sent again
+    compression_refusal_codes = frozenset([101, 102])
+    
+    # the read endpoints whose identical concurrent requests share one request to the server
+    coalesced_endpoints = frozenset([
+        '/config/read', '/campaign/read', '/class/read', '/mobility/dates/read', '/mobility/read', '/survey_response/read',
+    ])
+    
+    def __init__(self, server, app_prefix='/app', client='ohmage-python-api', pool=None, cache=None, coalesce=None):
+        """
+        If a cache (e.g. an LRUCache or DiskCache from ohmagekit.clients.cache) is given,
+        the results of config_read() and campaign_read() are stored in it and reused until
+        they expire. Results returned from the cache are shared, so don't modify them.
+        Entries are keyed by user and password, or by the user a token was issued to, so
+        they outlive the handle's tokens but are only returned to the same credentials.
+        
+        Calls made from several threads at once to the same read endpoint, with the same
+        parameters and credentials, are sent to the server once and all get its result,
+        which is likewise shared. 'coalesce' is the set of endpoint uris this applies to
+        (by default, coalesced_endpoints); pass an empty set to send every call separately.
+        Uploads are never coalesced. Handles can pool their calls by sharing 'in_flight'.
+        
+        'server' may be a list of replicas, in which case reads go to whichever is fastest
+        and healthy and uploads go to the first; see BaseApi and ohmagekit.clients.routing.
+        """
+        super(OhmageApi, self).__init__(server, app_prefix, pool)
         self.client = client
+        self.cache = cache
+        self.coalesced_endpoints = frozenset(coalesce) if coalesce is not None else self.coalesced_endpoints
+        self.in_flight = SingleFlight()
     
     # ========================================================
     # === User Authentication
@@ -44,24 +95,41 @@ class OhmageApi(BaseApi):
             'client': self.client
         })
         
-    def login(self, username, password, doHashedLogin=True, doTokenLogin=True):
+    def login(self, username, password, doHashedLogin=True, doTokenLogin=True, lazy=False):
         """
         Performs a login and stores the resulting credentials in the handle
         (specifically, in self.auth_token and self.auth_hashedpass). All other
         methods in the API will preferentially use explicit credentials, but can
         fall back on these saved ones if the explicit credentials aren't given.
         
-        If authentication fails, this method raises an OhmageApiException with code 0200.
+        If authentication fails, this method raises an OhmageApiException with code 0200,
+        and the handle is left without any stored credentials.
+        
+        If lazy is true, nothing is requested up front; instead, each kind of credential
+        is fetched the first time a request needs it (and any authentication failure is
+        raised from that request). Either way, when a stored token expires it's replaced
+        automatically and the rejected request is retried once; see CredentialManager.
         """
         
-        if doHashedLogin:
-            result = self.user_auth(username, password)
-            self.auth_username = username
-            self.auth_hashedpass = result['hashed_password']
-            
-        if doTokenLogin:
-            result = self.user_auth_token(username, password)
-            self.auth_token = result['token']
+        # the previous login's credentials shouldn't outlive this one, whether or not it succeeds
+        self._forget_login()
+        credentials = CredentialManager(self, username, password,
+            use_token=doTokenLogin, use_hashedpass=doHashedLogin)
+        
+        if not lazy:
+            try:
+                if doHashedLogin:
+                    credentials.hashed_password()
+                if doTokenLogin:
+                    credentials.token()
+            except:
+                # keep nothing from a failed login, so that later calls don't resend a bad
+                # password (which may get the account locked)
+                self._forget_login()
+                raise
+        
+        self.auth_username = username
+        self.credentials = credentials
             
     def is_authenticated(self, forToken=False):
         """
@@ -71,21 +139,45 @@ class OhmageApi(BaseApi):
         For reference, token-based authentication times out after a while, whereas
         hashed passwords remain valid indefinitely.
         """
+        credentials = getattr(self, 'credentials', None)
+        if credentials is not None and (credentials.use_token if forToken else credentials.use_hashedpass):
+            return True
+        
         return hasattr(self, 'auth_username') and (
                 (forToken and hasattr(self, 'auth_token')) or
                 (not forToken and hasattr(self, 'auth_hashedpass'))
             )
         
+    def _forget_login(self):
+        # drops the credentials stored by login(), including those its CredentialManager stored
+        for name in ('auth_username', 'credentials', 'auth_token', 'auth_hashedpass'):
+            self.__dict__.pop(name, None)
+        
     def _add_login_to_params(self, params, useToken):
         # helper method that appends cached credentials to the request
-        # if we have them and they're not already present
-        if useToken and hasattr(self, 'auth_token'):
+        # if we have them and they're not already present. credentials
+        # deferred by login(lazy=True) are fetched here on first use.
+        credentials = getattr(self, 'credentials', None)
+        
+        if useToken and (hasattr(self, 'auth_token') or (credentials is not None and credentials.use_token)):
             if 'auth_token' not in params or not params['auth_token']:
-                params['auth_token'] = self.auth_token
-        elif hasattr(self, 'auth_username') and hasattr(self, 'auth_hashedpass'):
+                params['auth_token'] = credentials.token() if credentials is not None and credentials.use_token else self.auth_token
+        elif hasattr(self, 'auth_username') and (hasattr(self, 'auth_hashedpass') or (credentials is not None and credentials.use_hashedpass)):
             if ('user' not in params or not params['user']) and ('password' not in params or not params['password']):
                 params['user'] = self.auth_username
-                params['password'] = self.auth_hashedpass
+                params['password'] = credentials.hashed_password() if credentials is not None and credentials.use_hashedpass else self.auth_hashedpass
+                
+    def _refresh_token_in(self, params, ex):
+        # if ex is an authentication failure for a token that our CredentialManager handed out,
+        # swaps a fresh token into params and returns true to signal that the request can be retried
+        credentials = getattr(self, 'credentials', None)
+        stale = params.get('auth_token')
+        
+        if credentials is None or not credentials.issued(stale) or 200 not in ex.codes():
+            return False
+        
+        params['auth_token'] = credentials.refresh_token(stale)
+        return True
         
     # ========================================================
     # === Server Configuration
@@ -97,7 +189,7 @@ class OhmageApi(BaseApi):
         """
         params={}
         params.update(kwargs)
-        return self._perform_request('/config/read', method="GET", params=params)
+        return self._cached_request('/config/read', method="GET", params=params)
             
     # ========================================================
     # === Campaign Manipulation
@@ -131,27 +223,160 @@ class OhmageApi(BaseApi):
         # and supplement with the stored credentials, if present
         self._add_login_to_params(params, useToken=True)
         
-        return self._perform_request('/campaign/read', method="POST", params=params)
+        return self._cached_request('/campaign/read', method="POST", params=params)
+        
+    # ========================================================
+    # === Class Manipulation
+    # ========================================================
+    
+    def class_read(self, class_urn_list, auth_token=None, **kwargs):
+        """
+        Returns information about the given classes, including their members.
+        
+        (r) auth_token = A valid authentication token.
+        (r) client = A short description of the client making the request.
+        (r) class_urn_list = urn:class:class1,urn:class:class2
+        (o) with_user_list = true || false, whether to include each class's users and their roles (default true)
+        """
+        
+        # take the required arguments
+        params = {
+            'auth_token': auth_token,
+            'class_urn_list': class_urn_list,
+            'client': self.client
+        }
+        # and allow any other optional parameters they may wish to pass
+        params.update(kwargs)
+        
+        # and supplement with the stored credentials, if present
+        self._add_login_to_params(params, useToken=True)
+        
+        return self._perform_request('/class/read', method="POST", params=params)
         
     # ========================================================
     # === Survey Manipulation
     # ========================================================
     
-    def survey_upload(self, user=None, hashedpass=None, campaign_urn=None, campaign_creation_timestamp=None, surveys=None):
+    def survey_upload(self, user=None, hashedpass=None, campaign_urn=None, campaign_creation_timestamp=None, surveys=None, attachments=None):
+        """
+        Uploads the given surveys. If their responses include images (or other media), the
+        value of each such response is a uuid, and 'attachments' maps those uuids to the files
+        holding the media, as paths or open files. The files are streamed from disk as the
+        request is sent, rather than read into memory.
+        """
+        # without surveys, send 'null' as ever and let the server say what's wrong with it
+        surveys_json = encode_surveys(surveys) if surveys is not None else 'null'
+        return self._survey_upload_encoded(user, hashedpass, campaign_urn, campaign_creation_timestamp, surveys_json, attachments)
         
+    def _survey_upload_encoded(self, user, hashedpass, campaign_urn, campaign_creation_timestamp, surveys_json, attachments=None):
+        # performs a survey upload whose surveys have already been encoded as a JSON array
         params = {
             'user': user,
             'password': hashedpass,
             'client': self.client,
             'campaign_urn': campaign_urn,
             'campaign_creation_timestamp': campaign_creation_timestamp,
-            'surveys': simplejson.dumps(surveys)
+            'surveys': surveys_json
         }
         
         # and supplement with the stored credentials, if present
         self._add_login_to_params(params, useToken=False)
         
-        return self._perform_request('/survey/upload', method="POST", params=params, request_type='multipart')
+        # each attachment is a part of its own, named by its uuid
+        attachments = attachments or {}
+        files = dict((uuid, _attachment_param(uuid, source)) for uuid, source in attachments.items())
+        params.update(files)
+        
+        try:
+            return self._perform_request('/survey/upload', method="POST", params=params, request_type='multipart')
+        finally:
+            # close the files opened here; those passed in open belong to the caller
+            for uuid, param in files.items():
+                if isinstance(attachments[uuid], basestring):
+                    param.fileobj.close()
+        
+    def bulk_survey_upload(self, campaign_urn, surveys, campaign_creation_timestamp=None, user=None, hashedpass=None, max_bytes=512*1024, workers=4,
+        attachments=None, checkpoint=None):
+        """
+        Uploads a large number of surveys by splitting them into batches of at most
+        max_bytes of encoded JSON (a survey that's larger on its own is sent alone)
+        and uploading up to 'workers' batches at once.
+        
+        'attachments' maps the uuids of media responses to their files, as in survey_upload().
+        Each survey is sent in the same batch as the attachments its responses refer to, and
+        their sizes count toward max_bytes, so a batch holds at most a few photos.
+        
+        If a checkpoint (a Checkpoint from ohmagekit.clients.checkpoint, or the path of a
+        file for one) is given, each survey is recorded in it once it and its attachments
+        have been uploaded, and surveys recorded there by an earlier call that was
+        interrupted are skipped (and reported as uploaded).
+        
+        The server accepts or rejects each batch as a whole, so when a batch is rejected
+        because of its surveys (see survey_error_series) it's split in half and each half is
+        retried, until the offending surveys have been isolated. Batches that fail for other
+        reasons (e.g. a lost connection) are not retried. An error that concerns the request
+        as a whole, like bad credentials or a closed campaign, would fail every batch alike,
+        so it's raised right away, and the batches not yet sent are skipped.
+        
+        Returns a list of SurveyUploadResult, one per survey in the order given, whose
+        'error' is the exception that caused the survey to fail, or None if it was uploaded.
+        """
+        attachments = attachments or {}
+        encoded = [encode_survey(survey) for survey in surveys]
+        keys = [survey.get('survey_key') if isinstance(survey, dict) else getattr(survey, 'survey_key', None) for survey in surveys]
+        media = [[value for value in _response_values(survey) if isinstance(value, basestring) and value in attachments] for survey in surveys]
+        sizes = [len(encoded[i]) + sum(_file_size(attachments[uuid]) for uuid in media[i]) for i in range(len(encoded))]
+        errors = [None] * len(encoded)
+        
+        opened = isinstance(checkpoint, basestring)
+        if opened:
+            checkpoint = Checkpoint(checkpoint)
+        
+        pending = range(len(encoded))
+        if checkpoint is not None:
+            pending = [i for i in pending if keys[i] is None or (campaign_urn, keys[i]) not in checkpoint]
+        
+        # set once the server turns down the upload as a whole, after which sending the rest is pointless
+        refused = []
+        
+        def upload(indices):
+            if refused:
+                return
+            
+            surveys_json = '[' + ','.join(encoded[i] for i in indices) + ']'
+            files = dict((uuid, attachments[uuid]) for i in indices for uuid in media[i])
+            try:
+                self._survey_upload_encoded(user, hashedpass, campaign_urn, campaign_creation_timestamp, surveys_json, files)
+                if checkpoint is not None:
+                    for i in indices:
+                        if keys[i] is not None:
+                            checkpoint.add((campaign_urn, keys[i]))
+            except (OhmageApi.OhmageApiException, BaseApi.HTTPException), ex:
+                if isinstance(ex, OhmageApi.OhmageApiException) and not self._survey_errors(ex):
+                    refused.append(ex)
+                    raise
+                
+                # the batch was refused (or was too large for the server); narrow it down
+                if len(indices) > 1 and (isinstance(ex, OhmageApi.OhmageApiException) or ex.code == '413'):
+                    middle = len(indices) // 2
+                    upload(indices[:middle])
+                    upload(indices[middle:])
+                else:
+                    for i in indices:
+                        errors[i] = ex
+            except Exception, ex:
+                for i in indices:
+                    errors[i] = ex
+        
+        pool = WorkerPool(workers)
+        try:
+            wait_all(pool.map(upload, _size_batches(pending, sizes, max_bytes)))
+        finally:
+            pool.shutdown()
+            if opened:
+                checkpoint.close()
+        
+        return [SurveyUploadResult(i, keys[i], errors[i]) for i in range(len(encoded))]
         
     def survey_response_read(self,
         auth_token=None,
@@ -159,6 +384,8 @@ class OhmageApi(BaseApi):
         output_format="json-rows",
         column_list="urn:ohmage:special:all",
         user_list="urn:ohmage:special:all",
+        stream=False,
+        sink=None,
         **kwargs):
         """
         Allows reading of survey responses with a variety of output formats and many
@@ -191,6 +418,15 @@ class OhmageApi(BaseApi):
         (o) num_to_skip = The number of survey responses to skip in reverse chronological order in which they were taken.
         (o) num_to_process = The number of survey responses to process after the skipping those to be skipped via 'num_survey_responses_to_skip'.
         (o) survey_response_id_list = A comma-separated list of survey response IDs. The results will only be of survey responses whose ID is in this list.
+        
+        If stream is true, returns an iterator over the items of the response's 'data'
+        instead, which are decoded as they arrive; see _stream_request(). This keeps memory
+        flat for large reads. It applies to the json-rows and json-columns formats, and to
+        csv, whose rows are generated as dicts keyed by column.
+        
+        If sink is given (a path, or a file-like object with a write() method), the body is
+        written to it as it arrives, without being parsed, and a dict describing the download
+        is returned instead; see _download().
         """
         
         # take the required arguments
@@ -207,13 +443,58 @@ class OhmageApi(BaseApi):
         # and supplement with the stored credentials, if present
         self._add_login_to_params(params, useToken=True)
         
+        if sink is not None:
+            return self._download('/survey_response/read', params, sink, method="POST")
+        
+        if stream:
+            return self._stream_request('/survey_response/read', method="POST", params=params)
+        
         return self._perform_request('/survey_response/read', method="POST", params=params)
     
+    def iter_survey_responses(self, campaign_urn, page_size=500, prefetch=1, **kwargs):
+        """
+        Generates the survey responses of campaign_urn one at a time, reading them from
+        the server in pages of page_size responses (via num_to_skip/num_to_process).
+        
+        While the caller works through one page, the next prefetch pages are downloaded
+        in the background, so at most prefetch + 1 pages are held in memory at once.
+        Any other keyword arguments are passed along to survey_response_read(); the
+        output format is always json-rows.
+        
+        Note that the server pages in reverse chronological order, so responses uploaded
+        while the iteration is underway shift the pages and may cause duplicates.
+        """
+        kwargs.pop('output_format', None)
+        
+        def fetch(page):
+            return self.survey_response_read(campaign_urn=campaign_urn, output_format="json-rows",
+                num_to_skip=page * page_size, num_to_process=page_size, **kwargs)['data']
+        
+        pending = collections.deque(spawn(fetch, page) for page in range(prefetch + 1))
+        next_page = prefetch + 1
+        
+        while pending:
+            rows = pending.popleft().result()
+            
+            # a short page is the last one; any pages fetched past it are simply dropped
+            last = len(rows) < page_size
+            if last:
+                pending.clear()
+            
+            for row in rows:
+                yield row
+            
+            # the next page is only fetched once this one is done with, so at most prefetch + 1 are held
+            del rows
+            if not last:
+                pending.append(spawn(fetch, next_page))
+                next_page += 1
+    
     # ========================================================
     # === Mobility
     # ========================================================
     
-    def mobility_read(self, auth_token=None, date=None, **kwargs):
+    def mobility_read(self, auth_token=None, date=None, stream=False, as_columns=False, sink=None, **kwargs):
         """
         Returns a list of mobility data points conforming to the given parameters.
         
@@ -230,6 +511,16 @@ class OhmageApi(BaseApi):
         (r) date = An ISO8601-formatted date from which to retrieve mobility data points.
         (o) username = The username of the user whose data is desired. This is only applicable if the requesting user is an admin or if the server allows it (the "mobility_enabled" flag from config/read) and the requesting user is privileged in any class to which the desired user belongs.
         (o) with_sensor_data = true/false Indicates whether or not to return the sensor data with the regular data. The default is false.
+        
+        If stream is true, returns an iterator over the data points instead, which are
+        decoded as they arrive; see _stream_request().
+        
+        If as_columns is true, the points are streamed straight into a MobilityColumns
+        instance (see ohmagekit.clients.mobility), which holds one NumPy array per field
+        instead of a dict per point. Use MobilityColumns.concatenate() to join several days.
+        
+        If sink is given (a path or a writable file-like object), the raw JSON is written to
+        it instead; see _download().
         """
         
         # take the required arguments
@@ -244,6 +535,15 @@ class OhmageApi(BaseApi):
         # and supplement with the stored credentials, if present
         self._add_login_to_params(params, useToken=True)
         
+        if sink is not None:
+            return self._download('/mobility/read', params, sink, method="POST")
+        
+        if as_columns:
+            return decode_columns(self._stream_request('/mobility/read', method="POST", params=params))
+        
+        if stream:
+            return self._stream_request('/mobility/read', method="POST", params=params)
+        
         return self._perform_request('/mobility/read', method="POST", params=params)
 
     def mobility_dates_read(self, auth_token=None, start_date=None, end_date=None, username=None, **kwargs):
@@ -283,37 +583,343 @@ class OhmageApi(BaseApi):
 
         return self._perform_request('/mobility/dates/read', method="POST", params=params)
         
+    def mobility_read_range(self, username=None, start_date=None, end_date=None, with_sensor_data=False,
+        day_cache=None, min_age_days=1, workers=4, auth_token=None):
+        """
+        Reads all of a user's mobility data between start_date and end_date (inclusive,
+        as ISO8601 dates). The days that have data are found with mobility_dates_read(),
+        and then up to 'workers' of them are read with mobility_read() at once.
+        
+        If day_cache (a MobilityDayCache, or the path of a directory for one) is given,
+        days at least min_age_days old are stored in it once read, and are read from it
+        instead of the server from then on, since their data no longer changes.
+        
+        Returns an OrderedDict mapping each date that has data to its list of points,
+        in date order.
+        """
+        if isinstance(day_cache, basestring):
+            day_cache = MobilityDayCache(day_cache)
+        
+        # the cache is keyed by whose data it is, which defaults to the logged-in user
+        owner = username or getattr(self, 'auth_username', None)
+        sensor_flag = 'true' if with_sensor_data in (True, 'true') else 'false'
+        complete_before = (Date.today() - timedelta(days=min_age_days - 1)).isoformat()
+        
+        dates = sorted(self.mobility_dates_read(auth_token=auth_token, start_date=start_date,
+            end_date=end_date, username=username)['data'])
+        days = collections.OrderedDict((d, None) for d in dates)
+        
+        if day_cache is not None and owner is not None:
+            for d in dates:
+                if d < complete_before:
+                    days[d] = day_cache.get(self.server, owner, d, sensor_flag == 'true')
+        
+        def fetch(d):
+            kwargs = {'username': username} if username else {}
+            points = self.mobility_read(auth_token=auth_token, date=d, with_sensor_data=sensor_flag, **kwargs)['data']
+            if day_cache is not None and owner is not None and d < complete_before:
+                day_cache.put(self.server, owner, d, sensor_flag == 'true', points)
+            return points
+        
+        missing = [d for d, points in days.items() if points is None]
+        pool = WorkerPool(workers)
+        try:
+            for d, points in zip(missing, wait_all(pool.map(fetch, missing))):
+                days[d] = points
+        finally:
+            pool.shutdown()
+        
+        return days
+        
+    # ========================================================
+    # === Batches
+    # ========================================================
+    
+    def batch(self, max_concurrency=8):
+        """
+        Returns a Batch for making several independent calls at once, e.g.
+        
+            with api.batch() as batch:
+                campaigns = batch.campaign_read()
+                dates = batch.mobility_dates_read()
+                
+            print campaigns.result(), dates.result()
+            
+        Each call made on the batch returns a Future. When the 'with' block exits, the
+        calls run concurrently (up to max_concurrency at once) over the handle's pool,
+        and the block waits for all of them to complete; each future then holds its
+        call's result, or the OhmageApiException (or other error) it raised.
+        """
+        return Batch(self, max_concurrency)
+        
     # ========================================================
     # === support methods and classes
     # ========================================================
     
-    def _perform_request(self, *args, **kwargs):
+    def _open_request(self, *args, **kwargs):
         """
-        Overrides the base _perform_request() to get a chance to catch and reinterpet
+        Overrides the base _open_request() to get a chance to catch and reinterpet
         BaseApi.HTTPException in the case where the body contains more info about the error.
         """
         try:
-            return super(OhmageApi, self)._perform_request(*args, **kwargs)
+            return super(OhmageApi, self)._open_request(*args, **kwargs)
         except BaseApi.HTTPException, ex:
             # assume json and attempt to parse out result and errors keys
             # if it's not json or they're not present, re-raise the original exception
             try:
-                parsed = simplejson.loads(ex.body)
-                assert 'result' in parsed and 'errors' in parsed
-                raise OhmageApi.OhmageApiException(result['errors'])
-            except:
+                parsed = formats.loads(ex.body)
+            except ValueError:
+                raise ex
+            if not isinstance(parsed, dict) or 'result' not in parsed or 'errors' not in parsed:
                 raise ex
+            raise OhmageApi.OhmageApiException(parsed['errors'])
+            
+    def _perform_request(self, uri, params, method="GET", request_type="standard"):
+        """
+        Overrides the base _perform_request() to retry the request once with a new token
+        if the stored token it was sent with has expired, and to join an identical request
+        that's already underway if the endpoint is coalesced.
+        """
+        if request_type == "standard" and uri in self.coalesced_endpoints and uri not in self.cache_invalidations:
+            return self.in_flight.run(self._coalesce_key(uri, params, method), self._perform_single, uri, params, method, request_type)
+        
+        return self._perform_single(uri, params, method, request_type)
+    
+    def _perform_single(self, uri, params, method, request_type):
+        try:
+            result = super(OhmageApi, self)._perform_request(uri, params, method, request_type)
+        except OhmageApi.OhmageApiException, ex:
+            if not self._refresh_token_in(params, ex):
+                raise
+            result = super(OhmageApi, self)._perform_request(uri, params, method, request_type)
+        
+        for cached_uri in self.cache_invalidations.get(uri, ()):
+            self.invalidate_cache(cached_uri)
+        
+        return result
+        
+    def _survey_errors(self, ex):
+        # whether an OhmageApiException is about the surveys sent rather than the request as a whole
+        return any(code // 100 in self.survey_error_series for code in ex.codes())
         
-    def _handle_response(self, data):
+    def _refuses_compression(self, ex):
+        # Ohmage answers a request body it couldn't decode with a failure about the parameters
+        # it couldn't find, rather than a 400
+        if not isinstance(ex, OhmageApi.OhmageApiException):
+            return False
+        codes = ex.codes()
+        return bool(codes) and all(code in self.compression_refusal_codes for code in codes)
+        
+    def _cached_request(self, uri, params, method):
+        """
+        Performs a request through the response cache, if the handle has one.
+        """
+        if self.cache is None:
+            return self._perform_request(uri, method=method, params=params)
+        
+        key = self._cache_key(uri, params)
+        result = self.cache.get(key)
+        
+        if result is None:
+            result = self._perform_request(uri, method=method, params=params)
+            self.cache.set(key, result)
+        
+        return result
+        
+    def _cache_key(self, uri, params):
+        # the key identifies the user rather than including their token, which changes on every
+        # login; a password doesn't, so it's part of the key (as a digest), and a call with a
+        # wrong one can't be answered with the result of a call with the right one
+        params = dict(params)
+        token, user, password = params.pop('auth_token', None), params.pop('user', None), params.pop('password', None)
+        
+        if user:
+            identity = (user, hashlib.sha1(password or '').hexdigest())
+        elif token and hasattr(self, 'auth_username') and (token == getattr(self, 'auth_token', None) or
+                (hasattr(self, 'credentials') and self.credentials.issued(token))):
+            identity = self.auth_username
+        elif token:
+            identity = hashlib.sha1(token).hexdigest()
+        else:
+            identity = None
+        
+        return (uri, self.server, identity, tuple(sorted((k, v) for k, v in params.items() if v is not None)))
+        
+    def _coalesce_key(self, uri, params, method):
+        # unlike the cache key, this tells apart different credentials for the same user,
+        # so that a call can't be answered with a result meant for credentials it lacks
+        params = tuple(sorted((k, v) for k, v in params.items() if v is not None))
+        return (self.server + self.app_prefix + uri, method, hashlib.sha1(repr(params)).hexdigest())
+        
+    def invalidate_cache(self, uri=None):
+        """
+        Drops the cached results for the given endpoint uri (e.g. '/campaign/read'), or
+        all cached results if uri is None. Does nothing if the handle has no cache.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(uri)
+            
+    def _stream_request(self, uri, params, method="POST"):
+        """
+        Sends a request and returns an iterator over the items of the response's 'data'
+        member, which are decoded incrementally as the body arrives rather than all at
+        once. For an object-valued 'data', the items are (key, value) tuples.
+        
+        The response is read up to the first item before returning, so errors (HTTP-level
+        or in the 'result' and 'errors' members, which precede 'data') are raised right
+        away, and an expired stored token is replaced as in _perform_request().
+        """
+        try:
+            return self._start_stream(uri, params, method)
+        except OhmageApi.OhmageApiException, ex:
+            if not self._refresh_token_in(params, ex):
+                raise
+        
+        return self._start_stream(uri, params, method)
+        
+    def _download(self, uri, params, sink, method="POST", chunk_size=64 * 1024):
+        """
+        Sends a request and copies the response body to 'sink' in chunks of chunk_size
+        bytes, so that the body is never held in memory or parsed. 'sink' is either a
+        writable file-like object or a path; a path is written via a temporary file in the
+        same directory, so it only appears once the download is complete.
+        
+        Before anything is written, the first chunk is checked for an Ohmage error envelope
+        (which a CSV response carries in its metadata line). If there is one, the body is
+        parsed and raised as an OhmageApiException, retrying once with a fresh token if the
+        stored one had expired.
+        
+        Returns a dict with the number of 'bytes' written, the response's 'content_type'
+        and 'format' (see formats.response_format()), and the 'path', if one was given.
+        """
+        try:
+            resp, head = self._open_download(uri, params, method, chunk_size)
+        except OhmageApi.OhmageApiException, ex:
+            if not self._refresh_token_in(params, ex):
+                raise
+            resp, head = self._open_download(uri, params, method, chunk_size)
+        
+        path = sink if isinstance(sink, basestring) else None
+        tmp_path = None
+        written = 0
+        
+        try:
+            if path is not None:
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+                out = os.fdopen(fd, 'wb')
+            else:
+                out = sink
+            
+            try:
+                chunk = head
+                while chunk:
+                    out.write(chunk)
+                    written += len(chunk)
+                    chunk = resp.read(chunk_size)
+            finally:
+                if path is not None:
+                    out.close()
+            
+            if path is not None:
+                os.rename(tmp_path, path)
+        except Exception, ex:
+            resp.close()
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._emit_response(resp, error=ex)
+            raise
+        
+        self._emit_response(resp)
+        
+        content_type = resp.getheader('content-type')
+        return {'bytes': written, 'content_type': content_type,
+            'format': formats.response_format(content_type, params.get('output_format')), 'path': path}
+        
+    def _open_download(self, uri, params, method, chunk_size):
+        # opens the response and reads its first chunk, raising any error envelope found in it
+        resp = self._open_request(uri, params, method)
+        head = resp.read(chunk_size)
+        
+        # envelopes are small, so a failure shows up in the first chunk; a success body that
+        # merely contains the pattern costs a full parse, but is still written out as it is
+        if _FAILURE_PATTERN.search(head):
+            body = head + resp.read()
+            # errors come as JSON whatever format was asked for, and may not be labeled as such
+            content_type = 'application/json' if body.lstrip().startswith('{') else resp.getheader('content-type')
+            try:
+                self._handle_response(body, content_type, params)
+            except Exception, ex:
+                self._emit_response(resp, error=ex)
+                raise
+            return resp, body
+        
+        return resp, head
+        
+    def _start_stream(self, uri, params, method):
+        items = self._iter_data(self._open_request(uri, params, method), params.get('output_format'))
+        
+        for first in items:
+            return itertools.chain([first], items)
+        
+        return iter(())
+        
+    def _iter_data(self, resp, output_format=None):
+        result, error = None, None
+        
+        if formats.response_format(resp.getheader('content-type'), output_format) == 'csv':
+            members = _csv_members(resp.read)
+        else:
+            members = iter_members(resp.read, stream_keys=('data',))
+        
+        # the time spent in here, less the time spent reading, is the parse time; the
+        # time the caller spends between items isn't counted
+        busy, resumed = 0.0, time.time()
+        
+        try:
+            for event, key, value in members:
+                if key == 'errors':
+                    error = OhmageApi.OhmageApiException(value)
+                    raise error
+                elif key == 'result':
+                    result = value
+                elif event == 'item':
+                    busy += time.time() - resumed
+                    yield value
+                    resumed = time.time()
+                    
+            if result != 'success':
+                error = OhmageApi.OhmageApiException([])
+                raise error
+        finally:
+            # if we stopped early, this discards the connection rather than reusing it mid-body
+            resp.close()
+            busy += time.time() - resumed
+            self._emit_response(resp, parse=max(0.0, busy - resp.download_time), error=error)
+        
+    def _handle_response(self, data, content_type=None, params=None):
         """
         Overrides the base _handle_response() method to trap for Ohmage-specific errors.
+        
+        The body is decoded according to its Content-Type, or the output_format that was
+        asked for if that's inconclusive: JSON is parsed, CSV is parsed into a dict like
+        the JSON formats' (with the rows as dicts under 'data'), and XML is returned as
+        it is. An html page raises HTTPException, since it's never the api's output.
         """
+        fmt = formats.response_format(content_type, (params or {}).get('output_format'))
         
-        # in the rare case that the data is actually xml, return it as it is
-        if data.startswith("""<?xml version="1.0" encoding="UTF-8"?>"""):
+        if fmt == 'csv':
+            decoder = formats.CSVDecoder(data.splitlines(True))
+            rows = list(decoder)
+            result = {'result': decoder.metadata.get('result', 'success'), 'metadata': decoder.metadata, 'data': rows}
+            if 'errors' in decoder.metadata:
+                result['errors'] = decoder.metadata['errors']
+        elif fmt == 'json':
+            result = formats.loads(data)
+        elif fmt == 'text':
+            # an html page in place of the api's output, e.g. from a proxy or a captive portal
+            raise OhmageApi.HTTPException(self.__class__.__name__, '200', body=data)
+        else:
             return data
-            
-        result = simplejson.loads(data)
         
         if (result['result'] != 'success'):
             raise OhmageApi.OhmageApiException(result['errors'])
@@ -351,7 +957,260 @@ class OhmageApi(BaseApi):
             
         def __unicode__(self):
             return unicode(self.__str__())
+
+# the OhmageApi methods that make requests and return their result. AsyncOhmageApi and Batch
+# each provide a wrapper for every one of them, so a method listed here is available through both
+REQUEST_METHODS = ('user_auth', 'user_auth_token', 'config_read', 'campaign_read', 'class_read',
+    'survey_upload', 'bulk_survey_upload', 'survey_response_read', 'mobility_read', 'mobility_dates_read',
+    'mobility_read_range')
  
+class SurveyUploadResult(collections.namedtuple('SurveyUploadResult', 'index survey_key error')):
+    """
+    The outcome of uploading one survey through OhmageApi.bulk_survey_upload(). 'index'
+    is the survey's position in the list that was uploaded, and 'error' is the exception
+    that caused it to fail, or None if it was uploaded successfully.
+    """
+    __slots__ = ()
+    
+    @property
+    def ok(self):
+        return self.error is None
+
+# matches the "result" member of a failed request, in a JSON body or a CSV metadata line
+_FAILURE_PATTERN = re.compile(r'"result"\s*:\s*"failure"')
+
+def _csv_members(read):
+    # generates the same events as iter_members() for an Ohmage CSV body, with one item per row
+    decoder = formats.CSVDecoder(formats.iter_lines(read))
+    
+    for row in decoder:
+        if 'errors' in decoder.metadata:
+            break
+        yield ('item', 'data', row)
+    
+    if 'errors' in decoder.metadata:
+        yield ('value', 'errors', decoder.metadata['errors'])
+    yield ('value', 'result', decoder.metadata.get('result', 'success'))
+    
+def _size_batches(indices, sizes, max_bytes):
+    # groups the given indices of surveys into batches whose JSON array (plus attachments) fits in max_bytes
+    batch, size = [], 2
+    
+    for i in indices:
+        if batch and size + sizes[i] + 1 > max_bytes:
+            yield batch
+            batch, size = [], 2
+        batch.append(i)
+        size += sizes[i] + 1
+        
+    if batch:
+        yield batch
+
+def _response_values(survey):
+    # the values of a Survey's or CompactSurvey's responses
+    responses = survey.get('responses', ()) if isinstance(survey, dict) else survey.responses
+    return [response['value'] if isinstance(response, dict) else response[1] for response in responses]
+
+def _file_size(source):
+    # the size of an attachment given as a path or as an open file
+    if isinstance(source, basestring):
+        return os.path.getsize(source)
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    return size
+
+class _FileParam(MultipartParam):
+    # sends files in larger blocks than poster's default of 4KB, which takes a lot of
+    # small writes (and boundary checks) for a photo
+    def iter_encode(self, boundary, blocksize=256 * 1024):
+        return MultipartParam.iter_encode(self, boundary, blocksize)
+
+def _attachment_param(uuid, source):
+    # a multipart parameter that streams the attachment's file as the body is sent
+    if isinstance(source, basestring):
+        return _FileParam.from_file(uuid, source)
+    
+    filename = os.path.basename(getattr(source, 'name', uuid))
+    return _FileParam(uuid, filename=filename, filetype=mimetypes.guess_type(filename)[0],
+        filesize=_file_size(source), fileobj=source)
+
+class AsyncOhmageApi(object):
+    """
+    A non-blocking counterpart to OhmageApi. It exposes the same methods, but each
+    one returns a Future immediately; calling result() on it blocks until the
+    request completes and returns the same value (or raises the same
+    OhmageApiException) that the OhmageApi method would have.
+
+    At most max_concurrency requests are in flight at once; the rest wait their turn.
+    Unless a pool is given, the handle gets its own ConnectionPool sized to match.
+    """
+
+    def __init__(self, server, app_prefix='/app', client='ohmage-python-api', max_concurrency=8, pool=None):
+        if pool is None:
+            pool = ConnectionPool(pool_size=max_concurrency)
+
+        # the blocking handle that does the actual work on the worker threads
+        self.api = OhmageApi(server, app_prefix, client, pool)
+        self.workers = WorkerPool(max_concurrency)
+
+    def login(self, *args, **kwargs):
+        return self.workers.submit(self.api.login, *args, **kwargs)
+    login.__doc__ = OhmageApi.login.__doc__
+
+    def iter_survey_responses(self, campaign_urn, page_size=500, prefetch=1, **kwargs):
+        """
+        Returns OhmageApi.iter_survey_responses() as it is, rather than in a Future: it
+        already fetches pages in the background and only blocks for pages not yet read.
+        """
+        return self.api.iter_survey_responses(campaign_urn, page_size, prefetch, **kwargs)
+
+    def batch(self, max_concurrency=None):
+        """
+        Returns a Batch (see OhmageApi.batch()) that runs up to max_concurrency calls at
+        once; by default, as many as this handle does.
+        """
+        return self.api.batch(max_concurrency or self.workers.max_workers)
+
+    def is_authenticated(self, forToken=False):
+        return self.api.is_authenticated(forToken)
+
+    # ========================================================
+    # === Fan-out helpers
+    # ========================================================
+
+    def gather_survey_responses(self, campaign_urn, users, return_exceptions=False, **kwargs):
+        """
+        Reads the survey responses of each of the given users in campaign_urn, running
+        up to max_concurrency requests at once. Any other keyword arguments are passed
+        along to survey_response_read().
+
+        Returns a dict mapping each username to its survey_response_read() result. If
+        any request fails, its exception is raised once all of them have completed,
+        unless return_exceptions is true, in which case it's stored in the dict in
+        place of the result.
+        """
+        users = list(users)
+        futures = [self.survey_response_read(campaign_urn=campaign_urn, user_list=user, **kwargs) for user in users]
+        return dict(zip(users, self._gather(futures, return_exceptions)))
+
+    def gather_mobility(self, usernames, date, return_exceptions=False, **kwargs):
+        """
+        Reads the mobility data of each of the given users for the given date, in the
+        same manner as gather_survey_responses(). Returns a dict mapping each username
+        to its mobility_read() result.
+        """
+        usernames = list(usernames)
+        futures = [self.mobility_read(date=date, username=username, **kwargs) for username in usernames]
+        return dict(zip(usernames, self._gather(futures, return_exceptions)))
+
+    def _gather(self, futures, return_exceptions):
+        # every request finishes before the first failure (if any) is re-raised, so nothing is left running
+        results = wait_all(futures, return_exceptions=True)
+        if not return_exceptions:
+            wait_all(futures)
+        return results
+
+    # ========================================================
+    # === Lifecycle
+    # ========================================================
+
+    def close(self):
+        """
+        Waits for outstanding requests, stops the worker threads, and closes idle connections.
+        """
+        self.workers.shutdown()
+        self.api.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Batch(object):
+    """
+    Collects calls to an OhmageApi's methods, and runs them together when the batch
+    is run (or its 'with' block exits). See OhmageApi.batch().
+    
+    A batch can be run more than once; each run makes the calls collected since the
+    last one. If its 'with' block raises, the calls collected are not made, and their
+    futures raise Batch.Cancelled.
+    """
+    
+    def __init__(self, api, max_concurrency=8):
+        self.api = api
+        self.max_concurrency = max_concurrency
+        self._calls = []
+        
+    def run(self):
+        """
+        Makes the calls collected so far, up to max_concurrency at once, and waits for all
+        of them to complete. Returns their futures, in the order the calls were made.
+        """
+        calls, self._calls = self._calls, []
+        
+        if len(calls) == 1:
+            future, fn, args, kwargs = calls[0]
+            future._run(fn, args, kwargs)
+        elif calls:
+            pool = WorkerPool(min(self.max_concurrency, len(calls)))
+            try:
+                for future, fn, args, kwargs in calls:
+                    pool.submit(future._run, fn, args, kwargs)
+            finally:
+                pool.shutdown()
+        
+        return [future for future, _, _, _ in calls]
+        
+    def cancel(self):
+        """
+        Drops the calls collected since the last run; their futures raise Batch.Cancelled.
+        """
+        calls, self._calls = self._calls, []
+        
+        for future, _, _, _ in calls:
+            try:
+                raise Batch.Cancelled()
+            except Batch.Cancelled:
+                future.set_exception(sys.exc_info())
+                
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+        else:
+            self.cancel()
+            
+    class Cancelled(Exception):
+        def __str__(self):
+            return "The batch this call belonged to was cancelled before it ran"
+
+def _submitter(name):
+    # builds an AsyncOhmageApi method that runs the same-named OhmageApi method on a worker thread
+    def submit(self, *args, **kwargs):
+        return self.workers.submit(getattr(self.api, name), *args, **kwargs)
+    submit.__name__ = name
+    submit.__doc__ = getattr(OhmageApi, name).__doc__
+    return submit
+
+def _recorder(name):
+    # builds a Batch method that queues a call to the same-named OhmageApi method
+    def record(self, *args, **kwargs):
+        future = Future()
+        self._calls.append((future, getattr(self.api, name), args, kwargs))
+        return future
+    record.__name__ = name
+    record.__doc__ = getattr(OhmageApi, name).__doc__
+    return record
+
+for _name in REQUEST_METHODS:
+    setattr(AsyncOhmageApi, _name, _submitter(_name))
+    setattr(Batch, _name, _recorder(_name))
+del _name
+
 class Survey(dict):
     """
     Represents a completed survey. 'responses' is a list of Response objects.
@@ -363,7 +1222,7 @@ class Survey(dict):
         'responses' should be a list of Response objects.
         Ommitting the 'uuid' paramter causes a unique uuid4 to be generated automatically.
         """
-        self['survey_key'] = str(uuid) if uuid is not None else str(uuid.uuid4())
+        self['survey_key'] = str(uuid) if uuid is not None else str(uuid4())
         self['time'] = time
         self['timezone'] = timezone
         self['location_status'] = "unavailable"
@@ -377,4 +1236,76 @@ class Response(dict):
     """
     def __init__(self, prompt_id, value):
         self['prompt_id'] = prompt_id
-        self['value'] = value
\ No newline at end of file
+        self['value'] = value
+
+class CompactSurvey(object):
+    """
+    A lightweight equivalent of Survey for building surveys in bulk. It holds only its
+    own fields in __slots__ instead of a dict (plus a nested launch context dict), and
+    is encoded by encode_surveys() straight into the same wire format as a Survey.
+
+    'responses' should be a list of CompactResponse (or plain (prompt_id, value) tuples).
+    Ommitting the 'uuid' paramter causes a unique uuid4 to be generated automatically.
+    """
+    __slots__ = ('survey_key', 'time', 'timezone', 'location_status', 'survey_id', 'responses')
+
+    def __init__(self, survey_id, time, timezone, responses, uuid=None):
+        self.survey_key = str(uuid) if uuid is not None else str(uuid4())
+        self.time = time
+        self.timezone = timezone
+        self.location_status = "unavailable"
+        self.survey_id = survey_id
+        self.responses = responses
+
+class CompactResponse(collections.namedtuple('CompactResponse', 'prompt_id value')):
+    """
+    A lightweight equivalent of Response, backed by a tuple.
+    """
+    __slots__ = ()
+
+# compact separators, to match what the encoder below writes for CompactSurvey
+_encode_value = simplejson.JSONEncoder(separators=(',', ':')).encode
+
+def _encode_json(value):
+    # strings and integers make up nearly every field, so skip the general encoder for them
+    kind = type(value)
+    if kind is str or kind is unicode:
+        return encode_basestring_ascii(value)
+    if kind is int or kind is long:
+        return str(value)
+    return _encode_value(value)
+
+_SURVEY_TEMPLATE = ('{"survey_key":%s,"time":%s,"timezone":%s,"location_status":%s,"survey_id":%s,'
+    '"survey_launch_context":{"launch_time":%s,"launch_timezone":%s,"active_triggers":[]},"responses":[%s]}')
+
+def encode_survey(survey):
+    """
+    Encodes a single Survey (or any dict) or CompactSurvey as a JSON string.
+    """
+    if not isinstance(survey, CompactSurvey):
+        return _encode_value(survey)
+
+    time, timezone = _encode_json(survey.time), _encode_json(survey.timezone)
+    responses = ','.join('{"prompt_id":%s,"value":%s}' % (_encode_json(prompt_id), _encode_json(value))
+        for prompt_id, value in survey.responses)
+
+    return _SURVEY_TEMPLATE % (_encode_json(survey.survey_key), time, timezone,
+        _encode_json(survey.location_status), _encode_json(survey.survey_id), time, timezone, responses)
+
+def encode_surveys(surveys, buf=None):
+    """
+    Encodes a list of surveys (Survey, CompactSurvey, or a mix) as a JSON array in the
+    format survey_upload() sends. If buf is given, the JSON is written to it and None
+    is returned; otherwise it's returned as a string.
+    """
+    out = buf if buf is not None else StringIO()
+
+    out.write('[')
+    for i, survey in enumerate(surveys):
+        if i:
+            out.write(',')
+        out.write(encode_survey(survey))
+    out.write(']')
+
+    if buf is None:
+        return out.getvalue()
@@ -0,0 +1,142 @@
+"""
+Builds the smallest survey_response/read request for the data a caller needs.
+
+survey_response_read() asks for every column of every prompt, plus the metadata
+section, unless told otherwise, and most callers use a fraction of it. A
+SurveyResponseQuery takes the fields and prompts that are actually needed and
+sets column_list, prompt_id_list or survey_id_list, suppress_metadata and collapse
+to match. It asks for json-columns output, which names each column once rather
+than once per row, and decodes it back into rows (or columns) keyed by the names
+the caller used:
+
+    query = SurveyResponseQuery('urn:campaign:ca:ucla:mood', fields=['user', 'timestamp'], prompts=['mood'])
+    for row in query.run(api):
+        print row['user'], row['timestamp'], row['mood']
+"""
+
+import collections
+
+# the survey_response/read columns, by the names a query may use for them
+COLUMNS = {
+    'user': 'urn:ohmage:user:id',
+    'client': 'urn:ohmage:context:client',
+    'timestamp': 'urn:ohmage:context:timestamp',
+    'utc_timestamp': 'urn:ohmage:context:utc_timestamp',
+    'timezone': 'urn:ohmage:context:timezone',
+    'launch_context_short': 'urn:ohmage:context:launch_context_short',
+    'launch_context_long': 'urn:ohmage:context:launch_context_long',
+    'location_status': 'urn:ohmage:context:location:status',
+    'latitude': 'urn:ohmage:context:location:latitude',
+    'longitude': 'urn:ohmage:context:location:longitude',
+    'accuracy': 'urn:ohmage:context:location:accuracy',
+    'provider': 'urn:ohmage:context:location:provider',
+    'location_timestamp': 'urn:ohmage:context:location:timestamp',
+    'survey_id': 'urn:ohmage:survey:id',
+    'survey_title': 'urn:ohmage:survey:title',
+    'survey_description': 'urn:ohmage:survey:description',
+    'privacy_state': 'urn:ohmage:survey:privacy_state',
+    'repeatable_set_id': 'urn:ohmage:repeatable_set:id',
+    'repeatable_set_iteration': 'urn:ohmage:repeatable_set:iteration',
+}
+
+# the column that carries the responses to the prompts in prompt_id_list, and the
+# prefix of each prompt's column in the output
+PROMPT_RESPONSES = 'urn:ohmage:prompt:response'
+PROMPT_PREFIX = 'urn:ohmage:prompt:id:'
+
+ALL = 'urn:ohmage:special:all'
+
+class SurveyResponseQuery(object):
+    """
+    A survey_response/read request for the given fields (names from COLUMNS, or column
+    urns) and prompts (prompt ids) of campaign_urn's responses.
+
+    (o) surveys = Survey ids to limit the responses to; only used if no prompts are given,
+        since the server takes one list or the other (and prompt ids imply their surveys).
+    (o) users = Usernames to limit the responses to (default: all users).
+    (o) distinct = If true, identical rows are returned once (the server's 'collapse'),
+        e.g. to list the users who responded with fields=['user'].
+
+    Any other keyword arguments (start_date, end_date, privacy_state, sort_order, ...)
+    are passed along to survey_response_read() as they are.
+    """
+
+    def __init__(self, campaign_urn, fields=(), prompts=(), surveys=(), users=None, distinct=False, **kwargs):
+        if isinstance(fields, basestring) or isinstance(prompts, basestring) or isinstance(surveys, basestring):
+            raise TypeError("fields, prompts and surveys must be lists, not strings")
+        if prompts and surveys:
+            raise ValueError("A query can be limited to prompts or to surveys, not both")
+        if not fields and not prompts:
+            raise ValueError("A query needs at least one field or prompt")
+
+        self.campaign_urn = campaign_urn
+        self.fields = list(fields)
+        self.prompts = list(prompts)
+        self.surveys = list(surveys)
+        self.users = list(users) if users is not None and not isinstance(users, basestring) else users
+        self.distinct = distinct
+        self.extra = kwargs
+
+        # the output column behind each name the caller will get back
+        self.columns = collections.OrderedDict((field, COLUMNS.get(field, field)) for field in self.fields)
+        for prompt in self.prompts:
+            self.columns[prompt] = PROMPT_PREFIX + prompt
+
+        for field, column in self.columns.items():
+            if not column.startswith('urn:'):
+                raise ValueError("Unknown field '%s'; use one of %s or a column urn" % (field, ", ".join(sorted(COLUMNS))))
+
+    def params(self):
+        """
+        Returns the keyword arguments for survey_response_read() that make this request.
+        """
+        column_list = [column for column in self.columns.values() if not column.startswith(PROMPT_PREFIX)]
+        if self.prompts:
+            column_list.append(PROMPT_RESPONSES)
+
+        params = {
+            'campaign_urn': self.campaign_urn,
+            'output_format': 'json-columns',
+            'column_list': ','.join(column_list),
+            'user_list': ','.join(self.users) if isinstance(self.users, list) else (self.users or ALL),
+            'suppress_metadata': 'true',
+        }
+
+        if self.prompts:
+            params['prompt_id_list'] = ','.join(self.prompts)
+        else:
+            params['survey_id_list'] = ','.join(self.surveys) or ALL
+
+        if self.distinct:
+            params['collapse'] = 'true'
+
+        params.update(self.extra)
+        return params
+
+    def decode(self, result, shape='rows'):
+        """
+        Turns a json-columns survey_response_read() result for this query into a list of
+        dicts, one per response, keyed by the query's field names and prompt ids; or, if
+        shape is 'columns', into an OrderedDict mapping each of those names to the list of
+        its values, which saves building a dict per response.
+        """
+        data = result.get('data') or {}
+        values = [(name, data[column]['values'] if column in data else None) for name, column in self.columns.items()]
+        count = max([len(column) for _, column in values if column is not None] + [0])
+
+        # a column that's absent (e.g. a prompt nobody has answered yet) reads as None
+        values = [(name, column if column is not None else [None] * count) for name, column in values]
+
+        if shape == 'columns':
+            return collections.OrderedDict(values)
+        if shape != 'rows':
+            raise ValueError("shape must be 'rows' or 'columns'")
+
+        names = [name for name, _ in values]
+        return [dict(zip(names, row)) for row in zip(*[column for _, column in values])] if count else []
+
+    def run(self, api, shape='rows'):
+        """
+        Makes the request through 'api' (an OhmageApi) and returns the decoded result.
+        """
+        return self.decode(api.survey_response_read(**self.params()), shape)
@@ -0,0 +1,257 @@
+"""
+Client-side rate limiting for the third-party device APIs, and date range planning
+to make the most of their quotas.
+
+FitBit and BodyMedia allow each app a number of requests per hour, and each user
+of the app a number of their own. A RateLimiter holds a token bucket for the app
+and one per user token, and makes each request wait until both have a token, so
+that a quota is spent evenly across the hour rather than all at its start. When
+the server says a quota has run out anyway (with a 429, a Retry-After header,
+FitBit's Fitbit-Rate-Limit-* headers or BodyMedia's Mashery error codes), the
+affected bucket is emptied until the reset time the server gave.
+
+split_range() and merge_ranges() plan the fewest requests that cover a set of date
+ranges, given the longest range the API serves in one request.
+"""
+
+import email.utils, threading, time
+from datetime import date as Date, datetime, timedelta
+
+class TokenBucket(object):
+    """
+    Allows 'rate' requests per second on average, in bursts of up to 'capacity'. A
+    rate of None allows any number, except while the bucket is blocked.
+    Not thread-safe on its own; RateLimiter serializes access to its buckets.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity or 0)
+        self.updated = time.time()
+        self.blocked_until = 0.0
+
+    def wait(self, now):
+        """
+        Returns how many seconds from 'now' until a token is available (0 if one is).
+        """
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.rate is None or self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate is not None:
+            self._refill(now)
+            self.tokens -= 1
+
+    def block_until(self, until):
+        """
+        Allows nothing until the given time, and then one request before refilling as usual.
+        """
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = min(1.0, self.capacity or 0)
+        self.updated = self.blocked_until
+
+    def limit_to(self, remaining):
+        # the server's count of what's left is authoritative when it's lower than ours
+        self.tokens = min(self.tokens, float(remaining))
+
+    def full(self, now):
+        return self.wait(now) == 0 and (self.rate is None or self.tokens >= self.capacity)
+
+    def _refill(self, now):
+        if self.rate is not None and now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+class RateLimiter(object):
+    """
+    Token buckets for an app key and for each user token used with it.
+
+    app_limit and user_limit are (requests, seconds) tuples, e.g. (150, 3600) for
+    150 requests an hour, or None for no limit at that level. 'burst' is the fraction
+    of each limit that may be spent at once (the buckets' capacity); the rest is
+    released evenly over the period.
+    """
+
+    APP, USER = 'app', 'user'
+
+    def __init__(self, app_limit=None, user_limit=(150, 3600), burst=0.1):
+        self.app_limit = app_limit
+        self.user_limit = user_limit
+        self.burst = burst
+
+        self._app = self._bucket(app_limit)
+        self._users = {}
+        self._prune_at = 1024
+        self._lock = threading.Lock()
+
+    def acquire(self, user=None, max_wait=None):
+        """
+        Waits until both the app's and the given user's buckets allow a request, and
+        takes a token from each. If that would mean waiting longer than max_wait seconds,
+        returns the wait instead without taking anything; otherwise returns 0.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                buckets = [b for b in (self._app, self._user_bucket(user, now)) if b is not None]
+                wait = max(b.wait(now) for b in buckets)
+
+                if wait == 0:
+                    for bucket in buckets:
+                        bucket.take(now)
+                    return 0.0
+
+            if max_wait is not None and wait > max_wait:
+                return wait
+            time.sleep(wait)
+
+    def observe(self, user, status, getheader):
+        """
+        Updates the buckets from a response's status and headers (getheader(name) returns
+        a header's value or None). Returns (scope, retry_after) if the response says a
+        quota has been exhausted, where scope is RateLimiter.APP or RateLimiter.USER and
+        retry_after is in seconds; otherwise returns None.
+        """
+        now = time.time()
+        limited = _rate_limited(status, getheader)
+        reset = _seconds(getheader('Retry-After'), now)
+        if reset is None:
+            reset = _seconds(getheader('Fitbit-Rate-Limit-Reset'), now)
+        remaining = getheader('Fitbit-Rate-Limit-Remaining')
+
+        with self._lock:
+            bucket = self._user_bucket(user, now)
+
+            if remaining is not None and bucket is not None and bucket.rate is not None:
+                try:
+                    bucket.limit_to(int(remaining))
+                except ValueError:
+                    pass
+
+            if not limited:
+                return None
+
+            scope = limited if limited != RateLimiter.USER or user is not None else RateLimiter.APP
+            retry_after = reset if reset is not None else self._period(scope)
+
+            (self._app if scope == RateLimiter.APP else bucket).block_until(now + retry_after)
+
+        return scope, retry_after
+
+    def _user_bucket(self, user, now):
+        if user is None:
+            return None
+        if user not in self._users:
+            if len(self._users) >= self._prune_at:
+                self._prune(now)
+            self._users[user] = self._bucket(self.user_limit)
+        return self._users[user]
+
+    def _prune(self, now):
+        # a bucket that has refilled is no different from a new one, so it needn't be kept
+        for user, bucket in self._users.items():
+            if bucket.full(now):
+                del self._users[user]
+        self._prune_at = max(1024, 2 * len(self._users))
+
+    def _bucket(self, limit):
+        if limit is None:
+            return TokenBucket(None, None)
+        requests, seconds = limit
+        return TokenBucket(float(requests) / seconds, max(1.0, requests * self.burst))
+
+    def _period(self, scope):
+        # with no reset time given, assume the whole quota period
+        limit = self.app_limit if scope == RateLimiter.APP else self.user_limit
+        return float(limit[1]) if limit else 60.0
+
+def _rate_limited(status, getheader):
+    # returns the scope of an exhausted quota that the response reports, or None
+    if status == 429:
+        return RateLimiter.USER
+
+    # BodyMedia's API gateway (Mashery) reports exhausted app quotas as a 403
+    mashery = getheader('X-Mashery-Error-Code') or ''
+    if 'OVER_RATE' in mashery or 'OVER_QPS' in mashery:
+        return RateLimiter.APP
+
+    if status == 503 and getheader('Retry-After') is not None:
+        return RateLimiter.APP
+
+    return None
+
+def _seconds(value, now):
+    # parses a number of seconds, or an HTTP date, into seconds from now
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        return max(0.0, email.utils.mktime_tz(parsed) - now) if parsed else None
+
+# ========================================================
+# === Date ranges
+# ========================================================
+
+def to_date(value):
+    """
+    Accepts a date, a datetime, or a string in YYYY-MM-DD or YYYYMMDD form.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, Date):
+        return value
+    value = value.replace('-', '')
+    return Date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+def split_range(start, end, max_days):
+    """
+    Splits the inclusive range [start, end] into consecutive ranges of at most max_days days
+    (or none at all, if max_days is None).
+    """
+    start, end = to_date(start), to_date(end)
+    if max_days is None:
+        return [(start, end)] if start <= end else []
+
+    ranges = []
+
+    while start <= end:
+        stop = min(end, start + timedelta(days=max_days - 1))
+        ranges.append((start, stop))
+        start = stop + timedelta(days=1)
+
+    return ranges
+
+def merge_ranges(ranges, max_days, max_gap_days=0):
+    """
+    Returns the fewest ranges of at most max_days days (of any length if max_days is None)
+    that cover all the given inclusive (start, end) ranges. Ranges that overlap, or are
+    separated by no more than max_gap_days days, are read together: fetching the days
+    between them costs less than a request.
+    """
+    spans = sorted((to_date(start), to_date(end)) for start, end in ranges)
+    merged = []
+
+    for start, end in spans:
+        if merged and (start - merged[-1][1]).days <= max_gap_days + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return [part for start, end in merged for part in split_range(start, end, max_days)]
+
+def covered(ranges):
+    """
+    Returns the set of dates in the given inclusive ranges.
+    """
+    days = set()
+    for start, end in ranges:
+        start, end = to_date(start), to_date(end)
+        days.update(start + timedelta(days=n) for n in range((end - start).days + 1))
+    return days
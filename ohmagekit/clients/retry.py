@@ -0,0 +1,121 @@
+"""
+Retry and circuit-breaking policies for the request layer.
+
+A RetryPolicy decides whether a failed attempt at a request should be repeated and
+how long to wait first (exponential backoff with full jitter, so that many clients
+recovering from the same outage don't all come back at once). Requests that aren't
+idempotent, like survey uploads, are only retried when the failure guarantees the
+server never saw them.
+
+A CircuitBreaker tracks consecutive failures against one server. Once there have
+been failure_threshold of them it opens, and requests fail immediately with
+CircuitBreaker.OpenError rather than tying up threads waiting on a server that's
+down. After reset_timeout seconds it lets a single trial request through, and
+closes again if that succeeds.
+"""
+
+import httplib, random, socket, threading, time
+
+from transport import ConnectError
+
+class RetryPolicy(object):
+    """
+    Retries failed requests up to max_attempts times in total. The wait before the
+    n-th retry is drawn uniformly from [0, min(max_delay, base_delay * 2^n)], or is
+    exactly that bound if jitter is false.
+
+    Idempotent requests are retried after socket errors and after the HTTP statuses in
+    retry_statuses. Other requests are only retried if the connection couldn't be
+    established, or the server answered 503 (i.e. it turned the request away unread).
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=30.0, jitter=True, retry_statuses=(500, 502, 503, 504)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+
+    def delay(self, retry):
+        """
+        Returns how many seconds to wait before the given retry (0 for the first).
+        """
+        bound = min(self.max_delay, self.base_delay * (2 ** retry))
+        return random.uniform(0, bound) if self.jitter else bound
+
+    def should_retry_error(self, ex, idempotent):
+        if isinstance(ex, ConnectError):
+            return True
+        return idempotent and isinstance(ex, (socket.error, httplib.HTTPException))
+
+    def should_retry_status(self, status, idempotent):
+        return status in self.retry_statuses and (idempotent or status == 503)
+
+class CircuitBreaker(object):
+    """
+    Fails requests to a server fast once it has failed failure_threshold times in a row,
+    until reset_timeout seconds have passed. Use CircuitBreaker.for_server() to share a
+    breaker between all the handles that talk to the same server.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    # the shared breakers, by server
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_server(cls, server, **kwargs):
+        """
+        Returns the breaker shared by all requests to 'server', creating it (with the
+        given settings) if there isn't one yet.
+        """
+        with cls._registry_lock:
+            if server not in cls._registry:
+                cls._registry[server] = cls(**kwargs)
+            return cls._registry[server]
+
+    def before_request(self):
+        """
+        Raises CircuitBreaker.OpenError if requests shouldn't be sent right now.
+        """
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+
+            if self.state == CircuitBreaker.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                # let this one request through as a trial; everyone else keeps failing fast
+                self.state = CircuitBreaker.HALF_OPEN
+                return
+
+            raise CircuitBreaker.OpenError(self.failures, self.opened_at + self.reset_timeout - time.time())
+
+    def record_success(self):
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.time()
+
+    class OpenError(Exception):
+        def __init__(self, failures, retry_in):
+            self.failures = failures
+            self.retry_in = max(0, retry_in)
+
+        def __str__(self):
+            return "Circuit open after %d consecutive failures; retrying in %.1fs" % (self.failures, self.retry_in)
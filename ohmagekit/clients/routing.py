@@ -0,0 +1,129 @@
+"""
+Routing of requests across several replicas of a server.
+
+A ServerRouter keeps an exponentially weighted moving average of each replica's
+latency (to the response headers) and error rate. Reads go to the fastest healthy
+replica; writes go only to the primaries, in the order given. A replica that fails
+is taken out of rotation for a cooldown that doubles with each consecutive failure,
+and the request moves on to the next candidate. A replica that hasn't been used for
+probe_interval seconds is tried again, so that its average doesn't go stale after it
+falls behind.
+
+BaseApi uses a router when it's given a list of servers rather than one; see
+BaseApi._send_routed().
+"""
+
+import threading, time
+
+class ServerRouter(object):
+    """
+    Chooses among 'servers' (base urls such as 'https://ohmage-a.example.org'), of which
+    'primaries' (by default, the first) accept writes.
+
+    'smoothing' is the weight of each new measurement in the moving averages. A replica
+    that fails is skipped for 'cooldown' seconds, doubling with each consecutive failure
+    up to max_cooldown.
+    """
+
+    def __init__(self, servers, primaries=None, smoothing=0.3, cooldown=5.0, max_cooldown=300.0, probe_interval=30.0):
+        if not servers:
+            raise ValueError("A ServerRouter needs at least one server")
+
+        self.servers = list(servers)
+        self.primaries = list(primaries) if primaries else self.servers[:1]
+        for primary in self.primaries:
+            if primary not in self.servers:
+                raise ValueError("Primary %s is not one of the servers" % primary)
+
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_interval = probe_interval
+
+        self._stats = dict((server, ServerStats()) for server in self.servers)
+        self._lock = threading.Lock()
+
+    def candidates(self, write=False):
+        """
+        Returns the servers to try for a request, in order. For a read, that's the healthy
+        servers from fastest to slowest, then the others from the soonest to recover; for
+        a write, the healthy primaries and then the others, each in the order given.
+        """
+        now = time.time()
+
+        with self._lock:
+            if write:
+                ordered = sorted(self.primaries, key=lambda server: not self._stats[server].healthy(now))
+            else:
+                healthy = [server for server in self.servers if self._stats[server].healthy(now)]
+                healthy.sort(key=lambda server: self._stats[server].score(now, self.probe_interval))
+                down = [server for server in self.servers if server not in healthy]
+                down.sort(key=lambda server: self._stats[server].down_until)
+                ordered = healthy + down
+
+            # claims the first choice's probe (if it's due one), so that concurrent requests don't all pile on
+            self._stats[ordered[0]].last_used = now
+
+        return ordered
+
+    def record(self, server, latency=None, error=False):
+        """
+        Records the outcome of a request to 'server': the seconds it took to answer, or
+        that it failed.
+        """
+        now = time.time()
+
+        with self._lock:
+            stats = self._stats.get(server)
+            if stats is None:
+                return
+
+            stats.requests += 1
+            stats.last_used = now
+            stats.error_rate += self.smoothing * ((1.0 if error else 0.0) - stats.error_rate)
+
+            if error:
+                stats.errors += 1
+                stats.failures += 1
+                stats.down_until = now + min(self.max_cooldown, self.cooldown * 2 ** (stats.failures - 1))
+                return
+
+            stats.failures = 0
+            stats.down_until = 0.0
+            if latency is not None:
+                stats.latency = latency if stats.latency is None else stats.latency + self.smoothing * (latency - stats.latency)
+
+    def stats(self):
+        """
+        Returns a dict mapping each server to a dict of its current latency average (in
+        seconds, or None before its first success), error rate average, request and error
+        counts, and whether it's healthy.
+        """
+        now = time.time()
+
+        with self._lock:
+            return dict((server, {'latency': stats.latency, 'error_rate': stats.error_rate, 'requests': stats.requests,
+                'errors': stats.errors, 'healthy': stats.healthy(now)}) for server, stats in self._stats.items())
+
+class ServerStats(object):
+    """
+    The moving averages and health of one server, as kept by a ServerRouter.
+    """
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.last_used = 0.0
+
+    def healthy(self, now):
+        return now >= self.down_until
+
+    def score(self, now, probe_interval):
+        # lower is better; servers with nothing recent to go on score 0, so they're tried
+        if self.latency is None or now - self.last_used > probe_interval:
+            return 0.0
+        return self.latency / max(0.05, 1.0 - self.error_rate)
@@ -0,0 +1,138 @@
+"""
+Incremental parsing of large JSON response bodies.
+
+Ohmage wraps every response in an envelope object, e.g.
+{"result": "success", "data": [...]}. The data member can run to hundreds of
+megabytes, so rather than loading the whole body and decoding it in one go,
+iter_members() reads the body a chunk at a time and decodes the top-level
+members as they arrive. Array (or object) members named in stream_keys are
+never decoded whole; their elements are produced one by one instead.
+"""
+
+import simplejson
+
+# the size of each read from the underlying stream
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+def iter_members(read, stream_keys=('data',), chunk_size=CHUNK_SIZE):
+    """
+    Generates events for the members of the JSON object read through read(n), which
+    should return an empty string at the end of the stream. The events are:
+
+    ('value', key, value) for a top-level member, decoded in full.
+    ('item', key, item) for each element of an array member named in stream_keys,
+        or each (name, value) tuple of an object member named in stream_keys.
+
+    The stream is always read to the end, so a pooled connection can be reused.
+    Raises simplejson.JSONDecodeError (a ValueError) if the document is malformed.
+    """
+    return _MemberParser(read, stream_keys, chunk_size).parse()
+
+class _MemberParser(object):
+    def __init__(self, read, stream_keys, chunk_size):
+        self.read = read
+        self.stream_keys = stream_keys
+        self.chunk_size = chunk_size
+
+        self.decoder = simplejson.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def parse(self):
+        self._expect('{')
+
+        if self._peek() == '}':
+            self.pos += 1
+        else:
+            while True:
+                key = self._decode()
+                self._expect(':')
+
+                if key in self.stream_keys and self._peek() in ('[', '{'):
+                    for item in self._items():
+                        yield ('item', key, item)
+                else:
+                    yield ('value', key, self._decode())
+
+                if self._expect(',', '}') == '}':
+                    break
+
+        # drain whatever's left (normally just a trailing newline)
+        if self._peek() != '':
+            self._fail("Extra data after the end of the document")
+
+    def _items(self):
+        opener = self._expect('[', '{')
+        closer = ']' if opener == '[' else '}'
+
+        if self._peek() == closer:
+            self.pos += 1
+            return
+
+        while True:
+            if opener == '[':
+                yield self._decode()
+            else:
+                name = self._decode()
+                self._expect(':')
+                yield (name, self._decode())
+
+            if self._expect(',', closer) == closer:
+                return
+
+    # ========================================================
+    # === buffer management
+    # ========================================================
+
+    def _fill(self, size=None):
+        # drops the consumed part of the buffer and appends the next chunk
+        data = self.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def _peek(self):
+        # skips whitespace and returns the next character, or '' at the end of the stream
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ''
+            self._fill()
+
+    def _expect(self, *chars):
+        c = self._peek()
+        if c not in chars or c == '':
+            self._fail("Expecting %s" % " or ".join("'%s'" % x for x in chars))
+        self.pos += 1
+        return c
+
+    def _decode(self):
+        self._peek()
+        size = self.chunk_size
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except simplejson.JSONDecodeError:
+                # most likely the value just runs past the end of the buffer
+                if self.eof:
+                    raise
+            else:
+                # a number or literal that ends the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+
+            # read progressively larger chunks so that a huge value isn't re-scanned too often
+            self._fill(size)
+            size *= 2
+
+    def _fail(self, msg):
+        raise simplejson.JSONDecodeError(msg, self.buf, self.pos)
@@ -0,0 +1,528 @@
+"""
+A small keep-alive connection pool shared by the HTTP(S) API handles.
+
+Every handle derived from BaseApi sends its requests through a ConnectionPool,
+which keeps a handful of idle connections open per (scheme, host) so that
+consecutive requests don't pay for a new TCP (and TLS) handshake each time.
+The connections are poster's streaming connections, so the same pool carries
+both regular form posts and the generator bodies produced by multipart_encode().
+
+The pool also negotiates compression: it asks for gzip or deflate responses and
+decodes them as they're read, and it can gzip large request bodies for servers
+that accept them. See ConnectionPool.compression_stats() for how much it saved.
+
+Like the urllib2 and httplib2 openers it replaces, the pool follows redirects (see
+ConnectionPool.request() for which) and honours the http_proxy, https_proxy and
+no_proxy environment variables, unless it's given proxies of its own.
+"""
+
+import base64, gzip, httplib, select, socket, threading, time, urllib, urlparse, zlib
+from cStringIO import StringIO
+
+# streaming connections accept iterables (e.g. multipart_encode() output) as bodies
+from poster.streaminghttp import StreamingHTTPConnection, StreamingHTTPSConnection
+
+class ConnectError(socket.error):
+    """
+    Raised when a connection to the server can't be established, meaning that the
+    request was never sent.
+    """
+
+class ConnectionPool(object):
+    """
+    Holds up to pool_size idle keep-alive connections per (scheme, host).
+
+    Connections that have sat idle for longer than idle_timeout seconds are closed
+    rather than reused. Requests beyond pool_size may run concurrently; their extra
+    connections are simply closed instead of being returned to the pool.
+
+    If accept_compressed is true, requests ask for gzip or deflate responses, which
+    are decoded transparently. If compress_requests_over is set, request bodies larger
+    than that many bytes are gzipped (with Content-Encoding: gzip); a host that
+    answers such a request with 400 or 415 is assumed not to support it, and the
+    request is sent again uncompressed, as are all later requests to that host.
+
+    'proxies' maps a scheme ('http' or 'https') to the url of the proxy for it, as
+    urllib.getproxies() does; by default, the proxies are read from the environment.
+    Pass {} to connect directly. Up to max_redirects redirects are followed per request.
+
+    The pool is thread-safe and may be shared between any number of api handles.
+    Closing it drops the idle connections; it can still be used afterward, in which
+    case it opens new connections as needed.
+    """
+
+    def __init__(self, pool_size=4, idle_timeout=60.0, timeout=None, accept_compressed=True, compress_requests_over=None, proxies=None, max_redirects=5):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.accept_compressed = accept_compressed
+        self.compress_requests_over = compress_requests_over
+        self.proxies = proxies if proxies is not None else urllib.getproxies()
+        self.max_redirects = max_redirects
+
+        # maps (scheme, host) to a list of (connection, last_used) tuples, most recent last
+        self._idle = {}
+        self._lock = threading.Lock()
+
+        # the hosts that rejected a compressed request body, and the compression counters
+        self._no_compressed_requests = set()
+        self._stats = dict.fromkeys(('requests_compressed', 'request_bytes', 'request_bytes_sent',
+            'responses_compressed', 'response_bytes', 'response_bytes_received'), 0)
+        self._stats_lock = threading.Lock()
+
+    def request(self, url, method="GET", body=None, headers=None, idempotent=None):
+        """
+        Sends a request for the given absolute url and returns a PooledResponse once
+        the status and headers have arrived. The caller must read() the response to
+        completion (or close() it) so that the connection can go back into the pool.
+
+        'idempotent' says whether the request may be sent twice (by default, only GET and
+        HEAD requests are). If a reused connection turns out to have been dropped by the
+        server, a request that isn't is only sent again if it failed while being sent,
+        not while waiting for the response, since by then the server may have acted on it.
+
+        Redirects of GET and HEAD requests are followed, as are 303s (as a GET) and 307s
+        and 308s (with the same method and body) of any request; a 301 or 302 in answer
+        to any other method is returned as it is.
+        """
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+
+        for redirects in range(self.max_redirects + 1):
+            resp = self._request_once(url, method, body, headers, idempotent)
+
+            location = resp.getheader('location')
+            if location is None or redirects == self.max_redirects:
+                return resp
+
+            if resp.status in (301, 302, 303, 307, 308) and method in ('GET', 'HEAD'):
+                pass
+            elif resp.status == 303:
+                method, body, headers = 'GET', None, _without(headers, 'content-type', 'content-length')
+            elif resp.status not in (307, 308) or not _replayable(body):
+                return resp
+
+            # finish off the response so that its connection can be reused
+            resp.read()
+            url = urlparse.urljoin(url, location)
+
+    def _request_once(self, url, method, body, headers, idempotent):
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        key = (scheme, host)
+        selector = (path or '/') + ('?' + query if query else '')
+        headers = dict(headers or {})
+
+        if self.accept_compressed and not _header(headers, 'accept-encoding'):
+            headers['Accept-Encoding'] = 'gzip, deflate'
+
+        proxy = self._proxy(key)
+        if proxy is not None and scheme == 'http':
+            # a plain http proxy is sent the whole url; https goes through a CONNECT tunnel instead
+            selector = urlparse.urlunsplit((scheme, host, path or '/', query, ''))
+            if proxy[1]:
+                headers['Proxy-Authorization'] = proxy[1]
+
+        # a multipart generator may have been (partly) sent already, by a retried request
+        _rewind(body)
+
+        sent_body, sent_headers = body, headers
+        if self._should_compress(key, body, headers):
+            sent_body, sent_headers = _gzip_body(body, headers)
+
+        resp = self._request(key, method, selector, sent_body, sent_headers, idempotent)
+
+        if sent_body is not body:
+            if resp.status in (400, 415):
+                # the server doesn't take compressed bodies; send this one again as it was
+                resp.read()
+                with self._lock:
+                    self._no_compressed_requests.add(key)
+                _rewind(body)
+                return self._request(key, method, selector, body, headers, idempotent)
+
+            self._count(requests_compressed=1, request_bytes=_body_size(body, headers), request_bytes_sent=len(sent_body))
+            resp.request_compressed = True
+
+        return resp
+
+    def compression_refused(self, resp):
+        """
+        Records that the server which sent 'resp', in answer to a compressed request, couldn't
+        decode the body; for servers that say so with an error of their own rather than a 400
+        or 415. Later requests to the same host are sent uncompressed.
+        """
+        with self._lock:
+            self._no_compressed_requests.add(resp._key)
+
+    def compression_stats(self):
+        """
+        Returns a dict of how many requests were sent compressed ('requests_compressed')
+        and their total size before ('request_bytes') and after ('request_bytes_sent')
+        compression, and likewise for the responses that arrived compressed.
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def close(self):
+        """
+        Closes all idle connections held by the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # ========================================================
+    # === compression
+    # ========================================================
+
+    def _should_compress(self, key, body, headers):
+        if self.compress_requests_over is None or body is None or _header(headers, 'content-encoding'):
+            return False
+        if not isinstance(body, basestring) and not hasattr(body, 'reset'):
+            return False
+        if _streams_files(body):
+            return False
+
+        with self._lock:
+            if key in self._no_compressed_requests:
+                return False
+
+        return _body_size(body, headers) > self.compress_requests_over
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+
+    # ========================================================
+    # === connection bookkeeping
+    # ========================================================
+
+    def _request(self, key, method, selector, body, headers, idempotent):
+        started = time.time()
+        conn, reused = self._acquire(key)
+        connected = time.time()
+
+        sent = False
+        try:
+            conn.request(method, selector, body, headers)
+            sent = True
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            # a reused connection may have been dropped by the server while it sat idle, so
+            # try once more on a fresh one; unless the whole request went out, in which case
+            # the server may have acted on it, and it's only sent again if that's harmless
+            if not reused or not _replayable(body) or (sent and not idempotent):
+                raise
+            _rewind(body)
+            started = time.time()
+            conn, reused = self._connect(key), False
+            connected = time.time()
+            response = self._send(conn, method, selector, body, headers)
+        except:
+            conn.close()
+            raise
+
+        resp = PooledResponse(self, key, conn, response)
+        # taking an idle connection from the pool doesn't count as connecting
+        resp.connect_time = connected - started if not reused else 0.0
+        resp.first_byte_time = time.time() - connected
+        resp.bytes_sent = _body_size(body, headers)
+        return resp
+
+    def _send(self, conn, method, selector, body, headers):
+        try:
+            conn.request(method, selector, body, headers)
+            return conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def _connect(self, key):
+        scheme, host = key
+        kwargs = {'timeout': self.timeout} if self.timeout is not None else {}
+        proxy = self._proxy(key)
+
+        if scheme == 'https':
+            conn = StreamingHTTPSConnection(proxy[0] if proxy else host, **kwargs)
+            if proxy:
+                conn.set_tunnel(host, headers={'Proxy-Authorization': proxy[1]} if proxy[1] else None)
+        elif scheme == 'http':
+            conn = StreamingHTTPConnection(proxy[0] if proxy else host, **kwargs)
+        else:
+            raise ValueError("Unsupported URL scheme '%s', must be 'http' or 'https'" % scheme)
+
+        # connect up front, so that a failure here is known not to have sent anything
+        try:
+            conn.connect()
+        except socket.error, ex:
+            conn.close()
+            raise ConnectError(*ex.args)
+
+        return conn
+
+    def _proxy(self, key):
+        # returns the (host, Proxy-Authorization header or None) of the proxy to reach key
+        # through, or None to connect directly
+        scheme, host = key
+        url = self.proxies.get(scheme)
+        if not url or urllib.proxy_bypass(host.split(':')[0]):
+            return None
+
+        parts = urlparse.urlsplit(url if '://' in url else 'http://' + url)
+        credentials = None
+        if parts.username is not None:
+            credentials = 'Basic ' + base64.b64encode('%s:%s' % (urllib.unquote(parts.username), urllib.unquote(parts.password or '')))
+        return parts.hostname + (':%d' % parts.port if parts.port else ''), credentials
+
+    def _acquire(self, key):
+        now = time.time()
+        stale = []
+
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout and not _dropped(conn):
+                    return conn, True
+                stale.append(conn)
+
+        for conn in stale:
+            conn.close()
+
+        return self._connect(key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append((conn, time.time()))
+                return
+
+        conn.close()
+
+class PooledResponse(object):
+    """
+    Wraps an httplib response whose connection belongs to a ConnectionPool.
+
+    The connection is handed back to the pool as soon as the body has been read to
+    the end. Closing the response before that discards the connection instead, since
+    whatever is left of the body would otherwise be read by the next request.
+
+    A gzip- or deflate-encoded body is decompressed as it's read, so read() always
+    returns the decoded body; bytes_received counts the bytes as they arrived.
+    """
+
+    def __init__(self, pool, key, conn, response):
+        self.status = response.status
+        self.reason = response.reason
+
+        # timings (in seconds) and sizes, for instrumentation
+        self.connect_time = 0.0
+        self.first_byte_time = 0.0
+        self.download_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        # whether the request's body was gzipped by the pool
+        self.request_compressed = False
+
+        # when the request was first sent (across any retries), and the RequestEvent
+        # describing it if the handle has observers; both are set by BaseApi._send()
+        self.started = time.time()
+        self.event = None
+
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+        encoding = (response.getheader('content-encoding') or '').strip().lower()
+        self._decoder = _Decoder(encoding) if encoding in ('gzip', 'x-gzip', 'deflate') else None
+        self._decoded = 0
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def getheaders(self):
+        return self._response.getheaders()
+
+    def read(self, amt=None):
+        """
+        Reads up to amt bytes of the body, or the rest of it if amt is None.
+        Returns an empty string once the body has been exhausted.
+        """
+        if self._decoder is None:
+            return self._read_raw(amt)
+
+        decoder = self._decoder
+        if amt is None:
+            data = decoder.decompress(decoder.unconsumed_tail + self._read_raw()) + decoder.flush()
+        else:
+            # a few compressed bytes may not decode to anything yet, so keep reading until they do
+            while True:
+                raw = decoder.unconsumed_tail or self._read_raw(amt)
+                data = decoder.decompress(raw, amt) if raw else decoder.flush()
+                if data or not raw:
+                    break
+
+        self._decoded += len(data)
+        if self._conn is None and not decoder.unconsumed_tail:
+            # the whole body has been decoded
+            self._decoder = None
+            self._pool._count(responses_compressed=1, response_bytes=self._decoded, response_bytes_received=self.bytes_received)
+
+        return data
+
+    def _read_raw(self, amt=None):
+        if self._conn is None:
+            return ''
+
+        started = time.time()
+        try:
+            data = self._response.read() if amt is None else self._response.read(amt)
+        except:
+            self.close()
+            raise
+        finally:
+            self.download_time += time.time() - started
+
+        if amt is not None and not data and self._response.length:
+            # httplib takes a body that ends early for a complete one when it's read in parts
+            self.close()
+            raise httplib.IncompleteRead('', self._response.length)
+
+        self.bytes_received += len(data)
+
+        if amt is None or not data or self._response.isclosed():
+            self._finish()
+
+        return data
+
+    def close(self):
+        """
+        Releases the response, discarding the connection if the body wasn't consumed.
+        """
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _finish(self):
+        conn, self._conn = self._conn, None
+
+        # only connections the server intends to keep open are worth pooling
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._release(self._key, conn)
+        else:
+            conn.close()
+
+class _Decoder(object):
+    # incrementally decompresses a gzip or deflate body; 'deflate' is meant to be zlib-wrapped,
+    # but some servers send raw deflate data, so that's tried if the zlib header is missing
+    def __init__(self, encoding):
+        self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding != 'deflate' else zlib.MAX_WBITS)
+        self._sniff = encoding == 'deflate'
+
+    @property
+    def unconsumed_tail(self):
+        return self._zlib.unconsumed_tail
+
+    def decompress(self, data, max_length=0):
+        if self._sniff and data:
+            self._sniff = False
+            try:
+                return self._zlib.decompress(data, max_length)
+            except zlib.error:
+                self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._zlib.decompress(data, max_length)
+
+    def flush(self):
+        return self._zlib.flush()
+
+def _dropped(conn):
+    # an idle connection has nothing to read unless the server has closed it (or sent something
+    # unasked for); either way it's no use for a request, which might not be safe to send twice
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+def _gzip_body(body, headers):
+    # returns the body gzipped, with headers to match; generator bodies are gathered up first
+    if not isinstance(body, basestring):
+        body = ''.join(body)
+
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+        f.write(body)
+
+    headers = dict((name, value) for name, value in headers.items() if name.lower() != 'content-length')
+    headers['Content-Encoding'] = 'gzip'
+    headers['Content-Length'] = str(buf.tell())
+    return buf.getvalue(), headers
+
+def _header(headers, name):
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def _without(headers, *names):
+    return dict((key, value) for key, value in (headers or {}).items() if key.lower() not in names)
+
+def _body_size(body, headers):
+    # multipart generators don't know their size, but the headers they came with do
+    if isinstance(body, basestring):
+        return len(body)
+    return int(_header(headers, 'content-length') or 0)
+
+def _rewind(body):
+    if hasattr(body, 'reset'):
+        body.reset()
+        # poster's reset() leaves a partly sent parameter's iterator in place, which
+        # would carry on from the middle of its (now rewound) file
+        if hasattr(body, 'param_iter'):
+            body.param_iter = body.p = None
+
+def _streams_files(body):
+    # multipart bodies with files are read from disk as they're sent; gzipping one would
+    # mean holding it all in memory, and media files are compressed already
+    return any(getattr(param, 'fileobj', None) is not None for param in getattr(body, 'params', ()))
+
+def _replayable(body):
+    # strings can be sent again as-is, and multipart_encode()'s generator can be rewound
+    return body is None or isinstance(body, basestring) or hasattr(body, 'reset')
+
+# the pool used by api handles that aren't given one explicitly
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def shared_pool():
+    """
+    Returns the process-wide ConnectionPool, creating it on first use.
+    """
+    global _shared_pool
+
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = ConnectionPool()
+        return _shared_pool
@@ -0,0 +1,363 @@
+"""
+Bulk export of every campaign's survey responses, and its users' mobility data,
+into a directory of files partitioned by campaign and date.
+
+The export is planned from campaign_read(): each campaign's users are its members
+in any role plus the members of its classes (from class_read()). The work is then
+split into one job per (campaign, user) for survey responses and one per user for
+mobility, which run on a bounded pool of threads sharing one logged-in handle. The
+output is laid out as:
+
+<out>/campaigns/<campaign urn>/<date>/<user>.jsonl   survey responses, one json-rows object per line
+<out>/mobility/<date>/<user>.json                    mobility/read output, exactly as the server sent it
+<out>/checkpoint                                     the jobs (and mobility days) completed so far
+
+Names are URL-quoted to make them safe as file names. Each file is written under
+a temporary name and renamed once complete, and a survey response job is only
+checkpointed once all its files are in place, so an interrupted export can simply be
+run again: completed jobs are skipped, and any others are redone from scratch. Once
+a run completes without failures, its survey response jobs are dropped from the
+checkpoint, since new responses may arrive for any date; the next run exports every
+campaign's responses again. Mobility jobs are never skipped as a whole; instead each
+day is checkpointed as it's written, except for today's, which may still grow and so
+is read again by every run.
+
+Run it as 'python -m ohmagekit.export' (or the ohmage-export script); see main().
+"""
+
+import argparse, getpass, os, simplejson, sys, tempfile, threading, time, urllib
+from datetime import date as Date
+
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.checkpoint import Checkpoint
+from ohmagekit.clients.concurrency import Future, WorkerPool
+
+class ExportStats(object):
+    """
+    Thread-safe counters of an export's progress, with a one-line report of its throughput.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.jobs_total = 0
+        self.jobs_done = 0
+        self.jobs_skipped = 0
+        self.jobs_failed = 0
+        self.responses = 0
+        self.mobility_days = 0
+        self.mobility_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        return ("%d/%d jobs (%d skipped, %d failed), %d responses (%.1f/s), %d mobility days, %.1f MB (%.2f MB/s) in %ds" % (
+            self.jobs_done + self.jobs_skipped, self.jobs_total, self.jobs_skipped, self.jobs_failed,
+            self.responses, self.responses / elapsed, self.mobility_days,
+            self.mobility_bytes / 1048576.0, self.mobility_bytes / 1048576.0 / elapsed, elapsed))
+
+class Exporter(object):
+    """
+    Exports campaigns through 'api' (a logged-in OhmageApi) into out_dir.
+
+    campaigns limits the export to the given campaign urns (default: every campaign
+    campaign_read() returns). start_date and end_date (ISO8601, inclusive) limit the
+    survey responses and mobility days exported. Up to 'workers' jobs run at once.
+    Progress is written to 'log' every progress_interval seconds.
+    """
+
+    def __init__(self, api, out_dir, campaigns=None, workers=8, responses=True, mobility=True,
+        start_date=None, end_date=None, progress_interval=30, log=sys.stderr):
+        self.api = api
+        self.out_dir = out_dir
+        self.campaigns = campaigns
+        self.workers = workers
+        self.responses = responses
+        self.mobility = mobility
+        self.start_date = start_date
+        self.end_date = end_date
+        self.progress_interval = progress_interval
+        self.log = log
+
+        self.stats = ExportStats()
+
+    def plan(self):
+        """
+        Returns the list of jobs to run, as (key, function, args) tuples.
+        """
+        kwargs = {'campaign_urn_list': ','.join(self.campaigns)} if self.campaigns else {}
+        campaigns = self.api.campaign_read(output_format='long', **kwargs)['data']
+
+        # the classes' members are read all at once, since campaigns often share classes
+        class_urns = set()
+        for campaign in campaigns.values():
+            class_urns.update(campaign.get('classes') or [])
+        classes = self.api.class_read(','.join(sorted(class_urns)))['data'] if class_urns else {}
+
+        jobs, everyone = [], set()
+
+        for urn in sorted(campaigns):
+            users = self._campaign_users(campaigns[urn], classes)
+            everyone.update(users)
+
+            if self.responses:
+                for user in sorted(users):
+                    jobs.append((('responses', urn, user), self._export_responses, (urn, user)))
+
+        if self.mobility:
+            for user in sorted(everyone):
+                jobs.append((('mobility', user), self._export_mobility, (user,)))
+
+        return jobs
+
+    def run(self, fresh=False):
+        """
+        Plans and runs the export, skipping the jobs an interrupted or failed previous
+        run completed unless 'fresh' is true. Returns the ExportStats; failed jobs are
+        logged and counted, and will be retried by the next run.
+        """
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+
+        checkpoint_path = os.path.join(self.out_dir, 'checkpoint')
+        if fresh and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.checkpoint = Checkpoint(checkpoint_path)
+
+        jobs = self.plan()
+        self.stats.jobs_total = len(jobs)
+
+        progress = _Repeater(self.progress_interval, lambda: self._log(self.stats.report()))
+        pool = WorkerPool(self.workers)
+
+        try:
+            futures = []
+            for key, fn, args in jobs:
+                if key in self.checkpoint:
+                    self.stats.add(jobs_skipped=1)
+                    continue
+
+                future = pool.submit(fn, *args)
+                future.add_done_callback(self._finisher(key))
+                futures.append(future)
+
+            for future in futures:
+                _wait(future)
+
+            # the last jobs are checkpointed by callbacks on the workers, which must finish first
+            pool.shutdown()
+            if not self.stats.jobs_failed:
+                # the response checkpoint is only there to resume an interrupted run
+                self.checkpoint.prune(lambda key: key[0] == 'responses')
+        except KeyboardInterrupt:
+            # drop the jobs that haven't started, which the next run does; the running ones finish below
+            pool.shutdown(wait=False, cancel_pending=True)
+            raise
+        finally:
+            pool.shutdown()
+            progress.stop()
+            self.checkpoint.close()
+
+        self._log(self.stats.report())
+        return self.stats
+
+    def _finisher(self, key):
+        # checkpoints a job as soon as it completes, so that an interruption loses as little as possible
+        def finish(future):
+            ex = future.exception()
+            if ex is None:
+                # a mobility job checkpoints its days itself, so that it runs again for today's
+                if key[0] != 'mobility':
+                    self.checkpoint.add(key)
+                self.stats.add(jobs_done=1)
+            elif not isinstance(ex, WorkerPool.Cancelled):
+                self.stats.add(jobs_failed=1)
+                self._log("%s failed: %s" % (' '.join(key), ex))
+        return finish
+
+    # ========================================================
+    # === Jobs
+    # ========================================================
+
+    def _export_responses(self, campaign_urn, user):
+        # in time order, so that each day's rows arrive together
+        params = {'campaign_urn': campaign_urn, 'user_list': user, 'output_format': 'json-rows', 'return_id': 'true',
+            'sort_order': 'user,timestamp,survey'}
+        if self.start_date or self.end_date:
+            params.update(start_date=self.start_date or '1970-01-01', end_date=self.end_date or Date.today().isoformat())
+
+        # one output file per day, written as the rows stream in
+        directory = os.path.join(self.out_dir, 'campaigns', _quote(campaign_urn))
+        files = _DayFiles(directory, _quote(user) + '.jsonl')
+        count = 0
+
+        try:
+            for row in self.api.survey_response_read(stream=True, **params):
+                day = (row.get('timestamp') or row.get('utc_timestamp') or 'undated')[:10]
+                files.write(day, simplejson.dumps(row) + '\n')
+                count += 1
+        except:
+            files.discard()
+            raise
+
+        files.commit()
+        self.stats.add(responses=count)
+
+    def _export_mobility(self, user):
+        today = Date.today().isoformat()
+        dates = self.api.mobility_dates_read(start_date=self.start_date, end_date=self.end_date, username=user)['data']
+
+        for day in sorted(dates):
+            key = ('mobility', user, day)
+            if key in self.checkpoint:
+                continue
+
+            directory = os.path.join(self.out_dir, 'mobility', day)
+            _makedirs(directory)
+            download = self.api.mobility_read(date=day, username=user, sink=os.path.join(directory, _quote(user) + '.json'))
+            self.stats.add(mobility_days=1, mobility_bytes=download['bytes'])
+
+            # today's data may still grow, so it's fetched again next time
+            if day < today:
+                self.checkpoint.add(key)
+
+    def _campaign_users(self, campaign, classes):
+        users = set()
+
+        for members in (campaign.get('user_role_campaign') or {}).values():
+            users.update(members)
+        for class_urn in campaign.get('classes') or []:
+            users.update((classes.get(class_urn) or {}).get('users') or {})
+
+        return users
+
+    def _log(self, message):
+        if self.log is not None:
+            self.log.write("[%s] %s\n" % (time.strftime('%H:%M:%S'), message))
+            self.log.flush()
+
+class _DayFiles(object):
+    # the per-day output files of one job, each written under a temporary name until commit().
+    # only the file of the day being written is kept open, since a job may span years of days;
+    # a day written to again is reopened for appending
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self._files = {}
+        self._day, self._file = None, None
+
+    def write(self, day, data):
+        if day != self._day:
+            self._close()
+            if day in self._files:
+                self._file = open(self._files[day][0], 'ab')
+            else:
+                path = os.path.join(self.directory, day, self.name)
+                _makedirs(os.path.dirname(path))
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+                self._files[day] = (tmp_path, path)
+                self._file = os.fdopen(fd, 'wb')
+            self._day = day
+        self._file.write(data)
+
+    def commit(self):
+        self._close()
+        for tmp_path, path in self._files.values():
+            os.rename(tmp_path, path)
+        self._files = {}
+
+    def discard(self):
+        self._close()
+        for tmp_path, path in self._files.values():
+            os.remove(tmp_path)
+        self._files = {}
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+        self._day, self._file = None, None
+
+class _Repeater(object):
+    # calls fn every 'interval' seconds on a daemon thread, until stopped
+    def __init__(self, interval, fn):
+        self._stopped = threading.Event()
+        self._interval = interval
+        self._fn = fn
+
+        if interval:
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self._fn()
+
+    def stop(self):
+        self._stopped.set()
+
+def _wait(future):
+    # waits in steps, since an untimed wait can't be interrupted with Ctrl-C
+    while True:
+        try:
+            return future.exception(1.0)
+        except Future.Timeout:
+            pass
+
+def _quote(name):
+    return urllib.quote(name, safe='')
+
+def _makedirs(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another job may have just created it
+            if not os.path.isdir(directory):
+                raise
+
+def main(argv=None):
+    """
+    The command-line entry point; run with --help for the options. The password may
+    also be given in the OHMAGE_PASSWORD environment variable, and is prompted for if
+    it's in neither place. Exits with status 1 if any job failed.
+    """
+    parser = argparse.ArgumentParser(description="Exports Ohmage campaigns' survey responses and mobility data.")
+    parser.add_argument('--server', required=True, action='append', help="the server's base url, e.g. https://ohmage.example.org; "
+        "give it once per replica to spread the reads across them")
+    parser.add_argument('--app-prefix', default='/app', help="the path of the API on the server (default: /app)")
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', default=os.environ.get('OHMAGE_PASSWORD'))
+    parser.add_argument('--out', required=True, help="the directory to export into")
+    parser.add_argument('--campaign', action='append', dest='campaigns', metavar='URN',
+        help="export only this campaign (may be repeated; default: all)")
+    parser.add_argument('--start-date', help="export only data on or after this date (YYYY-MM-DD)")
+    parser.add_argument('--end-date', help="export only data on or before this date (YYYY-MM-DD)")
+    parser.add_argument('--workers', type=int, default=8, help="jobs to run at once (default: 8)")
+    parser.add_argument('--no-responses', action='store_false', dest='responses', help="skip survey responses")
+    parser.add_argument('--no-mobility', action='store_false', dest='mobility', help="skip mobility data")
+    parser.add_argument('--fresh', action='store_true', help="ignore the checkpoint of a previous run")
+    parser.add_argument('--progress', type=int, default=30, metavar='SECONDS', help="how often to report progress (default: 30)")
+    args = parser.parse_args(argv)
+
+    password = args.password if args.password is not None else getpass.getpass("Password for %s: " % args.username)
+
+    api = OhmageApi(args.server if len(args.server) > 1 else args.server[0], app_prefix=args.app_prefix)
+    try:
+        api.login(args.username, password)
+
+        exporter = Exporter(api, args.out, campaigns=args.campaigns, workers=args.workers,
+            responses=args.responses, mobility=args.mobility, start_date=args.start_date,
+            end_date=args.end_date, progress_interval=args.progress)
+        stats = exporter.run(fresh=args.fresh)
+    finally:
+        api.close()
+
+    return 1 if stats.jobs_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+"""
+Incremental mirroring of campaign survey responses into a local SQLite database.
+
+SurveyResponseStore holds the responses of any number of campaigns, indexed by
+response id, user and timestamp, along with a per-campaign high-water mark: the
+latest response timestamp seen so far. SurveyResponseSync brings a campaign up to
+date by asking survey_response/read only for responses from the high-water mark
+onward (plus any specific responses known to have changed), so the cost of a sync
+follows the number of new responses rather than the size of the campaign.
+"""
+
+import sqlite3, simplejson
+from datetime import date as Date, datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS survey_response (
+    id TEXT PRIMARY KEY,
+    campaign_urn TEXT NOT NULL,
+    user TEXT,
+    survey_id TEXT,
+    timestamp TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS survey_response_user ON survey_response (campaign_urn, user, timestamp);
+CREATE INDEX IF NOT EXISTS survey_response_timestamp ON survey_response (campaign_urn, timestamp);
+CREATE TABLE IF NOT EXISTS sync_state (
+    campaign_urn TEXT PRIMARY KEY,
+    high_water TEXT,
+    last_sync TEXT
+);
+"""
+
+class SurveyResponseStore(object):
+    """
+    A local SQLite store of survey responses, keyed by response id. 'path' is the
+    database file, which is created if need be (':memory:' gives a throwaway store).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def upsert(self, campaign_urn, rows):
+        """
+        Inserts the given json-rows responses (read with return_id=true), replacing any
+        stored responses with the same ids. Returns the latest timestamp among them, or
+        None if rows was empty.
+        """
+        latest = None
+
+        with self.db:
+            for row in rows:
+                response_id = row.get('survey_key') or row.get('id')
+                if not response_id:
+                    raise ValueError("Survey response has no id; it must be read with return_id=true")
+
+                timestamp = _timestamp(row)
+                if timestamp is not None and (latest is None or timestamp > latest):
+                    latest = timestamp
+
+                self.db.execute("INSERT OR REPLACE INTO survey_response (id, campaign_urn, user, survey_id, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    (response_id, campaign_urn, row.get('user'), row.get('survey_id'), timestamp, simplejson.dumps(row)))
+
+        return latest
+
+    def responses(self, campaign_urn, user=None, start=None, end=None):
+        """
+        Generates the stored responses of a campaign in timestamp order, optionally only
+        those of one user and/or with timestamps in [start, end).
+        """
+        query, args = "SELECT data FROM survey_response WHERE campaign_urn = ?", [campaign_urn]
+
+        if user is not None:
+            query += " AND user = ?"
+            args.append(user)
+        if start is not None:
+            query += " AND timestamp >= ?"
+            args.append(start)
+        if end is not None:
+            query += " AND timestamp < ?"
+            args.append(end)
+
+        for (data,) in self.db.execute(query + " ORDER BY timestamp", args):
+            yield simplejson.loads(data)
+
+    def count(self, campaign_urn):
+        return self.db.execute("SELECT COUNT(*) FROM survey_response WHERE campaign_urn = ?", (campaign_urn,)).fetchone()[0]
+
+    def high_water(self, campaign_urn):
+        """
+        Returns the latest response timestamp synced for the campaign, or None.
+        """
+        row = self.db.execute("SELECT high_water FROM sync_state WHERE campaign_urn = ?", (campaign_urn,)).fetchone()
+        return row[0] if row else None
+
+    def set_high_water(self, campaign_urn, high_water):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO sync_state (campaign_urn, high_water, last_sync) VALUES (?, ?, ?)",
+                (campaign_urn, high_water, datetime.utcnow().isoformat()))
+
+    def close(self):
+        self.db.close()
+
+class SurveyResponseSync(object):
+    """
+    Keeps a SurveyResponseStore up to date with the server through an OhmageApi handle.
+
+    Ohmage filters survey responses by date rather than time, so each sync re-reads
+    from overlap_days before the day of the high-water mark; the responses it already
+    has are simply replaced with identical copies.
+
+    The window follows when responses were taken, as reported by the device, since
+    survey_response/read cannot filter by upload time. A response uploaded more than
+    overlap_days after it was taken is therefore missed, unless its id is passed in
+    changed_ids or the campaign is synced again from scratch; the default of a week
+    allows for phones that stay offline for a few days. The high-water mark is capped
+    at the day of the sync, so that a device with a wrong clock reporting a future
+    date can't push the window past the present.
+    """
+
+    def __init__(self, api, store, overlap_days=7, batch_size=500):
+        self.api = api
+        self.store = store
+        self.overlap_days = overlap_days
+        self.batch_size = batch_size
+
+    def sync(self, campaign_urn, changed_ids=None, **kwargs):
+        """
+        Fetches the campaign's responses from the high-water mark onward (all of them on
+        the first sync) and upserts them into the store. changed_ids may list the ids of
+        older responses known to have changed (e.g. their privacy state), which are
+        re-read as well. Other keyword arguments are passed to survey_response_read().
+
+        Returns a dict with the number of responses 'fetched' and the new 'high_water'.
+        """
+        high_water = self.store.high_water(campaign_urn)
+        fetched = 0
+
+        params = dict(kwargs, campaign_urn=campaign_urn, output_format="json-rows", return_id="true")
+        today = Date.today()
+
+        if high_water is not None:
+            # end_date is inclusive and required alongside start_date; tomorrow covers every timezone
+            until = today + timedelta(days=1)
+            since = datetime.strptime(high_water[:10], "%Y-%m-%d").date() - timedelta(days=self.overlap_days)
+            params.update(start_date=min(since, until).isoformat(), end_date=until.isoformat())
+
+        count, latest = self._upsert(campaign_urn, self.api.survey_response_read(stream=True, **params))
+        fetched += count
+
+        if changed_ids:
+            changed = dict(kwargs, campaign_urn=campaign_urn, output_format="json-rows", return_id="true",
+                survey_response_id_list=",".join(changed_ids))
+            count, changed_latest = self._upsert(campaign_urn, self.api.survey_response_read(stream=True, **changed))
+            fetched += count
+            latest = max(latest, changed_latest)
+
+        if latest is not None:
+            # a future timestamp comes from a device's wrong clock, not from the server
+            latest = min(latest, today.isoformat())
+
+        if latest is not None and (high_water is None or latest > high_water):
+            high_water = latest
+            self.store.set_high_water(campaign_urn, high_water)
+
+        return {'fetched': fetched, 'high_water': high_water}
+
+    def _upsert(self, campaign_urn, rows):
+        # upserts in batches, so that neither the response nor the transaction grows unbounded
+        count, latest, batch = 0, None, []
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                latest = max(latest, self.store.upsert(campaign_urn, batch))
+                count += len(batch)
+                batch = []
+
+        if batch:
+            latest = max(latest, self.store.upsert(campaign_urn, batch))
+            count += len(batch)
+
+        return count, latest
+
+def _timestamp(row):
+    # prefer the unambiguous UTC timestamp when the server includes it
+    return row.get('utc_timestamp') or row.get('timestamp')
@@ -0,0 +1,272 @@
+"""
+Benchmarks the API clients against a local StubServer.
+
+Each case calls one client method repeatedly, from 'concurrency' threads sharing one
+handle, and reports its throughput, the p50/p95/p99 latency of the calls, and the
+peak memory it used. Every case runs in a forked child process, so that one case's
+peak memory doesn't hide another's; the stub server runs in the parent, and so
+doesn't compete with the client for the interpreter lock.
+
+Usage:
+
+    python -m ohmagekit.tests.benchmark [options] [case ...]
+
+With --save the results are written out as JSON, and with --baseline the run is
+compared to such a file; the exit status is 1 if any case's p50 latency or peak
+memory grew by more than --tolerance.
+"""
+
+import argparse, resource, simplejson, sys, threading, time
+from multiprocessing import Process, Queue
+
+from ohmagekit.clients import bodymedia
+from ohmagekit.clients.ohmage import OhmageApi, Survey, Response
+from ohmagekit.clients.fitbit import FitBitApi
+from ohmagekit.clients.bodymedia import BodyMediaApi
+from ohmagekit.clients.metrics import percentile
+from ohmagekit.clients.query import SurveyResponseQuery
+from ohmagekit.tests.stubserver import StubServer
+
+OAUTH_URLS = ('/oauth/request_token', '/oauth/access_token', '/oauth/authorize')
+OAUTH_TOKEN = {'oauth_token': 'stub-access', 'oauth_secret': 'stub-access-secret'}
+
+# ========================================================
+# === Cases
+# ========================================================
+
+# each case takes the server url and returns the function to time; setup (logging
+# in, building upload bodies) happens before the clock starts
+
+def _ohmage(url):
+    api = OhmageApi(url)
+    api.login('stub.user', 'password')
+    return api
+
+def _surveys(count):
+    return [Survey('dailyMood', int(time.time() * 1000) + n, 'America/Los_Angeles',
+        [Response('mood', n % 5 + 1), Response('sleep', n % 8 + 3), Response('notes', 'Nothing much to report today')])
+        for n in range(count)]
+
+def case_user_auth_token(url):
+    api = OhmageApi(url)
+    return lambda: api.user_auth_token('stub.user', 'password')
+
+def case_config_read(url):
+    api = OhmageApi(url)
+    return api.config_read
+
+def case_campaign_read(url):
+    return _ohmage(url).campaign_read
+
+def case_survey_response_read(url):
+    api = _ohmage(url)
+    return lambda: api.survey_response_read(campaign_urn='urn:campaign:stub:0', output_format='json-rows')
+
+def case_survey_response_read_stream(url):
+    api = _ohmage(url)
+    return lambda: sum(1 for _ in api.survey_response_read(campaign_urn='urn:campaign:stub:0', output_format='json-rows', stream=True))
+
+def case_survey_response_read_csv(url):
+    api = _ohmage(url)
+    return lambda: api.survey_response_read(campaign_urn='urn:campaign:stub:0', output_format='csv')
+
+def case_survey_response_query(url):
+    api = _ohmage(url)
+    query = SurveyResponseQuery('urn:campaign:stub:0', fields=['user', 'timestamp'], prompts=['mood'])
+    return lambda: query.run(api)
+
+def case_iter_survey_responses(url):
+    api = _ohmage(url)
+    return lambda: sum(1 for _ in api.iter_survey_responses('urn:campaign:stub:0', page_size=100, output_format='json-rows'))
+
+def case_mobility_read(url):
+    api = _ohmage(url)
+    return lambda: api.mobility_read(date='2012-01-01')
+
+def case_mobility_read_columns(url):
+    api = _ohmage(url)
+    return lambda: api.mobility_read(date='2012-01-01', as_columns=True)
+
+def case_survey_upload(url):
+    api = _ohmage(url)
+    surveys = _surveys(100)
+    return lambda: api.survey_upload(campaign_urn='urn:campaign:stub:0', campaign_creation_timestamp='2012-01-01 00:00:00', surveys=surveys)
+
+def case_bulk_survey_upload(url):
+    api = _ohmage(url)
+    surveys = _surveys(2000)
+    return lambda: api.bulk_survey_upload('urn:campaign:stub:0', surveys, campaign_creation_timestamp='2012-01-01 00:00:00', max_bytes=64 * 1024)
+
+def case_fitbit_activities_steps(url):
+    api = FitBitApi(url, 'stub-key', 'stub-secret', *OAUTH_URLS)
+    return lambda: api.activities_steps(OAUTH_TOKEN)
+
+def case_fitbit_auth(url):
+    api = FitBitApi(url, 'stub-key', 'stub-secret', *OAUTH_URLS)
+
+    def auth():
+        rq_token, _ = api.get_auth_url('http://localhost/callback')
+        return api.process_auth_response(rq_token, 'stub-verifier')
+    return auth
+
+def case_bodymedia_step_day(url):
+    # the module prints every url and response unless told not to
+    bodymedia.debug = False
+    api = BodyMediaApi(url, 'stub-key', 'stub-secret', *OAUTH_URLS)
+    return lambda: api.step_day(OAUTH_TOKEN)
+
+CASES = [(name[len('case_'):], fn) for name, fn in sorted(globals().items()) if name.startswith('case_')]
+
+# ========================================================
+# === Running
+# ========================================================
+
+def run_case(setup, url, calls, concurrency):
+    """
+    Calls the function setup(url) returns 'calls' times in total from 'concurrency'
+    threads, and returns a dict of the results. Runs in the current process; see
+    run_isolated().
+    """
+    fn = setup(url)
+    baseline_rss = _peak_rss()
+
+    # warm up, so that connecting and first-call costs don't skew small runs
+    fn()
+
+    latencies, errors = [], []
+    remaining = [calls]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+
+            started = time.time()
+            try:
+                fn()
+            except Exception, ex:
+                errors.append(repr(ex))
+            latencies.append(time.time() - started)
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'calls': calls,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'throughput': calls / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'peak_rss_mb': _peak_rss() / 1024.0,
+        'rss_growth_mb': (_peak_rss() - baseline_rss) / 1024.0,
+    }
+
+def run_isolated(setup, url, calls, concurrency):
+    # runs the case in a child process and sends back its results (or the error)
+    queue = Queue()
+
+    def child():
+        try:
+            queue.put(run_case(setup, url, calls, concurrency))
+        except Exception, ex:
+            queue.put({'failed': repr(ex)})
+
+    process = Process(target=child)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def _peak_rss():
+    # in KB; ru_maxrss is in bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of descriptions of the cases whose p50 latency or peak memory grew by
+    more than 'tolerance' (a fraction) relative to 'baseline'.
+    """
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if not before or 'failed' in before or 'failed' in result:
+            continue
+
+        for metric in ('p50', 'peak_rss_mb'):
+            if before[metric] and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append("%s: %s went from %.4g to %.4g" % (name, metric, before[metric], result[metric]))
+
+    return regressions
+
+def report(results):
+    lines = ["%-32s %7s %6s %9s %9s %9s %9s %9s" % ('case', 'calls', 'errors', 'calls/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'peak (MB)')]
+
+    for name, result in sorted(results.items()):
+        if 'failed' in result:
+            lines.append("%-32s failed: %s" % (name, result['failed']))
+            continue
+
+        lines.append("%-32s %7d %6d %9.1f %9.2f %9.2f %9.2f %9.1f" % (name, result['calls'], result['errors'],
+            result['throughput'], result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000, result['peak_rss_mb']))
+        if result['first_error']:
+            lines.append("    first error: %s" % result['first_error'])
+
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the API clients against a local stub server.")
+    parser.add_argument('cases', nargs='*', help="the cases to run (default: all of %s)" % ", ".join(name for name, _ in CASES))
+    parser.add_argument('--calls', type=int, default=200, help="calls per case")
+    parser.add_argument('--concurrency', type=int, default=1, help="threads calling each case at once")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the server waits before each response")
+    parser.add_argument('--survey-responses', type=int, default=500, help="rows returned by survey_response/read")
+    parser.add_argument('--mobility-points', type=int, default=1000, help="points returned by mobility/read")
+    parser.add_argument('--compress', action='store_true', help="have the server gzip its responses")
+    parser.add_argument('--save', metavar='FILE', help="write the results to FILE as JSON")
+    parser.add_argument('--baseline', metavar='FILE', help="compare the results to those saved in FILE")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="the fraction by which a case may get worse than the baseline")
+    args = parser.parse_args(argv)
+
+    cases = dict(CASES)
+    for name in args.cases:
+        if name not in cases:
+            parser.error("unknown case: %s" % name)
+    selected = [(name, fn) for name, fn in CASES if not args.cases or name in args.cases]
+
+    results = {}
+    with StubServer(latency=args.latency, survey_responses=args.survey_responses, mobility_points=args.mobility_points,
+            compress=args.compress) as server:
+        for name, setup in selected:
+            results[name] = run_isolated(setup, server.url, args.calls, args.concurrency)
+
+    print report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            simplejson.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, simplejson.load(f), args.tolerance)
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
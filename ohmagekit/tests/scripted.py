@@ -0,0 +1,167 @@
+"""
+A keep-alive HTTP server for the unit tests, whose every response is decided by the
+test. Unlike StubServer, which imitates the real servers as cheaply as it can, it
+records each request in full and can fail in the ways the clients must survive.
+
+The test's handler is called with a ScriptedRequest and returns one of:
+
+    (status, body)                  body is a string, or a value to send as JSON
+    (status, headers, body)         headers is a dict; a Content-Length longer than
+                                    the body leaves the body cut short
+    None                            the connection is cut without an answer
+
+    with ScriptedServer(lambda request: (200, {'result': 'success'})) as server:
+        api = OhmageApi(server.url)
+"""
+
+import BaseHTTPServer, SocketServer, cgi, gzip, simplejson, socket, sys, threading, urlparse
+from cStringIO import StringIO
+
+class ScriptedRequest(object):
+    """
+    A request as the server received it. 'params' holds the query string's parameters
+    and the form-encoded or multipart body's, the latter decompressed if it was gzipped
+    (which 'compressed' records).
+    """
+
+    def __init__(self, method, path, headers, body, connection):
+        self.method = method
+        self.path, _, query = path.partition('?')
+        self.url = path
+        self.headers = headers
+        self.body = body
+        self.connection = connection
+        self.compressed = headers.get('Content-Encoding') == 'gzip'
+
+        if self.compressed:
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+
+        self.params = dict(urlparse.parse_qsl(query))
+        content_type = headers.get('Content-Type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            self.params.update(urlparse.parse_qsl(body))
+        elif content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(fp=StringIO(body), environ={'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body))})
+            self.params.update((key, form[key].value) for key in form.keys())
+
+class ScriptedServer(object):
+    """
+    Runs on 127.0.0.1 on a background thread while used as a context manager. 'url' is
+    its address, 'requests' the ScriptedRequests it has received, in order, and
+    'connections' the number of connections clients have opened to it.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.url = None
+        self.requests = []
+        self.connections = 0
+        self._server = None
+
+    def __enter__(self):
+        self._server = _HTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.scripted = self
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+        # a short poll interval, since the server is stopped after every test
+        thread = threading.Thread(target=self._server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.stopped = True
+        self._server.shutdown()
+        self._server.server_close()
+        self._server.close_connections()
+
+    def paths(self):
+        return [request.path for request in self.requests]
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    stopped = False
+
+    # kept on the class, since module globals are cleared while the interpreter exits
+    _exc_info = staticmethod(sys.exc_info)
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        # the open keep-alive connections, and the threads serving them
+        self.open_connections = {}
+        self.lock = threading.Lock()
+
+    def close_connections(self):
+        # closes the clients' connections and waits for their threads, so that none are
+        # left running while the interpreter exits
+        with self.lock:
+            connections = self.open_connections.items()
+        for connection, thread in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for connection, thread in connections:
+            thread.join(1.0)
+
+    def handle_error(self, request, client_address):
+        # connections the tests cut, or that clients drop, aren't worth a traceback
+        if not self.stopped and not isinstance(self._exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.open_connections[self.connection] = threading.current_thread()
+            self.server.scripted.connections += 1
+
+    def finish(self):
+        with self.server.lock:
+            self.server.open_connections.pop(self.connection, None)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self._respond()
+
+    def _respond(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        request = ScriptedRequest(self.command, self.path, self.headers, body, self.connection)
+
+        scripted = self.server.scripted
+        with self.server.lock:
+            scripted.requests.append(request)
+
+        answer = scripted.handler(request)
+        if answer is None:
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+
+        status, headers, content = answer if len(answer) == 3 else (answer[0], {}, answer[1])
+        headers = dict(headers)
+        if not isinstance(content, str):
+            content = simplejson.dumps(content)
+            headers.setdefault('Content-Type', 'application/json')
+
+        # a Content-Length of the handler's own that overstates the body cuts the body short
+        if 'Content-Length' not in headers:
+            headers['Content-Length'] = str(len(content))
+        elif int(headers['Content-Length']) > len(content):
+            self.close_connection = 1
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,385 @@
+"""
+An in-process HTTP server that imitates the parts of Ohmage, FitBit and BodyMedia
+that the clients use, for benchmarking the clients without a network.
+
+StubServer answers on 127.0.0.1 with generated data of configurable size, after an
+optional artificial latency, gzipping it for clients that accept that if 'compress'
+is set. Payloads are generated from a fixed seed and encoded
+once per size, so runs are reproducible and the server does as little work per
+request as possible. It emulates:
+
+/app/user/auth, /app/user/auth_token   any credentials are accepted
+/app/config/read
+/app/campaign/read                     'campaigns' campaigns, each with 'users' participants and a class
+/app/class/read                        a class of the same users
+/app/survey_response/read              'survey_responses' json-rows (or csv) rows, paged by num_to_skip/num_to_process
+                                       and filtered by user_list; json-columns output honors column_list,
+                                       prompt_id_list, suppress_metadata and collapse
+/app/mobility/read                     'mobility_points' points
+/app/mobility/dates/read               the last 'days' days
+/app/survey/upload                     the body is read and discarded
+/oauth/request_token, /oauth/access_token
+/1/user/<user>/activities/steps/date/<date>/<period>.json    FitBit, 'days' days
+/v2/json/step/day/<start>/<end>                              BodyMedia, 'days' days
+"""
+
+import BaseHTTPServer, SocketServer, collections, csv, gzip, random, re, simplejson, socket, sys, threading, time, urlparse
+from cStringIO import StringIO
+from datetime import date as Date, timedelta
+
+class StubServer(object):
+    """
+    A stub server running on a background thread. Use it as a context manager, or
+    call start() and stop(); 'url' is its address once started, and 'requests' counts
+    the requests it has answered, by path.
+    """
+
+    def __init__(self, latency=0.0, survey_responses=500, mobility_points=1000, campaigns=10, days=30, users=20,
+        seed=0, compress=False):
+        self.latency = latency
+        self.users = users
+        self.compress = compress
+        self.survey_responses = survey_responses
+        self.mobility_points = mobility_points
+        self.campaigns = campaigns
+        self.days = days
+        self.seed = seed
+
+        self.url = None
+        self.requests = {}
+        self._server = None
+        self._payloads = {}
+        self._gzipped = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._server = _HTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.stub = self
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stopped = True
+            self._server.shutdown()
+            self._server.server_close()
+            self._server.close_connections()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    # ========================================================
+    # === Routing
+    # ========================================================
+
+    def respond(self, path, params):
+        """
+        Returns (status, content type, body) for a request.
+        """
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path == '/app/user/auth':
+            return self._json({'result': 'success', 'hashed_password': '$2a$04$stubhashedpassword'})
+        if path == '/app/user/auth_token':
+            return self._json({'result': 'success', 'token': 'stub-token', 'campaigns': {}})
+        if path == '/app/config/read':
+            return self._cached('config', self._config)
+        if path == '/app/campaign/read':
+            return self._cached('campaigns', self._campaign_read)
+        if path == '/app/class/read':
+            return self._cached('classes', self._class_read)
+        if path == '/app/survey_response/read':
+            skip = int(params.get('num_to_skip', 0))
+            count = int(params.get('num_to_process', self.survey_responses))
+            user = params.get('user_list', 'urn:ohmage:special:all')
+            generate = lambda: self._survey_response_read(skip, count, user)
+            if params.get('output_format') == 'csv':
+                return self._cached_csv(('responses.csv', skip, count, user), generate)
+            if params.get('output_format') == 'json-columns':
+                layout = tuple(params.get(name) for name in ('column_list', 'prompt_id_list', 'suppress_metadata', 'collapse'))
+                return self._cached(('responses.columns', skip, count, user) + layout,
+                    lambda: self._survey_response_columns(generate(), *layout))
+            return self._cached(('responses', skip, count, user), generate)
+        if path == '/app/mobility/read':
+            return self._cached('mobility', self._mobility_read)
+        if path == '/app/mobility/dates/read':
+            return self._json({'result': 'success', 'data': [d.isoformat() for d in self._dates()]})
+        if path == '/app/survey/upload':
+            return self._json({'result': 'success'})
+
+        if path == '/oauth/request_token':
+            return 200, 'application/x-www-form-urlencoded', 'oauth_token=stub-request&oauth_token_secret=stub-request-secret&oauth_callback_confirmed=true'
+        if path == '/oauth/access_token':
+            return 200, 'application/x-www-form-urlencoded', 'oauth_token=stub-access&oauth_token_secret=stub-access-secret'
+
+        if re.match(r'^/1/user/[^/]+/activities/steps/date/[^/]+/[^/]+\.json$', path):
+            return self._cached('fitbit', self._fitbit_steps)
+        if path.startswith('/v2/json/step/day/'):
+            return self._cached('bodymedia', self._bodymedia_steps)
+
+        return self._json({'result': 'failure', 'errors': [{'code': '0101', 'text': 'Unknown request: %s' % path}]}, status=404)
+
+    def gzipped(self, content):
+        """
+        Returns the gzipped content, compressing each distinct payload only once.
+        """
+        with self._lock:
+            if content not in self._gzipped:
+                buf = StringIO()
+                with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                    f.write(content)
+                self._gzipped[content] = buf.getvalue()
+            return self._gzipped[content]
+
+    def _json(self, value, status=200):
+        return status, 'application/json', simplejson.dumps(value)
+
+    def _cached(self, key, generate):
+        # payloads are generated and encoded once; the server only has to write them out
+        with self._lock:
+            if key not in self._payloads:
+                self._payloads[key] = self._json(generate())
+            return self._payloads[key]
+
+    def _cached_csv(self, key, generate):
+        # renders a json-rows payload the way Ohmage's csv output lays it out
+        with self._lock:
+            if key not in self._payloads:
+                payload = generate()
+                rows = [dict((name, value['prompt_response'] if isinstance(value, dict) else value)
+                    for name, value in row.items()) for row in payload['data']]
+                columns = sorted(rows[0]) if rows else []
+
+                out = StringIO()
+                out.write('## begin metadata\n#%s\n## end metadata\n## begin data\n'
+                    % simplejson.dumps(dict(payload['metadata'], result='success')))
+                writer = csv.writer(out)
+                writer.writerow(columns)
+                for row in rows:
+                    writer.writerow([row[name] for name in columns])
+                out.write('## end data\n')
+
+                self._payloads[key] = (200, 'text/csv', out.getvalue())
+            return self._payloads[key]
+
+    # ========================================================
+    # === Payloads
+    # ========================================================
+
+    def _usernames(self):
+        return ['stub.user.%d' % n for n in range(self.users)]
+
+    def _random(self):
+        return random.Random(self.seed)
+
+    def _dates(self):
+        today = Date.today()
+        return [today - timedelta(days=n) for n in range(self.days, 0, -1)]
+
+    def _config(self):
+        return {'result': 'success', 'data': {
+            'application_name': 'ohmage', 'application_version': '2.10', 'default_survey_response_sharing_state': 'private',
+            'mobility_enabled': True, 'self_registration_allowed': False, 'survey_response_privacy_states': ['private', 'shared'],
+        }}
+
+    def _campaign_read(self):
+        data = {}
+        for n in range(self.campaigns):
+            urn = 'urn:campaign:stub:%d' % n
+            data[urn] = {'name': 'Stub campaign %d' % n, 'description': 'A generated campaign', 'running_state': 'running',
+                'privacy_state': 'shared', 'creation_timestamp': '2012-01-01 00:00:00', 'user_roles': ['participant'],
+                'classes': ['urn:class:stub'], 'user_role_campaign': {'participant': self._usernames()}}
+        return {'result': 'success', 'metadata': {'number_of_results': self.campaigns, 'items': sorted(data)}, 'data': data}
+
+    def _class_read(self):
+        users = dict((user, 'restricted') for user in self._usernames())
+        return {'result': 'success', 'data': {'urn:class:stub': {'name': 'Stub class', 'description': '', 'users': users}}}
+
+    def _survey_response_read(self, skip, count, user):
+        rng = self._random()
+        rows = []
+
+        for n in range(skip, min(skip + count, self.survey_responses)):
+            if user != 'urn:ohmage:special:all' and user != 'stub.user.%d' % (n % self.users):
+                continue
+            day = self._dates()[n % self.days]
+            rows.append({
+                'survey_key': 'stub-response-%08d' % n,
+                'user': 'stub.user.%d' % (n % self.users),
+                'survey_id': 'dailyMood',
+                'timestamp': '%s %02d:%02d:00' % (day.isoformat(), n % 24, n % 60),
+                'utc_timestamp': '%s %02d:%02d:00' % (day.isoformat(), n % 24, n % 60),
+                'timezone': 'America/Los_Angeles',
+                'location_status': 'valid',
+                'latitude': 34.0 + rng.random(), 'longitude': -118.0 + rng.random(),
+                'privacy_state': 'shared',
+                'prompt.mood': {'prompt_response': rng.randint(1, 5), 'prompt_type': 'number'},
+                'prompt.sleep': {'prompt_response': rng.randint(3, 10), 'prompt_type': 'number'},
+                'prompt.notes': {'prompt_response': 'Nothing much to report today', 'prompt_type': 'text'},
+            })
+
+        return {'result': 'success', 'metadata': {'number_of_surveys': self.survey_responses, 'number_of_prompts': 3}, 'data': rows}
+
+    def _survey_response_columns(self, payload, column_list, prompt_id_list, suppress_metadata, collapse):
+        # lays out a json-rows payload the way Ohmage's json-columns output does
+        columns = (column_list or ALL).split(',')
+        if ALL in columns:
+            columns = sorted(_COLUMN_FIELDS) + ['urn:ohmage:prompt:response']
+
+        layout = [(urn, _COLUMN_FIELDS[urn]) for urn in columns if urn in _COLUMN_FIELDS]
+        if 'urn:ohmage:prompt:response' in columns:
+            prompts = _PROMPTS if prompt_id_list in (None, ALL) else prompt_id_list.split(',')
+            layout.extend(('urn:ohmage:prompt:id:' + prompt, 'prompt.' + prompt) for prompt in prompts)
+
+        table = [tuple(_response(row.get(field)) for _, field in layout) for row in payload['data']]
+        if collapse == 'true':
+            table = list(collections.OrderedDict.fromkeys(table))
+
+        data = {}
+        for i, (urn, field) in enumerate(layout):
+            data[urn] = {'values': [row[i] for row in table]}
+            if field.startswith('prompt.') and payload['data'] and field in payload['data'][0]:
+                data[urn]['context'] = {'prompt_type': payload['data'][0][field]['prompt_type']}
+
+        result = {'result': 'success', 'data': data}
+        if suppress_metadata != 'true':
+            result['metadata'] = dict(payload['metadata'], items=[urn for urn, _ in layout])
+        return result
+
+    def _mobility_read(self):
+        rng = self._random()
+        start = int(time.mktime(self._dates()[-1].timetuple())) * 1000
+        points = []
+
+        for n in range(self.mobility_points):
+            points.append({
+                't': start + n * 60000, 'tz': 'America/Los_Angeles', 'm': rng.choice(('still', 'walk', 'run', 'bike', 'drive')),
+                'l': {'la': 34.0 + rng.random(), 'lo': -118.0 + rng.random(), 'ac': 10.0 + rng.random() * 50, 'pr': 'gps'},
+                'ls': 'valid',
+            })
+
+        return {'result': 'success', 'data': points}
+
+    def _fitbit_steps(self):
+        rng = self._random()
+        return {'activities-steps': [{'dateTime': d.isoformat(), 'value': str(rng.randint(0, 20000))} for d in self._dates()]}
+
+    def _bodymedia_steps(self):
+        rng = self._random()
+        days = [{'date': d.strftime('%Y%m%d'), 'totalSteps': rng.randint(0, 20000)} for d in self._dates()]
+        return {'days': days, 'totalSteps': sum(d['totalSteps'] for d in days)}
+
+ALL = 'urn:ohmage:special:all'
+
+# the json-columns column of each field of the generated survey responses
+_COLUMN_FIELDS = {
+    'urn:ohmage:user:id': 'user',
+    'urn:ohmage:survey:id': 'survey_id',
+    'urn:ohmage:context:timestamp': 'timestamp',
+    'urn:ohmage:context:utc_timestamp': 'utc_timestamp',
+    'urn:ohmage:context:timezone': 'timezone',
+    'urn:ohmage:context:location:status': 'location_status',
+    'urn:ohmage:context:location:latitude': 'latitude',
+    'urn:ohmage:context:location:longitude': 'longitude',
+    'urn:ohmage:survey:privacy_state': 'privacy_state',
+}
+_PROMPTS = ['mood', 'sleep', 'notes']
+
+def _response(value):
+    return value['prompt_response'] if isinstance(value, dict) else value
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # kept on the class, since module globals are cleared while the interpreter exits
+    _exc_info = staticmethod(sys.exc_info)
+    _quiet_errors = (socket.error,)
+    stopped = False
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        # the open keep-alive connections, and the threads serving them
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+
+    def close_connections(self):
+        """
+        Closes the clients' keep-alive connections and waits for their threads to finish,
+        so that none are left running while the interpreter exits.
+        """
+        with self.connections_lock:
+            connections = self.connections.items()
+
+        for connection, thread in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for connection, thread in connections:
+            thread.join(1.0)
+
+    def handle_error(self, request, client_address):
+        # clients dropping their idle keep-alive connections isn't worth a traceback,
+        # and neither are connections cut off after the server has been stopped
+        if not self.stopped and not isinstance(self._exc_info()[1], self._quiet_errors):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, like the real servers, and a buffered wfile so that each response goes out
+    # in one write rather than one per header
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 64 * 1024
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.connections_lock:
+            self.server.connections[self.connection] = threading.current_thread()
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.pop(self.connection, None)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self._respond()
+
+    def _respond(self):
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update(urlparse.parse_qsl(body))
+
+        stub = self.server.stub
+        status, content_type, content = stub.respond(path, params)
+
+        self.send_response(status)
+        if stub.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = stub.gzipped(content)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,144 @@
+"""
+Tests for the response caches in ohmagekit.clients.cache, and for OhmageApi's use
+of them.
+"""
+
+import os, shutil, tempfile, threading, unittest
+
+from ohmagekit.clients.cache import LRUCache, DiskCache
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+CAMPAIGNS = ('/campaign/read', 'server', 'alice', ())
+CONFIG = ('/config/read', 'server', None, ())
+
+class CacheBehaviour(object):
+    # the tests both backends must pass; a subclass's _cache() makes one
+
+    def test_values_are_returned_until_they_expire(self):
+        cache = self._cache()
+        cache.set(CAMPAIGNS, {'data': [1]})
+        self.assertEqual(cache.get(CAMPAIGNS), {'data': [1]})
+
+        expired = self._cache(ttl=-1)
+        expired.set(CAMPAIGNS, {'data': [1]})
+        self.assertIsNone(expired.get(CAMPAIGNS))
+        self.assertEqual(expired.stats()['evictions'], 1)
+
+    def test_stats(self):
+        cache = self._cache()
+        cache.get(CAMPAIGNS)
+        cache.set(CAMPAIGNS, 1)
+        cache.get(CAMPAIGNS)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1})
+
+    def test_invalidating_an_endpoint_keeps_the_others(self):
+        cache = self._cache()
+        cache.set(CAMPAIGNS, 1)
+        cache.set(CAMPAIGNS[:2] + ('bob', ()), 2)
+        cache.set(CONFIG, 3)
+
+        cache.invalidate('/campaign/read')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(CONFIG), 3)
+
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+class LRUCacheTest(CacheBehaviour, unittest.TestCase):
+    def _cache(self, ttl=300):
+        return LRUCache(ttl=ttl)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set(('/a',), 1)
+        cache.set(('/b',), 2)
+        cache.get(('/a',))
+        cache.set(('/c',), 3)
+
+        self.assertEqual([cache.get(('/a',)), cache.get(('/b',)), cache.get(('/c',))], [1, None, 3])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+class DiskCacheTest(CacheBehaviour, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _cache(self, ttl=300):
+        return DiskCache(os.path.join(self.directory, 'cache-%d' % ttl), ttl=ttl)
+
+    def test_entries_outlive_the_instance(self):
+        DiskCache(self.directory).set(CAMPAIGNS, {'data': [1]})
+        self.assertEqual(DiskCache(self.directory).get(CAMPAIGNS), {'data': [1]})
+
+    def test_damaged_entries_are_misses(self):
+        cache = DiskCache(self.directory)
+        cache.set(CAMPAIGNS, {'data': [1]})
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name), 'r+b') as f:
+                f.truncate(5)
+
+        self.assertIsNone(cache.get(CAMPAIGNS))
+
+    def test_failed_write_leaves_nothing_behind(self):
+        cache = DiskCache(self.directory)
+        self.assertRaises(Exception, cache.set, CAMPAIGNS, threading.Lock())
+        self.assertEqual(os.listdir(self.directory), [])
+
+class ApiCacheTest(unittest.TestCase):
+    def test_entries_belong_to_the_user_and_password(self):
+        def handler(request):
+            return (200, {'result': 'success', 'data': {'user': request.params['user']}})
+
+        with ScriptedServer(handler) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}), cache=LRUCache())
+            alice = api.campaign_read(user='alice', password='first')
+            self.assertEqual(api.campaign_read(user='alice', password='first'), alice)
+            self.assertEqual(api.campaign_read(user='bob', password='first')['data'], {'user': 'bob'})
+
+        self.assertEqual(len(server.requests), 2)
+
+    def test_entries_outlive_the_tokens_of_their_user(self):
+        def handler(request):
+            if request.path == '/app/user/auth_token':
+                return (200, {'result': 'success', 'token': 'token-%d' % len(server.requests)})
+            return (200, {'result': 'success', 'data': {}})
+
+        with ScriptedServer(handler) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}), cache=LRUCache())
+            api.login('alice', 'secret', doHashedLogin=False)
+            result = api.campaign_read()
+            api.login('alice', 'secret', doHashedLogin=False)
+            self.assertEqual(api.campaign_read(), result)
+
+        self.assertEqual(server.paths(), ['/app/user/auth_token', '/app/campaign/read', '/app/user/auth_token'])
+
+    def test_cached_results_are_not_returned_for_a_wrong_password(self):
+        def handler(request):
+            if request.params['password'] != 'right':
+                return (200, {'result': 'failure', 'errors': [{'code': '0200', 'text': 'bad password'}]})
+            return (200, {'result': 'success', 'data': {}})
+
+        with ScriptedServer(handler) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}), cache=LRUCache())
+            result = api.campaign_read(user='alice', password='right')
+            self.assertRaises(OhmageApi.OhmageApiException, api.campaign_read, user='alice', password='wrong')
+            self.assertEqual(api.campaign_read(user='alice', password='right'), result)
+
+        self.assertEqual(len(server.requests), 2)
+
+    def test_failures_are_not_cached(self):
+        answers = [{'result': 'failure', 'errors': [{'code': '0101', 'text': 'busy'}]}, {'result': 'success', 'data': {}}]
+        with ScriptedServer(lambda request: (200, answers.pop(0))) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}), cache=LRUCache())
+            self.assertRaises(OhmageApi.OhmageApiException, api.config_read)
+            self.assertEqual(api.config_read(), {'result': 'success', 'data': {}})
+            api.config_read()
+
+        self.assertEqual(len(server.requests), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Tests for Checkpoint, and the resumption of bulk uploads from one.
+"""
+
+import os, shutil, simplejson, tempfile, unittest
+
+from ohmagekit.clients.checkpoint import Checkpoint
+from ohmagekit.clients.ohmage import OhmageApi, Survey, Response
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+CAMPAIGN = 'urn:campaign:test'
+CREATED = '2012-01-01 00:00:00'
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _reopen(self):
+        checkpoint = Checkpoint(self.path)
+        self.addCleanup(checkpoint.close)
+        return checkpoint
+
+    def test_keys_are_kept_across_runs(self):
+        checkpoint = self._reopen()
+        checkpoint.add(('a', '1'))
+        checkpoint.add(('b', '2'))
+        checkpoint.add(('a', '1'))
+        checkpoint.close()
+
+        checkpoint = self._reopen()
+        self.assertEqual(len(checkpoint), 2)
+        self.assertTrue(('a', '1') in checkpoint and ('b', '2') in checkpoint)
+        self.assertFalse(('a', '2') in checkpoint)
+
+    def test_keys_added_after_a_cut_off_line_are_readable(self):
+        with open(self.path, 'w') as f:
+            f.write(simplejson.dumps(['a', '1']) + '\n' + simplejson.dumps(['b', '2'])[:-3])
+
+        checkpoint = self._reopen()
+        self.assertEqual(len(checkpoint), 1)
+        checkpoint.add(('c', '3'))
+        checkpoint.close()
+
+        checkpoint = self._reopen()
+        self.assertEqual(len(checkpoint), 2)
+        self.assertTrue(('a', '1') in checkpoint and ('c', '3') in checkpoint)
+
+    def test_pruned_keys_are_forgotten_across_runs(self):
+        checkpoint = self._reopen()
+        for key in [('a', '1'), ('b', '2'), ('a', '3')]:
+            checkpoint.add(key)
+        checkpoint.prune(lambda key: key[0] == 'a')
+        self.assertEqual(len(checkpoint), 1)
+        checkpoint.add(('c', '4'))
+        checkpoint.close()
+
+        checkpoint = self._reopen()
+        self.assertEqual(len(checkpoint), 2)
+        self.assertTrue(('b', '2') in checkpoint and ('c', '4') in checkpoint)
+        self.assertEqual(os.listdir(self.directory), ['checkpoint'])
+
+    def test_adds_after_closing_are_ignored(self):
+        checkpoint = self._reopen()
+        checkpoint.close()
+        checkpoint.add(('a', '1'))
+
+        self.assertEqual(len(self._reopen()), 0)
+
+class BulkUploadResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'uploads')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _photo(self, name):
+        path = os.path.join(self.directory, name + '.jpg')
+        with open(path, 'wb') as f:
+            f.write(name * 100)
+        return path
+
+    def _upload(self, server, ids):
+        surveys = [Survey('photo', 1325376000000, 'UTC', [Response('photo', 'image-' + survey_id)], uuid='key-' + survey_id) for survey_id in ids]
+        attachments = dict(('image-' + survey_id, self._photo(survey_id)) for survey_id in ids)
+        api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+        return api.bulk_survey_upload(CAMPAIGN, surveys, CREATED, user='user', hashedpass='hashed', workers=1,
+            max_bytes=1, attachments=attachments, checkpoint=self.path)
+
+    def test_upload_resumes_with_the_surveys_and_attachments_not_yet_sent(self):
+        def handler(request):
+            ids = [survey['survey_key'] for survey in simplejson.loads(request.params['surveys'])]
+            if 'key-c' in ids:
+                return (200, {'result': 'failure', 'errors': [{'code': '0601', 'text': 'bad survey'}]})
+            return (200, {'result': 'success'})
+
+        with ScriptedServer(handler) as server:
+            results = self._upload(server, ['a', 'b', 'c', 'd'])
+            self.assertEqual([result.ok for result in results], [True, True, False, True])
+
+            # as if the run had been interrupted while checkpointing the last survey
+            with open(self.path, 'r+b') as f:
+                f.truncate(os.path.getsize(self.path) - 5)
+
+            server.handler = lambda request: (200, {'result': 'success'})
+            del server.requests[:]
+            results = self._upload(server, ['a', 'b', 'c', 'd'])
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual([[survey['survey_key'] for survey in simplejson.loads(request.params['surveys'])] for request in server.requests],
+            [['key-c'], ['key-d']])
+        self.assertEqual([sorted(name for name in request.params if name.startswith('image-')) for request in server.requests],
+            [['image-c'], ['image-d']])
+        self.assertEqual(len(Checkpoint(self.path)), 4)
+
+if __name__ == '__main__':
+    unittest.main()
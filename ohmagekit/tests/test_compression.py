@@ -0,0 +1,97 @@
+"""
+Tests for the decoding of gzip- and deflate-encoded responses by ConnectionPool.
+"""
+
+import gzip, unittest, zlib
+from cStringIO import StringIO
+
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+BODY = '{"result": "success", "data": [%s]}' % ', '.join('{"n": %d}' % n for n in range(2000))
+
+def _gzip(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+def _raw_deflate(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+ENCODINGS = {
+    'gzip': _gzip,
+    'x-gzip': _gzip,
+    'deflate': zlib.compress,
+}
+
+def _server(encoding, encode, body=BODY):
+    return ScriptedServer(lambda request: (200, {'Content-Encoding': encoding}, encode(body)))
+
+class ResponseDecodingTest(unittest.TestCase):
+    def test_every_encoding_is_decoded(self):
+        for encoding, encode in ENCODINGS.items() + [('deflate', _raw_deflate)]:
+            with _server(encoding, encode) as server:
+                self.assertEqual(ConnectionPool(proxies={}).request(server.url + '/read').read(), BODY)
+
+    def test_reads_of_any_size_give_the_whole_body(self):
+        for amt in (1, 7, 100, 4096, 1 << 20):
+            with _server('gzip', _gzip) as server:
+                resp = ConnectionPool(proxies={}).request(server.url + '/read')
+                chunks = []
+                while True:
+                    chunk = resp.read(amt)
+                    if not chunk:
+                        break
+                    self.assertTrue(len(chunk) <= amt)
+                    chunks.append(chunk)
+                self.assertEqual(''.join(chunks), BODY)
+
+    def test_compression_is_asked_for_and_counted(self):
+        with _server('gzip', _gzip) as server:
+            pool = ConnectionPool(proxies={})
+            resp = pool.request(server.url + '/read')
+            resp.read()
+
+        self.assertTrue('gzip' in server.requests[0].headers['Accept-Encoding'])
+        self.assertEqual(resp.bytes_received, len(_gzip(BODY)))
+        stats = pool.compression_stats()
+        self.assertEqual((stats['responses_compressed'], stats['response_bytes'], stats['response_bytes_received']),
+            (1, len(BODY), len(_gzip(BODY))))
+
+    def test_compression_can_be_declined(self):
+        with ScriptedServer(lambda request: (200, request.headers.get('Accept-Encoding', ''))) as server:
+            self.assertFalse('gzip' in ConnectionPool(proxies={}, accept_compressed=False).request(server.url + '/read').read())
+
+    def test_connection_is_reused_after_a_compressed_body(self):
+        with _server('gzip', _gzip) as server:
+            pool = ConnectionPool(proxies={})
+            for i in range(3):
+                pool.request(server.url + '/read').read()
+
+        self.assertEqual(server.connections, 1)
+
+    def test_corrupt_body_raises(self):
+        for amt in (None, 16):
+            with _server('gzip', lambda body: _gzip(body)[:20] + 'garbage' * 1000) as server:
+                pool = ConnectionPool(proxies={})
+                with pool.request(server.url + '/read') as resp:
+                    self.assertRaises(zlib.error, resp.read, amt)
+
+                # and the pool carries on, with the connection only if the body was read to its end
+                server.handler = lambda request: (200, 'ok')
+                self.assertEqual(pool.request(server.url + '/read').read(), 'ok')
+
+            self.assertEqual(server.connections, 1 if amt is None else 2)
+
+    def test_api_results_are_decoded(self):
+        with _server('gzip', _gzip) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            self.assertEqual(len(api.config_read()['data']), 2000)
+            rows = api.survey_response_read(auth_token='token', campaign_urn='urn:campaign:test', stream=True)
+            self.assertEqual(sum(1 for row in rows), 2000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+Tests for decoding responses (format detection, JSON backends, CSV, columnar mobility
+data) and for Checkpoint.
+"""
+
+import os, shutil, tempfile, unittest
+
+from ohmagekit.clients import formats, mobility
+from ohmagekit.clients.checkpoint import Checkpoint
+from ohmagekit.clients.ohmage import OhmageApi
+
+class ResponseFormatTest(unittest.TestCase):
+    def test_content_type_decides(self):
+        self.assertEqual(formats.response_format('text/csv; charset=utf-8'), 'csv')
+        self.assertEqual(formats.response_format('text/csv', 'json'), 'csv')
+        self.assertEqual(formats.response_format('application/json', 'csv'), 'json')
+        self.assertEqual(formats.response_format('application/atom+xml'), 'xml')
+
+    def test_generic_content_types_defer_to_output_format(self):
+        self.assertEqual(formats.response_format('text/plain', 'csv'), 'csv')
+        self.assertEqual(formats.response_format('application/octet-stream', 'xml'), 'xml')
+        self.assertEqual(formats.response_format(None, 'json-rows'), 'json')
+        self.assertEqual(formats.response_format(None), 'json')
+
+    def test_html_pages_are_errors(self):
+        self.assertEqual(formats.response_format('text/html; charset=iso-8859-1', 'csv'), 'text')
+
+        page = '<html><body>Please sign in to the network</body></html>'
+        api = OhmageApi('http://127.0.0.1:1')
+        for params in ({'output_format': 'csv'}, None):
+            try:
+                api._handle_response(page, 'text/html', params)
+            except OhmageApi.HTTPException, ex:
+                self.assertEqual((ex.code, ex.body), ('200', page))
+            else:
+                self.fail("HTTPException not raised")
+
+class JSONBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(formats.use_json_backend, formats.json_backend)
+
+    def test_unknown_backends_are_refused(self):
+        backend = formats.json_backend
+        self.assertRaises(ValueError, formats.use_json_backend, 'yaml')
+        self.assertEqual(formats.json_backend, backend)
+
+    def test_switching_backends_and_back(self):
+        backend = formats.json_backend
+        formats.use_json_backend('json')
+        self.assertEqual(formats.json_backend, 'json')
+        self.assertEqual(formats.loads('{"a": [1, 2.5]}'), {'a': [1, 2.5]})
+
+        formats.use_json_backend(backend)
+        self.assertEqual(formats.json_backend, backend)
+        self.assertRaises(ValueError, formats.loads, '{"a": ')
+
+class CSVDecoderTest(unittest.TestCase):
+    def test_rows_and_metadata(self):
+        decoder = formats.CSVDecoder(['#{"result":"success"}\n', 'user,comment\n', '\n',
+            'alice,"hello, world"\n', 'bob,caf\xc3\xa9\n'])
+        self.assertEqual(list(decoder), [{'user': u'alice', 'comment': u'hello, world'}, {'user': u'bob', 'comment': u'caf\xe9'}])
+        self.assertEqual(decoder.metadata, {'result': 'success'})
+
+    def test_errors_in_metadata(self):
+        decoder = formats.CSVDecoder(['#{"result":"failure","errors":[{"code":"0200","text":"bad"}]}\n'])
+        self.assertEqual(list(decoder), [])
+        self.assertEqual(decoder.metadata['errors'][0]['code'], '0200')
+
+    def test_lines_are_split_across_chunks(self):
+        chunks = iter(['user,com', 'ment\nalice,1\n', 'bob,2'])
+        read = lambda size: next(chunks, '')
+        self.assertEqual(list(formats.iter_lines(read)), ['user,comment\n', 'alice,1\n', 'bob,2'])
+
+class DecodeColumnsTest(unittest.TestCase):
+    def setUp(self):
+        if mobility.numpy is None:
+            self.skipTest("NumPy is not installed")
+
+    def test_points_are_decoded_into_columns(self):
+        columns = mobility.decode_columns([
+            {'t': 1325376000000, 'tz': 'UTC', 'm': 'walk', 'l': {'la': 34.1, 'lo': -118.2, 'ac': 5.0}, 'sd': {'sp': 1.5}},
+            {'time': 1325376060000, 'timezone': 'PST', 'mode': 'still'},
+        ])
+        self.assertEqual(list(columns.time), [1325376000000, 1325376060000])
+        self.assertEqual(list(columns.mode), ['walk', 'still'])
+        self.assertEqual(list(columns.timezone), ['UTC', 'PST'])
+        self.assertEqual(columns.latitude[0], 34.1)
+        self.assertTrue(mobility.numpy.isnan(columns.latitude[1]))
+
+    def test_points_without_a_time_are_left_out(self):
+        columns = mobility.decode_columns([{'m': 'walk'}, {'t': 1325376000000, 'm': 'run'}])
+        self.assertEqual(list(columns.time), [1325376000000])
+        self.assertEqual(list(columns.mode), ['run'])
+
+    def test_null_readings_are_nan(self):
+        columns = mobility.decode_columns([{'t': 1, 'l': {'la': None, 'lo': None, 'ac': None}, 'sd': {'sp': None}}])
+        for name in ('latitude', 'longitude', 'accuracy', 'speed'):
+            self.assertTrue(mobility.numpy.isnan(getattr(columns, name)[0]), name)
+
+    def test_parts_are_concatenated_onto_the_union_of_categories(self):
+        monday = mobility.decode_columns([{'t': 1, 'tz': 'PST', 'm': 'walk'}, {'t': 2, 'tz': 'UTC', 'm': 'sail'}])
+        tuesday = mobility.decode_columns([{'t': 3, 'tz': 'UTC', 'm': 'fly', 'l': {'la': 1.5}}, {'t': 4, 'm': 'sail'}])
+        self.assertEqual((monday.timezones, tuesday.timezones), (['PST', 'UTC'], ['UTC']))
+
+        columns = mobility.MobilityColumns.concatenate([monday, tuesday])
+        self.assertEqual(list(columns.time), [1, 2, 3, 4])
+        self.assertEqual(list(columns.mode), ['walk', 'sail', 'fly', 'sail'])
+        self.assertEqual(list(columns.timezone), ['PST', 'UTC', 'UTC', None])
+        self.assertEqual(list(columns.mode_codes), [1, 6, 7, 6])
+        self.assertEqual(list(columns.timezone_codes), [0, 1, 1, -1])
+        self.assertEqual(columns.latitude[2], 1.5)
+
+    def test_no_parts_concatenate_to_empty_columns(self):
+        columns = mobility.MobilityColumns.concatenate([])
+        self.assertEqual(len(columns), 0)
+        self.assertEqual((columns.time.dtype, columns.mode_codes.dtype, columns.timezone_codes.dtype),
+            (mobility.numpy.int64, mobility.numpy.int8, mobility.numpy.int16))
+        self.assertEqual(list(columns.modes), list(mobility.MODES))
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_keys_persist_across_instances(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.add(('campaign', 'a'))
+        checkpoint.add(('campaign', 'a'))
+        checkpoint.close()
+
+        checkpoint = Checkpoint(self.path)
+        self.assertTrue(('campaign', 'a') in checkpoint)
+        self.assertFalse(('campaign', 'b') in checkpoint)
+        self.assertEqual(len(checkpoint), 1)
+        checkpoint.close()
+
+    def test_line_cut_short_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('["campaign", "a"]\n["campaign", "b')
+
+        checkpoint = Checkpoint(self.path)
+        self.assertEqual(len(checkpoint), 1)
+        checkpoint.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Tests for downloading survey responses and mobility data straight to a sink.
+"""
+
+import httplib, os, shutil, tempfile, unittest
+from cStringIO import StringIO
+
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+CAMPAIGN = 'urn:campaign:test'
+CSV = '#{"result":"success"}\nuser,value\n' + ''.join('user%d,%d\n' % (n, n) for n in range(5000))
+FAILURE = '{"result":"failure","errors":[{"code":"0200","text":"bad token"}]}'
+
+def _csv_server(body=CSV, **headers):
+    return ScriptedServer(lambda request: (200, dict(headers, **{'Content-Type': 'text/csv'}), body))
+
+def _api(server):
+    return OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+
+class FailingSink(object):
+    def __init__(self, fail_after):
+        self.written = []
+        self.fail_after = fail_after
+
+    def write(self, data):
+        if len(self.written) == self.fail_after:
+            raise IOError("disk full")
+        self.written.append(data)
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'responses.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _download(self, server, sink, **kwargs):
+        return _api(server).survey_response_read(auth_token='token', campaign_urn=CAMPAIGN, output_format='csv', sink=sink, **kwargs)
+
+    def test_body_is_written_to_a_path(self):
+        with _csv_server() as server:
+            result = self._download(server, self.path)
+
+        with open(self.path) as f:
+            self.assertEqual(f.read(), CSV)
+        self.assertEqual(result, {'bytes': len(CSV), 'content_type': 'text/csv', 'format': 'csv', 'path': self.path})
+        self.assertEqual(os.listdir(self.directory), ['responses.csv'])
+
+    def test_body_is_written_to_a_file(self):
+        sink = StringIO()
+        with ScriptedServer(lambda request: (200, '{"result":"success","data":[]}')) as server:
+            result = _api(server).mobility_read(auth_token='token', date='2012-01-01', sink=sink)
+
+        self.assertEqual(sink.getvalue(), '{"result":"success","data":[]}')
+        self.assertEqual((result['format'], result['path']), ('json', None))
+
+    def test_error_envelope_is_raised_and_nothing_written(self):
+        with ScriptedServer(lambda request: (200, FAILURE)) as server:
+            self.assertRaises(OhmageApi.OhmageApiException, self._download, server, self.path)
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_expired_token_is_replaced(self):
+        def handler(request):
+            if request.path == '/app/user/auth_token':
+                return (200, {'result': 'success', 'token': 'token-%d' % len(server.requests)})
+            return (200, FAILURE) if request.params['auth_token'] == 'token-1' else (200, {'Content-Type': 'text/csv'}, CSV)
+
+        with ScriptedServer(handler) as server:
+            api = _api(server)
+            api.login('user', 'secret', doHashedLogin=False)
+            api.survey_response_read(campaign_urn=CAMPAIGN, output_format='csv', sink=self.path)
+
+        self.assertEqual([request.params['auth_token'] for request in server.requests if request.path == '/app/survey_response/read'],
+            ['token-1', 'token-3'])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), CSV)
+
+    def test_missing_directory_raises_its_own_error(self):
+        with _csv_server() as server:
+            self.assertRaises(OSError, self._download, server, os.path.join(self.directory, 'missing', 'responses.csv'))
+
+    def test_cut_off_body_leaves_the_previous_file_in_place(self):
+        with open(self.path, 'w') as f:
+            f.write('previous')
+
+        with _csv_server(CSV[:len(CSV) // 2], **{'Content-Length': str(len(CSV))}) as server:
+            self.assertRaises(httplib.IncompleteRead, self._download, server, self.path)
+
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'previous')
+        self.assertEqual(os.listdir(self.directory), ['responses.csv'])
+
+    def test_failing_sink_raises_and_the_pool_carries_on(self):
+        with _csv_server() as server:
+            sink = FailingSink(fail_after=1)
+            self.assertRaises(IOError, self._download, server, sink)
+            self.assertEqual(len(sink.written), 1)
+
+            result = self._download(server, StringIO())
+            self.assertEqual(result['bytes'], len(CSV))
+
+if __name__ == '__main__':
+    unittest.main()
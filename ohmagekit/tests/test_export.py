@@ -0,0 +1,157 @@
+"""
+Tests for the bulk export in ohmagekit.export, and its resumption from the checkpoint.
+"""
+
+import os, shutil, simplejson, tempfile, unittest
+from datetime import date as Date
+
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.export import Exporter
+from ohmagekit.tests.scripted import ScriptedServer
+
+CAMPAIGN = 'urn:campaign:test'
+CLASS = 'urn:class:test'
+TODAY = Date.today().isoformat()
+DAYS = ['2012-01-01', '2012-01-02', TODAY]
+
+def _rows(user):
+    return [{'survey_key': '%s-%d' % (user, n), 'user': user, 'timestamp': '2012-01-0%d 09:00:00' % n} for n in (1, 2)]
+
+class ExportServer(ScriptedServer):
+    """
+    A campaign with alice and bob as participants and carol through its class, each with
+    two survey responses and mobility data on DAYS. Reads of the users in 'failing', and
+    of the mobility days in 'failing', are answered with an error.
+    """
+
+    def __init__(self):
+        ScriptedServer.__init__(self, self._answer)
+        self.failing = set()
+
+    def _answer(self, request):
+        if request.path == '/app/campaign/read':
+            return (200, {'result': 'success', 'data': {CAMPAIGN: {
+                'user_role_campaign': {'participant': ['alice', 'bob']}, 'classes': [CLASS]}}})
+        if request.path == '/app/class/read':
+            return (200, {'result': 'success', 'data': {CLASS: {'users': {'carol': 'restricted'}}}})
+        if request.path == '/app/survey_response/read':
+            user = request.params['user_list']
+            if user in self.failing:
+                return (500, 'unavailable')
+            return (200, {'result': 'success', 'data': _rows(user)})
+        if request.path == '/app/mobility/dates/read':
+            return (200, {'result': 'success', 'data': DAYS})
+
+        day = request.params['date']
+        if day in self.failing:
+            return (500, 'unavailable')
+        return (200, {'result': 'success', 'data': [{'day': day, 'user': request.params['username']}]})
+
+    def reads(self):
+        # the survey responses and mobility days read, and forgets them
+        responses = sorted(request.params['user_list'] for request in self.requests if request.path == '/app/survey_response/read')
+        mobility = sorted((request.params['username'], request.params['date'])
+            for request in self.requests if request.path == '/app/mobility/read')
+        del self.requests[:]
+        return responses, mobility
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _export(self, server, fresh=False, **kwargs):
+        api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+        api.auth_token = 'token'
+        return Exporter(api, self.directory, progress_interval=0, log=None, **kwargs).run(fresh=fresh)
+
+    def _files(self):
+        found = []
+        for root, dirs, files in os.walk(self.directory):
+            found.extend(os.path.relpath(os.path.join(root, name), self.directory) for name in files)
+        return sorted(found)
+
+    def test_everything_is_exported_by_campaign_user_and_date(self):
+        with ExportServer() as server:
+            stats = self._export(server)
+
+        campaign = os.path.join('campaigns', 'urn%3Acampaign%3Atest')
+        self.assertEqual(self._files(), sorted(['checkpoint'] +
+            [os.path.join(campaign, day, user + '.jsonl') for day in DAYS[:2] for user in ('alice', 'bob', 'carol')] +
+            [os.path.join('mobility', day, user + '.json') for day in DAYS for user in ('alice', 'bob', 'carol')]))
+
+        with open(os.path.join(self.directory, campaign, '2012-01-02', 'bob.jsonl')) as f:
+            self.assertEqual([simplejson.loads(line) for line in f], _rows('bob')[1:])
+        with open(os.path.join(self.directory, 'mobility', TODAY, 'carol.json')) as f:
+            self.assertEqual(simplejson.load(f)['data'], [{'day': TODAY, 'user': 'carol'}])
+
+        self.assertEqual((stats.jobs_total, stats.jobs_done, stats.jobs_failed, stats.responses, stats.mobility_days), (6, 6, 0, 6, 9))
+
+    def test_next_run_reads_responses_and_only_todays_mobility_again(self):
+        with ExportServer() as server:
+            self._export(server)
+            server.reads()
+            stats = self._export(server)
+
+            self.assertEqual(server.reads(), (['alice', 'bob', 'carol'], [('alice', TODAY), ('bob', TODAY), ('carol', TODAY)]))
+            self.assertEqual((stats.jobs_skipped, stats.jobs_done), (0, 6))
+
+            # unless the checkpoint is set aside
+            self._export(server, fresh=True)
+            responses, mobility = server.reads()
+
+        self.assertEqual((len(responses), len(mobility)), (3, 9))
+
+    def test_failed_jobs_are_counted_and_redone_by_the_next_run(self):
+        with ExportServer() as server:
+            server.failing.update(['bob', '2012-01-02'])
+            stats = self._export(server, workers=1)
+            self.assertEqual(stats.jobs_failed, 4)
+            self.assertFalse(os.path.exists(os.path.join(self.directory, 'campaigns', 'urn%3Acampaign%3Atest', '2012-01-01', 'bob.jsonl')))
+            server.reads()
+
+            server.failing.clear()
+            stats = self._export(server, workers=1)
+            responses, mobility = server.reads()
+
+        # each user's mobility stopped at the failed day, so it and those after it are read
+        self.assertEqual(responses, ['bob'])
+        self.assertEqual(mobility, sorted((user, day) for user in ('alice', 'bob', 'carol') for day in DAYS[1:]))
+        self.assertEqual((stats.jobs_skipped, stats.jobs_done, stats.jobs_failed), (2, 4, 0))
+
+        # with nothing left to resume, the responses are no longer checkpointed
+        with ExportServer() as server:
+            self._export(server, workers=1)
+            self.assertEqual(server.reads()[0], ['alice', 'bob', 'carol'])
+
+    def test_responses_are_read_in_time_order_and_split_by_day(self):
+        # out of order all the same, so a day's file is written to again after another's
+        rows = [{'survey_key': str(n), 'user': 'alice', 'timestamp': '2012-01-%02d 09:00:00' % day}
+            for n, day in enumerate([1, 2, 1, 3, 2])]
+        with ExportServer() as server:
+            server.handler = lambda request: (200, {'result': 'success', 'data': rows}
+                ) if request.path == '/app/survey_response/read' else server._answer(request)
+            self._export(server, mobility=False, workers=1)
+            self.assertEqual(server.requests[-1].params['sort_order'], 'user,timestamp,survey')
+
+        directory = os.path.join(self.directory, 'campaigns', 'urn%3Acampaign%3Atest')
+        for day, keys in (('2012-01-01', ['0', '2']), ('2012-01-02', ['1', '4']), ('2012-01-03', ['3'])):
+            with open(os.path.join(directory, day, 'alice.jsonl')) as f:
+                self.assertEqual([simplejson.loads(line)['survey_key'] for line in f], keys)
+        self.assertEqual(sorted(os.listdir(directory)), ['2012-01-01', '2012-01-02', '2012-01-03'])
+        self.assertEqual(sorted(os.listdir(os.path.join(directory, '2012-01-01'))), ['alice.jsonl', 'bob.jsonl', 'carol.jsonl'])
+
+    def test_cut_off_responses_leave_no_files(self):
+        with ExportServer() as server:
+            server.handler = lambda request: (200, simplejson.dumps({'result': 'success', 'data': _rows('alice')})[:-10]
+                ) if request.path == '/app/survey_response/read' else server._answer(request)
+            stats = self._export(server, mobility=False)
+
+        self.assertEqual(stats.jobs_failed, 3)
+        self.assertEqual(self._files(), ['checkpoint'])
+
+if __name__ == '__main__':
+    unittest.main()
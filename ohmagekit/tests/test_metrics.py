@@ -0,0 +1,124 @@
+"""
+Tests for request instrumentation: the RequestEvents handles send their observers,
+and LatencyStats.
+"""
+
+import unittest
+
+from ohmagekit.clients.metrics import RequestEvent, LatencyStats, percentile
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.retry import RetryPolicy
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+SUCCESS = {'result': 'success', 'data': [1, 2, 3]}
+
+def _api(server):
+    api = OhmageApi(server.url, pool=ConnectionPool(proxies={}), coalesce=())
+    events = []
+    api.add_observer(events.append)
+    return api, events
+
+class ObserverTest(unittest.TestCase):
+    def test_each_request_sends_one_event(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            api, events = _api(server)
+            api.config_read()
+            api.campaign_read(auth_token='token')
+
+        self.assertEqual([(event.service, event.endpoint, event.method, event.status, event.attempts) for event in events],
+            [('OhmageApi', '/config/read', 'GET', 200, 1), ('OhmageApi', '/campaign/read', 'POST', 200, 1)])
+
+        event = events[1]
+        self.assertIsNone(event.error)
+        self.assertTrue(event.bytes_sent > 0 and event.bytes_received > 0)
+        for phase in ('connect', 'first_byte', 'download', 'parse'):
+            self.assertTrue(0 <= getattr(event, phase) <= event.total)
+        self.assertEqual(events[1].connect, 0)
+
+    def test_retries_are_counted(self):
+        statuses = [503, 200]
+        with ScriptedServer(lambda request: (statuses.pop(0), SUCCESS)) as server:
+            api, events = _api(server)
+            api.retry_policy = RetryPolicy(max_attempts=3, base_delay=0.001)
+            api.config_read()
+
+        self.assertEqual([(event.status, event.attempts) for event in events], [(200, 2)])
+
+    def test_failures_are_reported(self):
+        failure = {'result': 'failure', 'errors': [{'code': '0200', 'text': 'bad'}]}
+        with ScriptedServer(lambda request: (500, 'oops') if request.path == '/app/config/read' else (200, failure)) as server:
+            api, events = _api(server)
+            self.assertRaises(OhmageApi.HTTPException, api.config_read)
+            self.assertRaises(OhmageApi.OhmageApiException, api.campaign_read, auth_token='token')
+
+        self.assertEqual([(event.status, type(event.error)) for event in events],
+            [(500, OhmageApi.HTTPException), (200, OhmageApi.OhmageApiException)])
+
+    def test_unreachable_server_is_reported(self):
+        api, events = _api(ScriptedServer(None))
+        api.server = 'http://127.0.0.1:1'
+        self.assertRaises(Exception, api.config_read)
+
+        self.assertEqual(len(events), 1)
+        self.assertIsNone(events[0].status)
+        self.assertIsNotNone(events[0].error)
+        self.assertEqual(events[0].endpoint, '/config/read')
+
+    def test_streamed_reads_are_reported_once_consumed(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            api, events = _api(server)
+            rows = api.survey_response_read(auth_token='token', campaign_urn='urn:campaign:test', stream=True)
+            self.assertEqual(events, [])
+            self.assertEqual(list(rows), [1, 2, 3])
+
+        self.assertEqual([(event.endpoint, event.status) for event in events], [('/survey_response/read', 200)])
+
+    def test_removed_observers_get_nothing(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            api, events = _api(server)
+            api.remove_observer(events.append)
+            api.config_read()
+
+        self.assertEqual(events, [])
+
+class LatencyStatsTest(unittest.TestCase):
+    def test_percentiles(self):
+        values = range(1, 101)
+        self.assertEqual([percentile(values, pct) for pct in (0, 50, 95, 99, 100)], [1, 50, 95, 99, 100])
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_summary_by_endpoint(self):
+        stats = LatencyStats()
+        for total in (0.1, 0.2, 0.3):
+            stats(RequestEvent(service='OhmageApi', endpoint='/config/read', total=total, bytes_received=10))
+        stats(RequestEvent(service='OhmageApi', endpoint='/campaign/read', error=ValueError(), total=None))
+
+        summary = stats.summary()
+        self.assertEqual(summary[('OhmageApi', '/config/read')], {'count': 3, 'errors': 0, 'bytes_received': 30,
+            'p50': 0.2, 'p95': 0.3, 'p99': 0.3})
+        self.assertEqual(summary[('OhmageApi', '/campaign/read')]['errors'], 1)
+        self.assertTrue(stats.report().splitlines()[1].startswith('OhmageApi /config/read'))
+
+        stats.reset()
+        self.assertEqual(stats.summary(), {})
+
+    def test_only_the_latest_samples_are_kept(self):
+        stats = LatencyStats(max_samples=2)
+        for total in (9.0, 1.0, 1.0):
+            stats(RequestEvent(service='OhmageApi', endpoint='/config/read', total=total))
+
+        self.assertEqual(stats.summary()[('OhmageApi', '/config/read')]['p99'], 1.0)
+
+    def test_observes_a_handle(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            stats = LatencyStats()
+            api.add_observer(stats)
+            for i in range(3):
+                api.config_read()
+
+        self.assertEqual(stats.summary()[('OhmageApi', '/config/read')]['count'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+Tests for OhmageApi.mobility_read_range() and the MobilityDayCache it keeps.
+"""
+
+import os, shutil, tempfile, threading, unittest
+from datetime import date as Date
+
+from ohmagekit.clients.mobility import MobilityDayCache
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+TODAY = Date.today().isoformat()
+PAST = ['2012-01-01', '2012-01-02', '2012-01-05']
+
+def _points(day):
+    return [{'t': 1325376000000, 'm': 'still', 'day': day}]
+
+class MobilityServer(ScriptedServer):
+    """
+    Has data for the given days; reads of the days in 'failing' are answered with an error.
+    """
+
+    def __init__(self, days):
+        ScriptedServer.__init__(self, self._answer)
+        self.days = days
+        self.failing = set()
+
+    def _answer(self, request):
+        if request.path == '/app/mobility/dates/read':
+            return (200, {'result': 'success', 'data': list(reversed(self.days))})
+        day = request.params['date']
+        if day in self.failing:
+            return (500, 'unavailable')
+        return (200, {'result': 'success', 'data': _points(day)})
+
+    def days_read(self):
+        return sorted(request.params['date'] for request in self.requests if request.path == '/app/mobility/read')
+
+class RangeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self, server, **kwargs):
+        api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+        return api.mobility_read_range(username='alice', start_date='2012-01-01', end_date=TODAY, auth_token='token', **kwargs)
+
+    def test_every_day_with_data_is_read_in_order(self):
+        with MobilityServer(PAST + [TODAY]) as server:
+            days = self._read(server)
+
+        self.assertEqual(days.keys(), PAST + [TODAY])
+        self.assertEqual(days['2012-01-02'], _points('2012-01-02'))
+        self.assertEqual(server.requests[0].params['username'], 'alice')
+
+    def test_past_days_are_read_from_the_cache_and_today_again(self):
+        with MobilityServer(PAST + [TODAY]) as server:
+            first = self._read(server, day_cache=self.directory)
+            second = self._read(server, day_cache=self.directory)
+
+        self.assertEqual(first, second)
+        self.assertEqual(server.days_read(), sorted(PAST + [TODAY, TODAY]))
+
+    def test_failed_read_raises_and_the_next_call_reads_only_what_is_missing(self):
+        with MobilityServer(PAST) as server:
+            server.failing.add('2012-01-02')
+            self.assertRaises(OhmageApi.HTTPException, self._read, server, day_cache=self.directory, workers=1)
+
+            server.failing.clear()
+            del server.requests[:]
+            days = self._read(server, day_cache=self.directory)
+
+        self.assertEqual(days.keys(), PAST)
+        self.assertEqual(server.days_read(), ['2012-01-02'])
+
+    def test_nothing_is_cached_without_a_user(self):
+        with MobilityServer(PAST) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            api.mobility_read_range(start_date='2012-01-01', end_date='2012-01-31', day_cache=self.directory, auth_token='token')
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+class DayCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = MobilityDayCache(os.path.join(self.directory, 'days'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_days_are_stored_by_server_user_date_and_sensor_data(self):
+        self.cache.put('server', 'alice', '2012-01-01', False, _points('2012-01-01'))
+
+        self.assertEqual(MobilityDayCache(self.cache.directory).get('server', 'alice', '2012-01-01', False), _points('2012-01-01'))
+        for key in (('other', 'alice', '2012-01-01', False), ('server', 'bob', '2012-01-01', False),
+                ('server', 'alice', '2012-01-02', False), ('server', 'alice', '2012-01-01', True)):
+            self.assertIsNone(self.cache.get(*key))
+
+    def test_damaged_days_are_misses(self):
+        self.cache.put('server', 'alice', '2012-01-01', False, _points('2012-01-01') * 100)
+        path = self.cache._path('server', 'alice', '2012-01-01', False)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) // 2)
+
+        self.assertIsNone(self.cache.get('server', 'alice', '2012-01-01', False))
+
+    def test_failed_write_leaves_nothing_behind(self):
+        self.assertRaises(TypeError, self.cache.put, 'server', 'alice', '2012-01-01', False, [threading.Lock()])
+        path = self.cache._path('server', 'alice', '2012-01-01', False)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,371 @@
+"""
+Tests for OhmageApi: logging in and refreshing tokens, bulk uploads, caching and
+coalescing of reads, paging, and the asynchronous wrappers.
+"""
+
+import os, shutil, simplejson, tempfile, threading, time, unittest
+
+from ohmagekit.clients.cache import LRUCache
+from ohmagekit.clients.ohmage import OhmageApi, AsyncOhmageApi, Batch, REQUEST_METHODS, Survey, Response
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+CAMPAIGN = 'urn:campaign:test'
+CREATED = '2012-01-01 00:00:00'
+SUCCESS = {'result': 'success', 'data': {}}
+
+def _failure(code):
+    return {'result': 'failure', 'errors': [{'code': code, 'text': 'error %s' % code}]}
+
+def _api(server, **kwargs):
+    return OhmageApi(server.url, pool=kwargs.pop('pool', None) or ConnectionPool(proxies={}), **kwargs)
+
+def _surveys(*ids):
+    return [Survey(survey_id, 1325376000000, 'UTC', [Response('prompt', 1)], uuid='key-%s' % survey_id) for survey_id in ids]
+
+def _bulk_upload(api, ids, **kwargs):
+    return api.bulk_survey_upload(CAMPAIGN, _surveys(*ids), CREATED, user='user', hashedpass='hashed', **kwargs)
+
+def _uploaded(request):
+    # the survey ids in an upload request
+    return [survey['survey_id'] for survey in simplejson.loads(request.params['surveys'])]
+
+class LoginTest(unittest.TestCase):
+    def _server(self, password='secret'):
+        def handler(request):
+            if request.params.get('password') not in (password, 'hashed'):
+                return (200, _failure('0200'))
+            if request.path == '/app/user/auth':
+                return (200, {'result': 'success', 'hashed_password': 'hashed'})
+            if request.path == '/app/user/auth_token':
+                return (200, {'result': 'success', 'token': 'token-%d' % len(server.requests)})
+            return (200, SUCCESS)
+
+        server = ScriptedServer(handler)
+        return server
+
+    def test_login_stores_credentials(self):
+        with self._server() as server:
+            api = _api(server)
+            api.login('user', 'secret')
+            self.assertTrue(api.is_authenticated() and api.is_authenticated(forToken=True))
+
+            api.survey_upload(campaign_urn=CAMPAIGN, campaign_creation_timestamp=CREATED, surveys=[])
+            self.assertEqual(server.requests[-1].params['password'], 'hashed')
+
+    def test_failed_login_stores_nothing(self):
+        with self._server() as server:
+            api = _api(server)
+            api.login('user', 'secret')
+            self.assertRaises(OhmageApi.OhmageApiException, api.login, 'user', 'wrong')
+
+        self.assertFalse(api.is_authenticated() or api.is_authenticated(forToken=True))
+        for name in ('auth_username', 'credentials', 'auth_token', 'auth_hashedpass'):
+            self.assertFalse(hasattr(api, name))
+
+    def test_expired_token_is_replaced_and_the_request_retried(self):
+        expired = set()
+
+        def handler(request):
+            if request.path == '/app/user/auth_token':
+                return (200, {'result': 'success', 'token': 'token-%d' % len(server.requests)})
+            if request.params['auth_token'] in expired:
+                return (200, _failure('0200'))
+            expired.add(request.params['auth_token'])
+            return (200, SUCCESS)
+
+        with ScriptedServer(handler) as server:
+            api = _api(server)
+            api.login('user', 'secret', doHashedLogin=False)
+            api.campaign_read()
+            api.campaign_read()
+
+        self.assertEqual(server.paths(), ['/app/user/auth_token', '/app/campaign/read', '/app/campaign/read',
+            '/app/user/auth_token', '/app/campaign/read'])
+
+    def test_failed_refresh_is_shared_by_every_caller(self):
+        state = {'password': 'secret'}
+
+        def handler(request):
+            if request.path == '/app/user/auth_token':
+                if request.params['password'] != state['password']:
+                    # slow, so that the other callers are waiting for this refresh
+                    time.sleep(0.1)
+                    return (200, _failure('0200'))
+                return (200, {'result': 'success', 'token': 'token'})
+            return (200, _failure('0200'))
+
+        with ScriptedServer(handler) as server:
+            api = _api(server, coalesce=set())
+            api.login('user', 'secret', doHashedLogin=False)
+
+            # the token expires just as the password is changed elsewhere
+            state['password'] = 'changed'
+            errors = []
+            def read():
+                try:
+                    api.campaign_read()
+                except OhmageApi.OhmageApiException, ex:
+                    errors.append(ex)
+            threads = [threading.Thread(target=read) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(errors), 10)
+            self.assertEqual(server.paths().count('/app/user/auth_token'), 2)
+
+    def test_rejected_token_not_issued_by_login_is_raised(self):
+        with ScriptedServer(lambda request: (200, _failure('0200'))) as server:
+            self.assertRaises(OhmageApi.OhmageApiException, _api(server).campaign_read, auth_token='mine')
+
+        self.assertEqual(len(server.requests), 1)
+
+class BulkUploadTest(unittest.TestCase):
+    def test_rejected_batches_are_split_until_the_bad_surveys_are_found(self):
+        def handler(request):
+            return (200, _failure('0601') if 'bad' in _uploaded(request) else SUCCESS)
+
+        with ScriptedServer(handler) as server:
+            results = _bulk_upload(_api(server), ['a', 'b', 'bad', 'c'])
+
+        self.assertEqual([result.ok for result in results], [True, True, False, True])
+        self.assertEqual(results[2].error.codes(), [601])
+
+    def test_errors_about_the_whole_request_are_raised_without_splitting(self):
+        with ScriptedServer(lambda request: (200, _failure('0200'))) as server:
+            self.assertRaises(OhmageApi.OhmageApiException, _bulk_upload, _api(server), ['a', 'b', 'c', 'd'], max_bytes=1, workers=1)
+
+        self.assertEqual(len(server.requests), 1)
+
+    def test_upload_refused_while_compressed_is_sent_plain(self):
+        def handler(request):
+            if request.compressed:
+                return (200, _failure('0102'))
+            return (200, _failure('0601') if 'bad' in _uploaded(request) else SUCCESS)
+
+        with ScriptedServer(handler) as server:
+            api = _api(server, pool=ConnectionPool(proxies={}, compress_requests_over=100))
+            results = _bulk_upload(api, ['a', 'bad'])
+
+        self.assertEqual([result.ok for result in results], [True, False])
+        self.assertEqual([request.compressed for request in server.requests], [True, False, False, False])
+
+    def test_compressed_upload_refused_for_its_credentials_or_campaign_is_not_resent(self):
+        for code in ('0200', '0700'):
+            with ScriptedServer(lambda request: (200, _failure(code) if request.params['password'] == 'wrong' else SUCCESS)) as server:
+                api = _api(server, pool=ConnectionPool(proxies={}, compress_requests_over=100))
+                self.assertRaises(OhmageApi.OhmageApiException, api.survey_upload, 'user', 'wrong', CAMPAIGN, CREATED, _surveys('a'))
+                api.survey_upload('user', 'hashed', CAMPAIGN, CREATED, _surveys('a'))
+
+            # and the later upload is still compressed
+            self.assertEqual([request.compressed for request in server.requests], [True, True])
+
+    def test_checkpointed_surveys_are_skipped(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'uploads')
+        try:
+            with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+                _bulk_upload(_api(server), ['a', 'b'], checkpoint=path)
+                results = _bulk_upload(_api(server), ['a', 'b', 'c'], checkpoint=path)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual([_uploaded(request) for request in server.requests], [['a', 'b'], ['c']])
+
+    def test_attachments_are_sent_as_parts(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'photo.jpg')
+        with open(path, 'wb') as f:
+            f.write('jpeg' * 1000)
+        try:
+            survey = Survey('photo', 1325376000000, 'UTC', [Response('photo', 'image-uuid')])
+            with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+                _api(server).survey_upload('user', 'hashed', CAMPAIGN, CREATED, surveys=[survey], attachments={'image-uuid': path})
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(server.requests[0].params['image-uuid'], 'jpeg' * 1000)
+
+    def test_missing_surveys_are_sent_as_null(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            _api(server).survey_upload('user', 'hashed', CAMPAIGN, CREATED)
+
+        self.assertEqual(server.requests[0].params['surveys'], 'null')
+
+class ReadTest(unittest.TestCase):
+    def test_cached_results_are_reused_until_an_upload(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            api = _api(server, cache=LRUCache())
+            for i in range(2):
+                api.config_read()
+                api.campaign_read(auth_token='token')
+            api.survey_upload('user', 'hashed', CAMPAIGN, CREATED, surveys=[])
+            api.campaign_read(auth_token='token')
+
+        self.assertEqual(server.paths(), ['/app/config/read', '/app/campaign/read', '/app/survey/upload', '/app/campaign/read'])
+
+    def test_concurrent_identical_reads_share_a_request(self):
+        release = threading.Event()
+
+        def handler(request):
+            release.wait(2)
+            return (200, SUCCESS)
+
+        with ScriptedServer(handler) as server:
+            api = _api(server)
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(api.campaign_read(auth_token='token'))) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_survey_responses_are_paged_as_they_are_consumed(self):
+        def handler(request):
+            skip, count = int(request.params['num_to_skip']), int(request.params['num_to_process'])
+            return (200, {'result': 'success', 'data': [{'n': n} for n in range(skip, min(skip + count, 5))]})
+
+        with ScriptedServer(handler) as server:
+            rows = _api(server).iter_survey_responses(CAMPAIGN, page_size=2, auth_token='token')
+            first = rows.next()
+            time.sleep(0.1)
+            self.assertEqual(sorted(request.params['num_to_skip'] for request in server.requests), ['0', '2'])
+            rest = list(rows)
+
+        self.assertEqual([row['n'] for row in [first] + rest], range(5))
+
+    def test_csv_responses_are_decoded_into_rows(self):
+        body = '#{"result":"success","metadata":{"number_of_surveys":2}}\nuser,value\nalice,1\nbob,2\n'
+        with ScriptedServer(lambda request: (200, {'Content-Type': 'text/csv'}, body)) as server:
+            result = _api(server).survey_response_read(auth_token='token', campaign_urn=CAMPAIGN, output_format='csv')
+
+        self.assertEqual(result['data'], [{'user': 'alice', 'value': '1'}, {'user': 'bob', 'value': '2'}])
+        self.assertEqual(result['metadata']['metadata'], {'number_of_surveys': 2})
+
+class AsyncTest(unittest.TestCase):
+    def test_every_request_method_is_wrapped(self):
+        for name in REQUEST_METHODS:
+            self.assertTrue(hasattr(OhmageApi, name))
+            self.assertTrue(hasattr(AsyncOhmageApi, name))
+            self.assertTrue(hasattr(Batch, name))
+
+    def test_calls_return_futures(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            api = AsyncOhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            try:
+                futures = [api.config_read(), api.campaign_read(auth_token='token')]
+                self.assertEqual([future.result() for future in futures], [SUCCESS, SUCCESS])
+
+                with api.batch() as batch:
+                    dates = batch.mobility_dates_read(auth_token='token')
+                self.assertEqual(dates.result(), SUCCESS)
+            finally:
+                api.close()
+
+    def _gather_server(self):
+        # answers each read with the campaign, user and date it asked for; bob's reads fail
+        def handler(request):
+            user = request.params.get('user_list') or request.params.get('username')
+            if user == 'bob':
+                return (200, _failure('0700'))
+            return (200, {'result': 'success', 'data': [{'campaign_urn': request.params.get('campaign_urn'), 'date': request.params.get('date'), 'user': user}]})
+        return ScriptedServer(handler)
+
+    def test_gathered_survey_responses_are_keyed_by_user(self):
+        with self._gather_server() as server:
+            with AsyncOhmageApi(server.url, max_concurrency=2, pool=ConnectionPool(proxies={})) as api:
+                results = api.gather_survey_responses(CAMPAIGN, ['alice', 'bob', 'carol'], return_exceptions=True, auth_token='token')
+
+        self.assertEqual(sorted(results), ['alice', 'bob', 'carol'])
+        for user in ('alice', 'carol'):
+            self.assertEqual(results[user]['data'], [{'campaign_urn': CAMPAIGN, 'date': None, 'user': user}])
+        self.assertEqual(results['bob'].codes(), [700])
+
+    def test_gathered_mobility_is_keyed_by_user(self):
+        with self._gather_server() as server:
+            with AsyncOhmageApi(server.url, max_concurrency=2, pool=ConnectionPool(proxies={})) as api:
+                results = api.gather_mobility(['alice', 'bob', 'carol'], '2012-01-01', return_exceptions=True, auth_token='token')
+
+        for user in ('alice', 'carol'):
+            self.assertEqual(results[user]['data'], [{'campaign_urn': None, 'date': '2012-01-01', 'user': user}])
+        self.assertTrue(isinstance(results['bob'], OhmageApi.OhmageApiException))
+
+    def test_gather_raises_once_every_request_has_completed(self):
+        with self._gather_server() as server:
+            with AsyncOhmageApi(server.url, max_concurrency=2, pool=ConnectionPool(proxies={})) as api:
+                self.assertRaises(OhmageApi.OhmageApiException, api.gather_survey_responses, CAMPAIGN,
+                    ['alice', 'bob', 'carol', 'dave'], auth_token='token')
+                self.assertEqual(len(server.requests), 4)
+
+class BatchTest(unittest.TestCase):
+    def test_each_future_holds_its_calls_result_or_error(self):
+        def handler(request):
+            return (200, _failure('0700')) if request.params.get('campaign_urn_list') == 'bad' else (200, SUCCESS)
+
+        with ScriptedServer(handler) as server:
+            with _api(server).batch() as batch:
+                futures = [batch.campaign_read(auth_token='token', campaign_urn_list=urns) for urns in ('a', 'bad', 'b')]
+                self.assertEqual(server.requests, [])
+
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual([future.exception() is None for future in futures], [True, False, True])
+        self.assertEqual(futures[0].result(), SUCCESS)
+        self.assertRaises(OhmageApi.OhmageApiException, futures[1].result)
+        self.assertEqual(futures[1].exception().codes(), [700])
+
+    def test_calls_run_at_most_max_concurrency_at_once(self):
+        lock, active, peak = threading.Lock(), [0], [0]
+        def handler(request):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return (200, SUCCESS)
+
+        with ScriptedServer(handler) as server:
+            batch = _api(server).batch(max_concurrency=2)
+            for i in range(6):
+                batch.campaign_read(auth_token='token', campaign_urn_list='urn:campaign:%d' % i)
+            futures = batch.run()
+
+        self.assertEqual([future.result() for future in futures], [SUCCESS] * 6)
+        self.assertEqual(len(server.requests), 6)
+        self.assertEqual(peak[0], 2)
+
+    def test_a_batch_runs_only_the_calls_made_since_its_last_run(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            batch = _api(server).batch()
+            first = batch.config_read()
+            self.assertEqual(batch.run(), [first])
+            second = batch.config_read()
+            self.assertEqual(batch.run(), [second])
+            self.assertEqual(batch.run(), [])
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(second.result(), SUCCESS)
+
+    def test_calls_are_cancelled_if_the_block_raises(self):
+        with ScriptedServer(lambda request: (200, SUCCESS)) as server:
+            try:
+                with _api(server).batch() as batch:
+                    futures = [batch.config_read(), batch.campaign_read(auth_token='token')]
+                    raise KeyError('oops')
+            except KeyError:
+                pass
+
+        self.assertEqual(server.requests, [])
+        for future in futures:
+            self.assertRaises(Batch.Cancelled, future.result)
+
+if __name__ == '__main__':
+    unittest.main()
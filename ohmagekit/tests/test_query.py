@@ -0,0 +1,84 @@
+"""
+Tests for SurveyResponseQuery's requests, and its decoding of their json-columns results.
+"""
+
+import unittest
+
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.query import SurveyResponseQuery, ALL
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+CAMPAIGN = 'urn:campaign:test'
+
+RESULT = {'result': 'success', 'data': {
+    'urn:ohmage:user:id': {'values': ['alice', 'bob']},
+    'urn:ohmage:context:timestamp': {'values': ['2012-01-01 09:00:00', '2012-01-02 09:00:00']},
+    'urn:ohmage:prompt:id:mood': {'values': [3, 5]},
+}}
+
+class QueryTest(unittest.TestCase):
+    def test_only_what_is_needed_is_asked_for(self):
+        query = SurveyResponseQuery(CAMPAIGN, fields=['user', 'urn:ohmage:context:timezone'], prompts=['mood', 'sleep'],
+            users=['alice', 'bob'], distinct=True, start_date='2012-01-01')
+
+        self.assertEqual(query.params(), {
+            'campaign_urn': CAMPAIGN,
+            'output_format': 'json-columns',
+            'column_list': 'urn:ohmage:user:id,urn:ohmage:context:timezone,urn:ohmage:prompt:response',
+            'user_list': 'alice,bob',
+            'prompt_id_list': 'mood,sleep',
+            'suppress_metadata': 'true',
+            'collapse': 'true',
+            'start_date': '2012-01-01',
+        })
+
+    def test_surveys_and_users_default_to_all(self):
+        params = SurveyResponseQuery(CAMPAIGN, fields=['user']).params()
+        self.assertEqual((params['user_list'], params['survey_id_list'], params['column_list']), (ALL, ALL, 'urn:ohmage:user:id'))
+        self.assertFalse('prompt_id_list' in params or 'collapse' in params)
+
+        params = SurveyResponseQuery(CAMPAIGN, fields=['user'], surveys=['morning', 'evening'], users='alice').params()
+        self.assertEqual((params['user_list'], params['survey_id_list']), ('alice', 'morning,evening'))
+
+    def test_bad_queries_are_refused(self):
+        self.assertRaises(ValueError, SurveyResponseQuery, CAMPAIGN)
+        self.assertRaises(ValueError, SurveyResponseQuery, CAMPAIGN, prompts=['mood'], surveys=['morning'])
+        self.assertRaises(ValueError, SurveyResponseQuery, CAMPAIGN, fields=['no_such_field'])
+        self.assertRaises(TypeError, SurveyResponseQuery, CAMPAIGN, fields='user')
+        self.assertRaises(ValueError, SurveyResponseQuery(CAMPAIGN, fields=['user']).decode, RESULT, shape='table')
+
+    def test_results_are_decoded_into_rows_or_columns(self):
+        query = SurveyResponseQuery(CAMPAIGN, fields=['user', 'timestamp'], prompts=['mood'])
+
+        self.assertEqual(query.decode(RESULT), [
+            {'user': 'alice', 'timestamp': '2012-01-01 09:00:00', 'mood': 3},
+            {'user': 'bob', 'timestamp': '2012-01-02 09:00:00', 'mood': 5}])
+        columns = query.decode(RESULT, shape='columns')
+        self.assertEqual(columns.keys(), ['user', 'timestamp', 'mood'])
+        self.assertEqual(columns['mood'], [3, 5])
+
+    def test_missing_columns_read_as_none(self):
+        query = SurveyResponseQuery(CAMPAIGN, fields=['user'], prompts=['sleep'])
+
+        self.assertEqual(query.decode(RESULT), [{'user': 'alice', 'sleep': None}, {'user': 'bob', 'sleep': None}])
+        self.assertEqual(query.decode({'result': 'success', 'data': {}}), [])
+        self.assertEqual(query.decode({'result': 'success'}, shape='columns'), {'user': [], 'sleep': []})
+
+    def test_run_makes_the_request(self):
+        with ScriptedServer(lambda request: (200, RESULT)) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            query = SurveyResponseQuery(CAMPAIGN, fields=['user'], prompts=['mood'], auth_token='token')
+            rows = query.run(api)
+
+            failure = {'result': 'failure', 'errors': [{'code': '0700', 'text': 'no such campaign'}]}
+            server.handler = lambda request: (200, failure)
+            self.assertRaises(OhmageApi.OhmageApiException, query.run, api)
+
+        self.assertEqual(rows, [{'user': 'alice', 'mood': 3}, {'user': 'bob', 'mood': 5}])
+        params = server.requests[0].params
+        self.assertEqual((params['output_format'], params['prompt_id_list'], params['column_list']),
+            ('json-columns', 'mood', 'urn:ohmage:user:id,urn:ohmage:prompt:response'))
+
+if __name__ == '__main__':
+    unittest.main()
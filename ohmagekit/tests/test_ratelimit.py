@@ -0,0 +1,84 @@
+"""
+Tests for RateLimiter and the date range planning in ohmagekit.clients.ratelimit.
+"""
+
+import time, unittest
+from datetime import date as Date
+
+from ohmagekit.clients.ratelimit import RateLimiter, split_range, merge_ranges, covered
+
+def _headers(**headers):
+    headers = dict((name.replace('_', '-'), value) for name, value in headers.items())
+    return headers.get
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_is_allowed_and_then_paced(self):
+        limiter = RateLimiter(user_limit=(100, 3600), burst=0.03)
+        self.assertEqual([limiter.acquire('user', max_wait=0) for i in range(3)], [0.0] * 3)
+        self.assertAlmostEqual(limiter.acquire('user', max_wait=0), 36.0, delta=0.1)
+
+    def test_users_have_buckets_of_their_own(self):
+        limiter = RateLimiter(user_limit=(1, 3600))
+        self.assertEqual(limiter.acquire('alice', max_wait=0), 0.0)
+        self.assertEqual(limiter.acquire('bob', max_wait=0), 0.0)
+        self.assertTrue(limiter.acquire('alice', max_wait=0) > 0)
+
+    def test_app_limit_applies_to_every_user(self):
+        limiter = RateLimiter(app_limit=(1, 3600), user_limit=None)
+        self.assertEqual(limiter.acquire('alice', max_wait=0), 0.0)
+        self.assertTrue(limiter.acquire('bob', max_wait=0) > 0)
+
+    def test_429_blocks_the_user_until_retry_after(self):
+        limiter = RateLimiter(user_limit=(150, 3600))
+        self.assertEqual(limiter.observe('user', 429, _headers(Retry_After='120')), (RateLimiter.USER, 120.0))
+        self.assertAlmostEqual(limiter.acquire('user', max_wait=0), 120.0, delta=0.1)
+        self.assertEqual(limiter.acquire('other', max_wait=0), 0.0)
+
+    def test_retry_after_may_be_a_date(self):
+        limiter = RateLimiter()
+        retry_at = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 600))
+        scope, retry_after = limiter.observe('user', 429, _headers(Retry_After=retry_at))
+        self.assertAlmostEqual(retry_after, 600.0, delta=2)
+
+    def test_mashery_errors_block_the_app(self):
+        limiter = RateLimiter(app_limit=(1000, 86400))
+        self.assertEqual(limiter.observe('user', 403, _headers(X_Mashery_Error_Code='ERR_403_DEVELOPER_OVER_RATE')),
+            (RateLimiter.APP, 86400.0))
+        self.assertTrue(limiter.acquire('other', max_wait=0) > 0)
+
+    def test_remaining_count_from_the_server_is_respected(self):
+        limiter = RateLimiter(user_limit=(150, 3600))
+        self.assertIsNone(limiter.observe('user', 200, _headers(Fitbit_Rate_Limit_Remaining='0')))
+        self.assertTrue(limiter.acquire('user', max_wait=0) > 0)
+
+    def test_successful_responses_change_nothing(self):
+        limiter = RateLimiter()
+        self.assertIsNone(limiter.observe('user', 200, _headers()))
+        self.assertEqual(limiter.acquire('user', max_wait=0), 0.0)
+
+class DateRangeTest(unittest.TestCase):
+    def test_split_range(self):
+        self.assertEqual(split_range('2012-01-01', '20120110', 4), [(Date(2012, 1, 1), Date(2012, 1, 4)),
+            (Date(2012, 1, 5), Date(2012, 1, 8)), (Date(2012, 1, 9), Date(2012, 1, 10))])
+        self.assertEqual(split_range('2012-01-02', '2012-01-01', 4), [])
+
+    def test_split_range_without_a_limit(self):
+        self.assertEqual(split_range('2012-01-01', '2012-12-31', None), [(Date(2012, 1, 1), Date(2012, 12, 31))])
+
+    def test_merge_ranges_joins_close_ranges(self):
+        ranges = [('2012-01-10', '2012-01-12'), ('2012-01-01', '2012-01-03'), ('2012-01-05', '2012-01-06')]
+        self.assertEqual(merge_ranges(ranges, 30, max_gap_days=1), [(Date(2012, 1, 1), Date(2012, 1, 6)),
+            (Date(2012, 1, 10), Date(2012, 1, 12))])
+        self.assertEqual(merge_ranges(ranges, 3), [(Date(2012, 1, 1), Date(2012, 1, 3)),
+            (Date(2012, 1, 5), Date(2012, 1, 6)), (Date(2012, 1, 10), Date(2012, 1, 12))])
+
+    def test_merged_ranges_cover_the_same_dates(self):
+        ranges = [('2012-01-01', '2012-02-15'), ('2012-02-10', '2012-03-01'), ('2012-06-01', '2012-06-01')]
+        for max_days in (1, 7, 31, None):
+            merged = merge_ranges(ranges, max_days)
+            self.assertTrue(covered(ranges) <= covered(merged))
+            if max_days is not None:
+                self.assertTrue(all((end - start).days < max_days for start, end in merged))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+"""
+Tests for the request layer shared by all the clients: retries, circuit breaking,
+hedging, routing across replicas, and the signing, pacing and bulk polling of OAuth
+requests.
+"""
+
+import re, threading, time, unittest
+
+from ohmagekit.clients.base import BaseApi
+from ohmagekit.clients.fitbit import FitBitApi
+from ohmagekit.clients.oauth import OAuthApi
+from ohmagekit.clients.ratelimit import RateLimiter
+from ohmagekit.clients.retry import CircuitBreaker, RetryPolicy
+from ohmagekit.clients.routing import ServerRouter
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+OAUTH_URLS = ('/oauth/request_token', '/oauth/access_token', '/oauth/authorize')
+TOKEN = {'oauth_token': 'access', 'oauth_secret': 'access-secret'}
+STEPS = {'activities-steps': [{'dateTime': '2012-01-01', 'value': '10'}]}
+
+def _statuses(*statuses):
+    # a handler that answers with each status in turn, and then 200 for good
+    remaining = list(statuses)
+    return lambda request: (remaining.pop(0) if remaining else 200, 'done')
+
+def _api(server, **attributes):
+    api = BaseApi(server.url, '/app', ConnectionPool(proxies={}))
+    for name, value in attributes.items():
+        setattr(api, name, value)
+    return api
+
+def _nonce(request):
+    return re.search(r'oauth_nonce="([^"]+)"', request.headers.get('Authorization', '')).group(1)
+
+def _fitbit(server, **attributes):
+    api = FitBitApi(server.url, 'key', 'secret', *OAUTH_URLS, pool=ConnectionPool(proxies={}))
+    for name, value in attributes.items():
+        setattr(api, name, value)
+    return api
+
+class RetryTest(unittest.TestCase):
+    def test_reads_are_retried_until_they_succeed(self):
+        with ScriptedServer(_statuses(503, 500)) as server:
+            api = _api(server, retry_policy=RetryPolicy(max_attempts=3, base_delay=0.001))
+            self.assertEqual(api._perform_request('/read', {}, 'POST'), 'done')
+
+        self.assertEqual(len(server.requests), 3)
+
+    def test_uploads_are_not_retried_after_a_500(self):
+        with ScriptedServer(_statuses(500)) as server:
+            api = _api(server, retry_policy=RetryPolicy(max_attempts=3, base_delay=0.001))
+            self.assertRaises(BaseApi.HTTPException, api._perform_request, '/upload', {'a': '1'}, 'POST', 'multipart')
+
+        self.assertEqual(len(server.requests), 1)
+
+    def test_uploads_are_retried_after_a_503(self):
+        with ScriptedServer(_statuses(503)) as server:
+            api = _api(server, retry_policy=RetryPolicy(max_attempts=3, base_delay=0.001))
+            self.assertEqual(api._perform_request('/upload', {'a': '1'}, 'POST', 'multipart'), 'done')
+
+        self.assertEqual(len(server.requests), 2)
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        with ScriptedServer(_statuses(500, 500)) as server:
+            api = _api(server, circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+            for i in range(2):
+                self.assertRaises(BaseApi.HTTPException, api._perform_request, '/read', {}, 'POST')
+            self.assertRaises(CircuitBreaker.OpenError, api._perform_request, '/read', {}, 'POST')
+
+        self.assertEqual(len(server.requests), 2)
+
+    def test_trial_that_fails_unexpectedly_reopens_the_breaker(self):
+        class BrokenPool(object):
+            def request(self, *args, **kwargs):
+                raise ValueError("broken")
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        api = BaseApi('http://127.0.0.1:1', '/app', BrokenPool())
+        api.circuit_breaker = breaker
+
+        self.assertRaises(ValueError, api._perform_request, '/read', {}, 'POST')
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+class HedgingTest(unittest.TestCase):
+    def test_slow_read_is_sent_again_and_the_first_answer_wins(self):
+        release = threading.Event()
+
+        def handler(request):
+            if len(server.requests) == 1:
+                release.wait(2)
+                return (200, 'slow')
+            return (200, 'fast')
+
+        with ScriptedServer(handler) as server:
+            api = _api(server, hedge_after=0.05)
+            self.assertEqual(api._perform_request('/read', {}, 'POST'), 'fast')
+            release.set()
+
+        self.assertEqual(len(server.requests), 2)
+
+class RoutingTest(unittest.TestCase):
+    def test_reads_fail_over_to_the_next_replica(self):
+        with ScriptedServer(_statuses(500)) as failing:
+            with ScriptedServer(_statuses()) as healthy:
+                api = BaseApi([failing.url, healthy.url], '/app', ConnectionPool(proxies={}))
+                self.assertEqual(api._perform_request('/read', {}, 'POST'), 'done')
+                self.assertFalse(api.router.stats()[failing.url]['healthy'])
+
+        self.assertEqual((len(failing.requests), len(healthy.requests)), (1, 1))
+
+    def test_reads_fail_over_from_an_unreachable_replica(self):
+        with ScriptedServer(_statuses()) as healthy:
+            api = BaseApi(['http://127.0.0.1:1', healthy.url], '/app', ConnectionPool(proxies={}))
+            self.assertEqual(api._perform_request('/read', {}, 'POST'), 'done')
+
+    def test_uploads_go_to_the_primary_and_are_not_resent_after_a_500(self):
+        with ScriptedServer(_statuses(500)) as primary:
+            with ScriptedServer(_statuses()) as secondary:
+                router = ServerRouter([primary.url, secondary.url], primaries=[primary.url, secondary.url])
+                api = BaseApi(router, '/app', ConnectionPool(proxies={}))
+                self.assertRaises(BaseApi.HTTPException, api._perform_request, '/upload', {'a': '1'}, 'POST', 'multipart')
+
+        self.assertEqual((len(primary.requests), len(secondary.requests)), (1, 0))
+
+    def test_uploads_move_on_from_a_503(self):
+        with ScriptedServer(_statuses(503)) as primary:
+            with ScriptedServer(_statuses()) as secondary:
+                router = ServerRouter([primary.url, secondary.url], primaries=[primary.url, secondary.url])
+                api = BaseApi(router, '/app', ConnectionPool(proxies={}))
+                self.assertEqual(api._perform_request('/upload', {'a': '1'}, 'POST', 'multipart'), 'done')
+
+        self.assertEqual((len(primary.requests), len(secondary.requests)), (1, 1))
+
+class OAuthSigningTest(unittest.TestCase):
+    def test_each_retry_is_signed_afresh(self):
+        with ScriptedServer(lambda request: (503, '') if len(server.requests) < 3 else (200, STEPS)) as server:
+            api = _fitbit(server, retry_policy=RetryPolicy(max_attempts=3, base_delay=0.001))
+            api.activities_steps(TOKEN, start='2012-01-01', end='2012-01-01')
+
+        nonces = [_nonce(request) for request in server.requests]
+        self.assertEqual(len(nonces), 3)
+        self.assertEqual(len(set(nonces)), 3)
+
+    def test_hedged_copies_are_signed_separately(self):
+        release = threading.Event()
+
+        def handler(request):
+            if len(server.requests) == 1:
+                release.wait(2)
+            return (200, STEPS)
+
+        with ScriptedServer(handler) as server:
+            api = _fitbit(server, hedge_after=0.05)
+            api.activities_steps(TOKEN, start='2012-01-01', end='2012-01-01')
+            release.set()
+
+        self.assertNotEqual(_nonce(server.requests[0]), _nonce(server.requests[1]))
+
+class FetchManyTest(unittest.TestCase):
+    def _handler(self, request):
+        # each account has as many steps as its token's number; 'bad' isn't authorized
+        token = re.search(r'oauth_token="([^"]+)"', request.headers['Authorization']).group(1)
+        if token == 'bad':
+            return (401, 'unauthorized')
+        if token == '1':
+            # the first account answers last
+            time.sleep(0.1)
+        return (200, {'activities-steps': [{'dateTime': '2012-01-01', 'value': token}]})
+
+    def _tokens(self, *names):
+        return [{'oauth_token': name, 'oauth_secret': 'secret'} for name in names]
+
+    def test_results_are_in_the_order_of_the_tokens(self):
+        with ScriptedServer(self._handler) as server:
+            results = _fitbit(server).fetch_many(self._tokens('1', '2', '3', '4'), workers=4, start='2012-01-01', end='2012-01-01')
+
+        self.assertEqual([result['activities-steps'][0]['value'] for result in results], ['1', '2', '3', '4'])
+
+    def test_failed_accounts_give_their_exceptions(self):
+        with ScriptedServer(self._handler) as server:
+            results = _fitbit(server).fetch_many(self._tokens('1', 'bad', '3'), workers=2, start='2012-01-01', end='2012-01-01')
+
+        self.assertEqual(results[0]['activities-steps'][0]['value'], '1')
+        self.assertTrue(isinstance(results[1], OAuthApi.OAuthException))
+        self.assertEqual(results[2]['activities-steps'][0]['value'], '3')
+
+    def test_failures_are_raised_unless_returned(self):
+        with ScriptedServer(self._handler) as server:
+            self.assertRaises(OAuthApi.OAuthException, _fitbit(server).fetch_many, self._tokens('1', 'bad', '3'),
+                workers=2, return_exceptions=False, start='2012-01-01', end='2012-01-01')
+
+class RateLimitTest(unittest.TestCase):
+    def test_limiting_is_opt_in(self):
+        self.assertIsNone(FitBitApi('http://127.0.0.1:1', 'key', 'secret', *OAUTH_URLS).rate_limiter)
+
+    def test_quota_retries_are_resigned_and_capped(self):
+        with ScriptedServer(lambda request: (429, {'Retry-After': '0'}, '')) as server:
+            api = _fitbit(server, rate_limiter=RateLimiter(**FitBitApi.rate_limits), rate_limit_retries=2)
+            self.assertRaises(OAuthApi.RateLimitException, api.activities_steps, TOKEN, start='2012-01-01', end='2012-01-01')
+
+        nonces = [_nonce(request) for request in server.requests]
+        self.assertEqual(len(nonces), 3)
+        self.assertEqual(len(set(nonces)), 3)
+
+    def test_long_reset_raises_without_retrying(self):
+        with ScriptedServer(lambda request: (429, {'Retry-After': '3600'}, '')) as server:
+            api = _fitbit(server, rate_limiter=RateLimiter(**FitBitApi.rate_limits))
+            try:
+                api.activities_steps(TOKEN, start='2012-01-01', end='2012-01-01')
+            except OAuthApi.RateLimitException, ex:
+                self.assertEqual((ex.scope, ex.retry_after), (RateLimiter.USER, 3600.0))
+            else:
+                self.fail("RateLimitException not raised")
+
+        self.assertEqual(len(server.requests), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Tests for the incremental JSON parsing in ohmagekit.clients.streaming, and for the
+streamed reads OhmageApi makes with it.
+"""
+
+import simplejson, unittest
+from cStringIO import StringIO
+
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.streaming import iter_members
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+CAMPAIGN = 'urn:campaign:test'
+
+def _events(document, chunk_size=3, stream_keys=('data',)):
+    return list(iter_members(StringIO(document).read, stream_keys, chunk_size))
+
+class IterMembersTest(unittest.TestCase):
+    def test_members_and_streamed_items(self):
+        document = '{"result": "success", "data": [1, {"a": [1, 2]}, "three"], "metadata": {"count": 3}}\n'
+        self.assertEqual(_events(document), [('value', 'result', 'success'), ('item', 'data', 1),
+            ('item', 'data', {'a': [1, 2]}), ('item', 'data', 'three'), ('value', 'metadata', {'count': 3})])
+
+    def test_every_chunk_size_gives_the_same_events(self):
+        document = simplejson.dumps({'result': 'success', 'data': [{'t': 1325376000000 + n, 'la': 34.0625} for n in range(20)]})
+        expected = _events(document, chunk_size=len(document))
+        for chunk_size in range(1, 40):
+            self.assertEqual(_events(document, chunk_size), expected)
+
+    def test_numbers_split_across_chunks_are_read_whole(self):
+        self.assertEqual(_events('{"data": [12345, 678], "n": 1234567}', chunk_size=4),
+            [('item', 'data', 12345), ('item', 'data', 678), ('value', 'n', 1234567)])
+
+    def test_object_members_are_streamed_as_pairs(self):
+        self.assertEqual(_events('{"data": {"urn:a": {"name": "A"}, "urn:b": {}}}'),
+            [('item', 'data', ('urn:a', {'name': 'A'})), ('item', 'data', ('urn:b', {}))])
+
+    def test_empty_containers(self):
+        self.assertEqual(_events('{}'), [])
+        self.assertEqual(_events('{"data": [], "result": "success"}'), [('value', 'result', 'success')])
+
+    def test_members_not_named_are_decoded_whole(self):
+        self.assertEqual(_events('{"data": [1, 2]}', stream_keys=()), [('value', 'data', [1, 2])])
+
+    def test_malformed_documents_raise(self):
+        for document in ('', '[1, 2]', '{"data": [1, 2}', '{"data": [1, 2]', '{"a": 1} {"b": 2}', '{"a": tru}'):
+            self.assertRaises(ValueError, _events, document)
+
+    def test_items_before_an_error_are_still_produced(self):
+        members = iter_members(StringIO('{"data": [1, 2, oops]}').read, chunk_size=4)
+        self.assertEqual([members.next(), members.next()], [('item', 'data', 1), ('item', 'data', 2)])
+        self.assertRaises(ValueError, members.next)
+
+class StreamedReadTest(unittest.TestCase):
+    def _read(self, body, **kwargs):
+        with ScriptedServer(lambda request: (200, {'Content-Type': 'application/json'}, body)) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            return list(api.survey_response_read(auth_token='token', campaign_urn=CAMPAIGN, stream=True, **kwargs))
+
+    def test_rows_are_generated(self):
+        self.assertEqual(self._read('{"result": "success", "data": [{"n": 1}, {"n": 2}]}'), [{'n': 1}, {'n': 2}])
+
+    def test_error_envelope_is_raised(self):
+        try:
+            self._read('{"result": "failure", "errors": [{"code": "0200", "text": "bad token"}]}')
+        except OhmageApi.OhmageApiException, ex:
+            self.assertEqual(ex.codes(), [200])
+        else:
+            self.fail("OhmageApiException not raised")
+
+    def test_csv_rows_are_generated_as_dicts(self):
+        with ScriptedServer(lambda request: (200, {'Content-Type': 'text/csv'}, '#{"result":"success"}\nuser\nalice\nbob\n')) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            rows = list(api.survey_response_read(auth_token='token', campaign_urn=CAMPAIGN, output_format='csv', stream=True))
+
+        self.assertEqual(rows, [{'user': 'alice'}, {'user': 'bob'}])
+
+    def test_connection_is_reused_after_a_complete_read(self):
+        body = '{"result": "success", "data": [1, 2]}'
+        with ScriptedServer(lambda request: (200, body)) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            for i in range(3):
+                self.assertEqual(list(api.survey_response_read(auth_token='token', campaign_urn=CAMPAIGN, stream=True)), [1, 2])
+
+        self.assertEqual(server.connections, 1)
+
+if __name__ == '__main__':
+    unittest.main()
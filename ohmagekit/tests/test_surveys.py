@@ -0,0 +1,76 @@
+"""
+Tests for the survey records and their encoding: CompactSurvey must encode to the
+same JSON as the equivalent Survey.
+"""
+
+import simplejson, unittest
+from cStringIO import StringIO
+
+from ohmagekit.clients.ohmage import (OhmageApi, Survey, Response, CompactSurvey, CompactResponse,
+    encode_survey, encode_surveys)
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+# values of every type a response may take
+VALUES = [1, 2L ** 40, 0.5, u'caf\xe9', 'quote " and \\ backslash', '\n\t', None, True, ['a', 1], {'key': [1.5]}]
+
+def _pair(survey_id='survey', values=VALUES, uuid='key'):
+    # a Survey and a CompactSurvey that should encode alike
+    survey = Survey(survey_id, 1325376000000, 'America/Los_Angeles',
+        [Response('prompt%d' % i, value) for i, value in enumerate(values)], uuid=uuid)
+    compact = CompactSurvey(survey_id, 1325376000000, 'America/Los_Angeles',
+        [CompactResponse('prompt%d' % i, value) for i, value in enumerate(values)], uuid=uuid)
+    return survey, compact
+
+class EncoderTest(unittest.TestCase):
+    def test_compact_surveys_encode_like_surveys(self):
+        survey, compact = _pair()
+        self.assertEqual(simplejson.loads(encode_survey(compact)), simplejson.loads(encode_survey(survey)))
+
+    def test_encoding_is_ascii(self):
+        survey, compact = _pair(survey_id=u'\u65e5\u672c')
+        encoded = encode_survey(compact)
+        encoded.decode('ascii')
+        self.assertEqual(simplejson.loads(encoded)['survey_id'], u'\u65e5\u672c')
+
+    def test_plain_tuples_serve_as_responses(self):
+        compact = CompactSurvey('survey', 1, 'UTC', [('prompt', 'value')], uuid='key')
+        self.assertEqual(simplejson.loads(encode_survey(compact))['responses'], [{'prompt_id': 'prompt', 'value': 'value'}])
+
+    def test_lists_may_mix_both_kinds(self):
+        survey, compact = _pair()
+        encoded = encode_surveys([survey, compact, compact])
+        self.assertEqual(simplejson.loads(encoded), [simplejson.loads(encode_survey(survey))] * 3)
+        self.assertEqual(encode_surveys([]), '[]')
+
+    def test_encoding_into_a_buffer(self):
+        survey, compact = _pair()
+        buf = StringIO()
+        self.assertIsNone(encode_surveys([compact, survey], buf))
+        self.assertEqual(buf.getvalue(), encode_surveys([compact, survey]))
+
+    def test_keys_are_generated_unless_given(self):
+        first, second = CompactSurvey('survey', 1, 'UTC', []), CompactSurvey('survey', 1, 'UTC', [])
+        self.assertNotEqual(first.survey_key, second.survey_key)
+        self.assertEqual(CompactSurvey('survey', 1, 'UTC', [], uuid=7).survey_key, '7')
+
+    def test_compact_surveys_have_no_dict(self):
+        self.assertFalse(hasattr(CompactSurvey('survey', 1, 'UTC', []), '__dict__'))
+
+    def test_unencodable_values_raise(self):
+        self.assertRaises(TypeError, encode_survey, CompactSurvey('survey', 1, 'UTC', [('prompt', object())]))
+
+class UploadTest(unittest.TestCase):
+    def test_compact_surveys_are_uploaded(self):
+        survey, compact = _pair()
+        with ScriptedServer(lambda request: (200, {'result': 'success'})) as server:
+            api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+            api.survey_upload('user', 'hashed', 'urn:campaign:test', '2012-01-01 00:00:00', [compact])
+            results = api.bulk_survey_upload('urn:campaign:test', [compact], '2012-01-01 00:00:00', 'user', 'hashed')
+
+        self.assertEqual([result.survey_key for result in results], ['key'])
+        for request in server.requests:
+            self.assertEqual(simplejson.loads(request.params['surveys']), [simplejson.loads(encode_survey(survey))])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+Tests for the incremental survey response sync in ohmagekit.sync.
+"""
+
+import simplejson, unittest
+from datetime import date as Date, timedelta
+
+from ohmagekit.clients.ohmage import OhmageApi
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.sync import SurveyResponseStore, SurveyResponseSync
+from ohmagekit.tests.scripted import ScriptedServer
+
+CAMPAIGN = 'urn:campaign:test'
+
+def _row(key, timestamp, user='alice', **fields):
+    return dict(fields, survey_key=key, user=user, survey_id='survey', timestamp=timestamp)
+
+class ResponseServer(ScriptedServer):
+    """
+    Serves 'rows' from survey_response/read, honouring start_date and survey_response_id_list.
+    If 'broken' is set, the body is cut off after the rows with a malformed ending.
+    """
+
+    def __init__(self, rows):
+        ScriptedServer.__init__(self, self._answer)
+        self.rows = rows
+        self.broken = False
+
+    def _answer(self, request):
+        rows = self.rows
+        if 'start_date' in request.params:
+            rows = [row for row in rows if row['timestamp'][:10] >= request.params['start_date']]
+        if 'survey_response_id_list' in request.params:
+            rows = [row for row in self.rows if row['survey_key'] in request.params['survey_response_id_list'].split(',')]
+
+        body = simplejson.dumps({'result': 'success', 'data': rows})
+        return (200, body[:-2] + ', oops' if self.broken else body)
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.store = SurveyResponseStore(':memory:')
+
+    def tearDown(self):
+        self.store.close()
+
+    def _sync(self, server, batch_size=500, **kwargs):
+        api = OhmageApi(server.url, pool=ConnectionPool(proxies={}))
+        return SurveyResponseSync(api, self.store, batch_size=batch_size).sync(CAMPAIGN, auth_token='token', **kwargs)
+
+    def test_first_sync_reads_everything(self):
+        rows = [_row('a', '2012-01-01 09:00:00'), _row('b', '2012-01-03 09:00:00', user='bob')]
+        with ResponseServer(rows) as server:
+            self.assertEqual(self._sync(server), {'fetched': 2, 'high_water': '2012-01-03 09:00:00'})
+
+        self.assertEqual(server.requests[0].params['return_id'], 'true')
+        self.assertFalse('start_date' in server.requests[0].params)
+        self.assertEqual(list(self.store.responses(CAMPAIGN)), rows)
+        self.assertEqual(list(self.store.responses(CAMPAIGN, user='bob')), rows[1:])
+        self.assertEqual(list(self.store.responses(CAMPAIGN, start='2012-01-02')), rows[1:])
+
+    def test_later_syncs_read_from_the_high_water_mark(self):
+        rows = [_row('a', '2012-01-01 09:00:00'), _row('b', '2012-01-05 09:00:00')]
+        with ResponseServer(rows) as server:
+            self._sync(server)
+            rows.append(_row('c', '2012-01-06 09:00:00'))
+            result = self._sync(server)
+
+        params = server.requests[1].params
+        self.assertEqual((params['start_date'], params['end_date']), ('2011-12-29', (Date.today() + timedelta(days=1)).isoformat()))
+        self.assertEqual(result, {'fetched': 3, 'high_water': '2012-01-06 09:00:00'})
+        self.assertEqual(self.store.count(CAMPAIGN), 3)
+
+    def test_changed_responses_are_read_again(self):
+        rows = [_row('a', '2012-01-01 09:00:00'), _row('b', '2012-01-05 09:00:00')]
+        with ResponseServer(rows) as server:
+            self._sync(server)
+            rows[0] = _row('a', '2012-01-01 09:00:00', privacy_state='shared')
+            self._sync(server, changed_ids=['a'])
+
+        self.assertEqual(server.requests[-1].params['survey_response_id_list'], 'a')
+        self.assertEqual(list(self.store.responses(CAMPAIGN))[0]['privacy_state'], 'shared')
+        self.assertEqual(self.store.count(CAMPAIGN), 2)
+
+    def test_interrupted_sync_keeps_the_high_water_mark_and_resumes(self):
+        rows = [_row('a', '2012-01-01 09:00:00'), _row('b', '2012-01-05 09:00:00')]
+        with ResponseServer(rows) as server:
+            self._sync(server)
+
+            rows.extend([_row('c', '2012-01-06 09:00:00'), _row('d', '2012-01-07 09:00:00')])
+            server.broken = True
+            self.assertRaises(ValueError, self._sync, server, batch_size=1)
+            self.assertEqual(self.store.high_water(CAMPAIGN), '2012-01-05 09:00:00')
+
+            server.broken = False
+            result = self._sync(server)
+
+        self.assertEqual(server.requests[-1].params['start_date'], '2011-12-29')
+        self.assertEqual(result['high_water'], '2012-01-07 09:00:00')
+        self.assertEqual([row['survey_key'] for row in self.store.responses(CAMPAIGN)], ['a', 'b', 'c', 'd'])
+
+    def test_future_timestamps_do_not_push_the_window_past_today(self):
+        today = Date.today()
+        rows = [_row('a', '2031-01-01 09:00:00')]
+        with ResponseServer(rows) as server:
+            self.assertEqual(self._sync(server)['high_water'], today.isoformat())
+
+            rows.extend([_row('b', '%s 09:00:00' % today), _row('c', '%s 09:00:00' % (today - timedelta(days=3)))])
+            self._sync(server)
+
+        params = server.requests[-1].params
+        self.assertEqual((params['start_date'], params['end_date']), ((today - timedelta(days=7)).isoformat(), (today + timedelta(days=1)).isoformat()))
+        self.assertEqual(self.store.count(CAMPAIGN), 3)
+
+    def test_start_date_never_passes_end_date(self):
+        # a future high-water mark stored before it was capped
+        self.store.set_high_water(CAMPAIGN, '2031-01-01 09:00:00')
+        with ResponseServer([]) as server:
+            self._sync(server)
+
+        params = server.requests[0].params
+        self.assertEqual(params['start_date'], params['end_date'])
+
+    def test_late_uploads_are_read_within_the_overlap(self):
+        rows = [_row('a', '2012-01-10 09:00:00')]
+        with ResponseServer(rows) as server:
+            self._sync(server)
+
+            # taken earlier, but only uploaded after the first sync
+            rows.extend([_row('b', '2012-01-04 09:00:00'), _row('c', '2012-01-02 09:00:00')])
+            result = self._sync(server)
+
+        self.assertEqual(result, {'fetched': 2, 'high_water': '2012-01-10 09:00:00'})
+        # 'c' was taken more than overlap_days before the high-water mark, so it's missed
+        self.assertEqual([row['survey_key'] for row in self.store.responses(CAMPAIGN)], ['b', 'a'])
+
+    def test_rows_without_ids_are_refused(self):
+        self.assertRaises(ValueError, self.store.upsert, CAMPAIGN, [{'timestamp': '2012-01-01 09:00:00'}])
+        self.assertEqual(self.store.count(CAMPAIGN), 0)
+
+    def test_utc_timestamps_are_preferred(self):
+        self.assertEqual(self.store.upsert(CAMPAIGN, [_row('a', '2012-01-01 23:00:00', utc_timestamp='2012-01-02 07:00:00')]),
+            '2012-01-02 07:00:00')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+Tests for the keep-alive ConnectionPool: connection reuse, resending requests whose
+connection was lost, redirects, proxies and compression.
+"""
+
+import httplib, socket, time, unittest
+
+from ohmagekit.clients.transport import ConnectionPool
+from ohmagekit.tests.scripted import ScriptedServer
+
+FORM = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+class ConnectionReuseTest(unittest.TestCase):
+    def test_requests_share_a_connection(self):
+        with ScriptedServer(lambda request: (200, 'ok')) as server:
+            pool = ConnectionPool(proxies={})
+            for i in range(5):
+                self.assertEqual(pool.request(server.url + '/read').read(), 'ok')
+
+        self.assertEqual(server.connections, 1)
+
+    def test_unread_response_discards_its_connection(self):
+        with ScriptedServer(lambda request: (200, 'x' * 100000)) as server:
+            pool = ConnectionPool(proxies={})
+            pool.request(server.url + '/read').close()
+            pool.request(server.url + '/read').read()
+
+        self.assertEqual(server.connections, 2)
+
+    def test_connection_closed_while_idle_is_not_reused(self):
+        with ScriptedServer(lambda request: (200, 'ok')) as server:
+            pool = ConnectionPool(proxies={})
+            pool.request(server.url + '/read').read()
+
+            server._server.close_connections()
+            time.sleep(0.05)
+
+            resp = pool.request(server.url + '/upload', 'POST', 'a=1', FORM, idempotent=False)
+            self.assertEqual(resp.read(), 'ok')
+
+        self.assertEqual(server.paths(), ['/read', '/upload'])
+
+    def test_body_cut_short_raises(self):
+        for amt in (None, 1000):
+            with ScriptedServer(lambda request: (200, {'Content-Length': '100000'}, 'x' * 5000)) as server:
+                resp = ConnectionPool(proxies={}).request(server.url + '/read')
+                self.assertRaises(httplib.IncompleteRead, lambda: [resp.read(amt) for i in range(200)])
+
+class ReplayTest(unittest.TestCase):
+    # the server reads the whole request on a reused connection, then cuts it off unanswered
+    def _cut_after_first(self, method, idempotent):
+        def handler(request):
+            return (200, 'ok') if len(server.requests) == 1 else None
+
+        with ScriptedServer(handler) as server:
+            pool = ConnectionPool(proxies={})
+            pool.request(server.url + '/first').read()
+            try:
+                pool.request(server.url + '/second', method, 'a=1', FORM, idempotent=idempotent).read()
+            except (httplib.HTTPException, socket.error):
+                pass
+
+        return server.paths().count('/second')
+
+    def test_idempotent_request_is_resent_on_a_fresh_connection(self):
+        self.assertEqual(self._cut_after_first('POST', True), 2)
+
+    def test_request_that_was_sent_in_full_is_not_resent(self):
+        self.assertEqual(self._cut_after_first('POST', False), 1)
+
+    def test_idempotence_defaults_to_the_method(self):
+        self.assertEqual(self._cut_after_first('GET', None), 2)
+        self.assertEqual(self._cut_after_first('POST', None), 1)
+
+class RedirectTest(unittest.TestCase):
+    def _server(self, status):
+        return ScriptedServer(lambda request: (status, {'Location': '/target'}, '') if request.path == '/moved' else (200, request.method))
+
+    def test_get_follows_redirects(self):
+        with self._server(302) as server:
+            resp = ConnectionPool(proxies={}).request(server.url + '/moved')
+            self.assertEqual((resp.status, resp.read()), (200, 'GET'))
+
+    def test_post_is_not_redirected_by_302(self):
+        with self._server(302) as server:
+            resp = ConnectionPool(proxies={}).request(server.url + '/moved', 'POST', 'a=1', FORM)
+            resp.read()
+            self.assertEqual(resp.status, 302)
+
+    def test_303_becomes_a_get(self):
+        with self._server(303) as server:
+            resp = ConnectionPool(proxies={}).request(server.url + '/moved', 'POST', 'a=1', FORM)
+            self.assertEqual(resp.read(), 'GET')
+
+    def test_307_resends_method_and_body(self):
+        with self._server(307) as server:
+            resp = ConnectionPool(proxies={}).request(server.url + '/moved', 'POST', 'a=1', FORM)
+            self.assertEqual(resp.read(), 'POST')
+            self.assertEqual(server.requests[-1].params, {'a': '1'})
+
+    def test_redirect_loops_stop(self):
+        with ScriptedServer(lambda request: (302, {'Location': '/again'}, '')) as server:
+            resp = ConnectionPool(proxies={}, max_redirects=3).request(server.url + '/again')
+            resp.read()
+            self.assertEqual(resp.status, 302)
+            self.assertEqual(len(server.requests), 4)
+
+class ProxyTest(unittest.TestCase):
+    def test_http_goes_through_the_proxy(self):
+        with ScriptedServer(lambda request: (200, request.url)) as proxy:
+            pool = ConnectionPool(proxies={'http': proxy.url.replace('://', '://user:secret@')})
+            self.assertEqual(pool.request('http://ohmage.invalid/app/config/read').read(), 'http://ohmage.invalid/app/config/read')
+            self.assertEqual(proxy.requests[0].headers['Proxy-Authorization'], 'Basic dXNlcjpzZWNyZXQ=')
+
+    def test_empty_proxies_connect_directly(self):
+        with ScriptedServer(lambda request: (200, request.url)) as server:
+            self.assertEqual(ConnectionPool(proxies={}).request(server.url + '/read').read(), '/read')
+
+class CompressionTest(unittest.TestCase):
+    def test_large_bodies_are_gzipped(self):
+        with ScriptedServer(lambda request: (200, request.params['a'][:3])) as server:
+            pool = ConnectionPool(proxies={}, compress_requests_over=100)
+            self.assertEqual(pool.request(server.url + '/upload', 'POST', 'a=' + 'x' * 1000, FORM).read(), 'xxx')
+
+        self.assertTrue(server.requests[0].compressed)
+        self.assertEqual(pool.compression_stats()['requests_compressed'], 1)
+
+    def test_host_that_refuses_gzip_gets_plain_bodies(self):
+        with ScriptedServer(lambda request: (415, '') if request.compressed else (200, 'ok')) as server:
+            pool = ConnectionPool(proxies={}, compress_requests_over=100)
+            for i in range(2):
+                self.assertEqual(pool.request(server.url + '/upload', 'POST', 'a=' + 'x' * 1000, FORM).read(), 'ok')
+
+        self.assertEqual([request.compressed for request in server.requests], [True, False, False])
+
+if __name__ == '__main__':
+    unittest.main()
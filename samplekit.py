@@ -30,7 +30,7 @@ except OhmageApi.OhmageApiException as ex:
 
 # note that other things may go wrong (you may lose your network connection,
 # or the Ohmage server may be inaccessible, for instance). in this case, the
-# api throws standard HTTPError exceptions, as detailed in the urllib2 documentation.
+# api throws the standard socket.error and httplib.HTTPException exceptions.
 
 # practically all the ohmage api calls return a dictionary with two elements:
 # - result['status'], which contains the status of the call, and
@@ -41,6 +41,7 @@ except OhmageApi.OhmageApiException as ex:
 for urn, campaign in result['data'].items():
     print "Campaign %s has URN %s" % (campaign['name'], urn)
 
-# there's no need to close the api handle, so we're done.
-# perhaps i'll implement persistent connections in the future,
-# which may necessitate closing the handle to free up resources.
+# requests reuse keep-alive connections from a pool shared by all api
+# handles. closing the handle (or using it in a 'with' block) closes the
+# idle connections; the handle will open new ones if it's used again.
+api.close()
@@ -1,10 +1,12 @@
+from setuptools import setup
+
 setup(
     name='ohmageKit',
     version='0.1.0',
     author='Faisal Alquaddoomi',
     author_email='falquaddoomi@ucla.edu',
-    packages=['ohmagekit'],
-    # scripts=['bin/stowe-towels.py','bin/wash-towels.py'],
+    packages=['ohmagekit', 'ohmagekit.clients', 'ohmagekit.tests'],
+    scripts=['bin/ohmage-export'],
     url='https://github.com/cens/ohmagePythonClient',
     # license='LICENSE.txt',
     description='Client library for accessing ohmage and related services',